@@ -1,7 +1,10 @@
 import logging
 
+import numpy as np
 import datajoint as dj
+from datajoint import blob
 import hashlib
+from tqdm import tqdm
 
 log = logging.getLogger(__name__)
 
@@ -69,6 +72,163 @@ class InsertBuffer(object):
             return self.flush(1)
 
 
+class ColumnarInsertBuffer(object):
+    '''
+    ColumnarInsertBuffer: a utility class to help bulk inserts of columnar data
+
+    Rows are given as columns rather than as one dict per row:
+        + `key`: attributes shared by all rows (e.g. the probe insertion key)
+        + `columns`: equal-length per-row arrays (e.g. unit, trial)
+        + `ragged`: per-row blob attributes given as a flat buffer and
+          row offsets into it - row i is buffer[offsets[i]:offsets[i+1]]
+
+    Blob attributes given in `columns` are serialized per row and, as in
+    `Table.insert`, NaN in numeric attributes is written as NULL.
+
+    Blobs are serialized once as the rows are streamed out and the rows are
+    written as multi-row INSERT statements, each capped by a byte budget
+    (`max_bytes`, approximate - before escaping) rather than by a row count.
+    The byte budget defaults to dj.config['custom']['insert.max_bytes'].
+
+    Like InsertBuffer, currently requires records do not have prerequisites;
+    this writes directly to the table, bypassing the checks in `Table.insert`.
+    '''
+    default_max_bytes = 16 * 1024 ** 2
+
+    def __init__(self, rel, max_bytes=None, skip_duplicates=False):
+        self._rel = rel() if isinstance(rel, type) else rel  # table class or instance
+        self._max_bytes = max_bytes or dj.config['custom'].get('insert.max_bytes', self.default_max_bytes)
+        self._skip_duplicates = skip_duplicates
+        self._fields = None
+        self._placeholders, self._args, self._nbytes = [], [], 0
+        self.row_count = 0
+
+    def insert(self, columns, key=None, ragged=None):
+        '''
+        queue the rows given by `columns` (and `ragged`), combined with `key`,
+        flushing an INSERT each time the byte budget is reached
+        '''
+        key, ragged = key or {}, ragged or {}
+
+        fields = list(key) + list(columns) + list(ragged)
+        if self._fields is None:
+            for f in fields:
+                if f not in self._rel.heading.names:
+                    raise dj.DataJointError('Field `{}` not in the table heading'.format(f))
+                attr = self._rel.heading.attributes[f]
+                if (attr.adapter or attr.is_external or attr.is_attachment or attr.is_filepath
+                        or (f in ragged and not attr.is_blob)):
+                    raise dj.DataJointError('Unsupported attribute `{}` for columnar insert'.format(f))
+            self._fields = fields
+        elif fields != self._fields:
+            raise dj.DataJointError('Inconsistent fields for columnar insert: {} vs {}'.format(
+                fields, self._fields))
+
+        key_values = [self._encode(f, v) for f, v in key.items()]
+        key_nbytes = sum(len(v) if isinstance(v, bytes) else 8 for v in key_values)
+
+        columns = [self._encode_column(f, v) for f, v in columns.items()]
+        ragged = [(np.asarray(buf), np.asarray(offsets)) for buf, offsets in ragged.values()]
+
+        nrows = len(columns[0]) if columns else len(ragged[0][1]) - 1
+        if any(len(c) != nrows for c in columns) or any(len(o) != nrows + 1 for _, o in ragged):
+            raise dj.DataJointError('Columns of unequal length for columnar insert')
+
+        placeholder = '(' + ','.join(['%s'] * len(self._fields)) + ')'
+        for i in range(nrows):
+            row = key_values + [c[i] for c in columns]
+            row.extend(blob.pack(buf[offsets[i]:offsets[i + 1]]) for buf, offsets in ragged)
+            self._placeholders.append(placeholder)
+            self._args.extend(row)
+            self._nbytes += key_nbytes + sum(len(v) if isinstance(v, bytes) else 8 for v in row[len(key_values):])
+            self.row_count += 1
+            if self._nbytes >= self._max_bytes:
+                self.flush()
+
+    def _encode(self, name, value):
+        attr = self._rel.heading.attributes[name]
+        value = value.item() if isinstance(value, np.generic) else value
+        if attr.is_blob:
+            return blob.pack(value)
+        if attr.numeric and isinstance(value, float) and np.isnan(value):  # nans are turned into NULLs
+            return None
+        return value
+
+    def _encode_column(self, name, values):
+        attr = self._rel.heading.attributes[name]
+        if attr.is_blob:
+            return [blob.pack(v) for v in values]
+
+        values = np.asarray(values)
+        if attr.numeric and values.dtype.kind == 'f':
+            is_nan = np.isnan(values)
+            if is_nan.any():
+                values = values.astype(object)
+                values[is_nan] = None
+        elif attr.numeric and values.dtype.kind == 'O':
+            return [self._encode(name, v) for v in values]
+        return values.tolist()
+
+    def flush(self):
+        '''
+        write out all queued rows as a single INSERT statement
+        '''
+        qlen = len(self._placeholders)
+        if qlen == 0:
+            return 0
+
+        query = 'INSERT INTO {table}(`{fields}`) VALUES {placeholders}{duplicate}'.format(
+            table=self._rel.full_table_name, fields='`,`'.join(self._fields),
+            placeholders=','.join(self._placeholders),
+            duplicate=(' ON DUPLICATE KEY UPDATE `{pk}`=`{pk}`'.format(pk=self._rel.primary_key[0])
+                       if self._skip_duplicates else ''))
+        self._rel.connection.query(query, args=self._args)
+        self._placeholders, self._args, self._nbytes = [], [], 0
+        return qlen
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        if etype:
+            raise evalue
+        else:
+            return self.flush()
+
+
+def populate_batched(table, batch_table, make_batch, restrictions, schema, reserve_jobs=False,
+                     display_progress=False, suppress_errors=False):
+    """
+    Populate `table` one `batch_table` key (e.g. probe insertion, session) at a time,
+     each with `make_batch(batch_key, *restrictions)` in its own transaction
+    Jobs are reserved per batch key (in `schema`'s jobs table, under `table`): the hash of a batch key never matches
+     that of a key of `table` itself, so these reservations do not exclude a concurrent `table.populate()`
+     (nor the converse) - do not run both on the same keys at the same time (duplicate entry errors)
+    :param schema: the dj.Schema of `table` (for its jobs table)
+    :return: list of (batch_key, error) if suppress_errors
+    """
+    todo = (batch_table & ((table().key_source - table) & dj.AndList(restrictions)).proj()).fetch('KEY')
+
+    errors = []
+    for batch_key in (tqdm(todo) if display_progress else todo):
+        if reserve_jobs and not schema.jobs.reserve(table.table_name, batch_key):
+            continue
+        try:
+            with dj.conn().transaction:
+                make_batch(batch_key, *restrictions)
+        except Exception as e:
+            if reserve_jobs:
+                schema.jobs.error(table.table_name, batch_key, error_message=str(e))
+            if not suppress_errors:
+                raise
+            log.error('{}: {} - {}'.format(table.__name__, batch_key, e))
+            errors.append((batch_key, e))
+        else:
+            if reserve_jobs:
+                schema.jobs.complete(table.table_name, batch_key)
+    return errors
+
+
 def dict_value_to_hash(key):
     """
 	Given a dictionary `key`, returns a hash string of the values
@@ -8,7 +8,7 @@ import scipy.io as scio
 
 import nrrd
 
-from . import InsertBuffer
+from . import ColumnarInsertBuffer
 from . import get_schema_name, create_schema_settings
 
 schema = dj.schema(get_schema_name('ccf'), **create_schema_settings)
@@ -89,7 +89,7 @@ class CCFAnnotation(dj.Manual):
     """
 
     @classmethod
-    def load_ccf_annotation(cls):
+    def load_ccf_annotation(cls, planes_per_batch=10):
         """
         Load the CCF r3 10 uM NRRD Dataset scaled to 20um.
 
@@ -104,6 +104,9 @@ class CCFAnnotation(dj.Manual):
                 }
             }
 
+        Voxels are labeled and inserted in batches of `planes_per_batch` AP planes,
+        an interrupted load resumes from the planes not yet loaded.
+
         see also:
 
         http://download.alleninstitute.org/informatics-archive/current-release/mouse_ccf/annotation/ccf_2017
@@ -130,41 +133,49 @@ class CCFAnnotation(dj.Manual):
         log.info('.. loaded stack of shape {} from {}'
                  .format(stack.shape, stack_path))
 
-        # iterate over ccf ontology region id/name records,
-        regions = get_ontology_regions()
-        chunksz, ib_args = 50000, {'skip_duplicates': True,
-                                   'allow_direct_insert': True}
+        # vectorized region id -> region name lookup over the ccf ontology
+        regions = get_ontology_regions().sort_index()
+        region_ids = regions.index.values.astype(np.int64)
+        region_names = regions.region_name.values
 
-        for idx, (region_id, r) in enumerate(regions.iterrows()):
+        label_key = {'ccf_label_id': CCFLabel.CCF_R3_20UM_ID}
+        annotation_key = {**label_key, 'annotation_version': version_name}
 
-            region_id = int(region_id)
+        # resume: each batch of AP planes is loaded in a single transaction,
+        # so any plane already in CCFAnnotation has been fully loaded
+        loaded_planes = set((dj.U('ccf_z') & (cls & annotation_key)).fetch('ccf_z'))
+        if loaded_planes:
+            log.info('.. {} AP planes already loaded - resuming'.format(len(loaded_planes)))
 
-            log.info('.. loading region {} ({}/{}) ({})'
-                     .format(region_id, idx, len(regions), r.region_name))
+        for z_start in range(0, stack.shape[0], planes_per_batch):
+            planes = np.arange(z_start, min(z_start + planes_per_batch, stack.shape[0]))
+            if all(p * scale_factor in loaded_planes for p in planes):
+                continue
 
-            # extracting filled volumes from stack in scaled [[x,y,z]] shape,
-            vol = (np.array(np.where(stack == region_id)).T[:, [2, 1, 0]]
-                   * scale_factor)
+            # label all voxels of this batch of planes in one pass
+            slab = stack[planes[0]:planes[-1] + 1].astype(np.int64)
+            region_ind = np.searchsorted(region_ids, slab)
+            region_ind[region_ind == len(region_ids)] = 0
+            in_ontology = region_ids[region_ind] == slab
 
-            if not vol.shape[0]:
-                log.info('.. region {} volume: shape {} - skipping'
-                         .format(region_id, vol.shape))
+            z, y, x = np.nonzero(in_ontology)
+            if not len(z):
                 continue
 
-            log.info('.. region {} volume: shape {}'.format(
-                region_id, vol.shape))
+            voxels = {'ccf_x': x * scale_factor,
+                      'ccf_y': y * scale_factor,
+                      'ccf_z': (z + planes[0]) * scale_factor}
+
+            log.info('.. loading AP planes {}-{}/{}: {} voxels'.format(
+                planes[0], planes[-1], stack.shape[0], len(z)))
 
             with dj.conn().transaction:
-                with InsertBuffer(CCF, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1((CCFLabel.CCF_R3_20UM_ID, *vox))
+                with ColumnarInsertBuffer(CCF, skip_duplicates=True) as buf:
+                    buf.insert(voxels, key=label_key)
 
-                with InsertBuffer(cls, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1({'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
-                                     'ccf_x': vox[0], 'ccf_y': vox[1], 'ccf_z': vox[2],
-                                     'annotation_version': version_name,
-                                     'annotation': r.region_name})
+                with ColumnarInsertBuffer(cls, skip_duplicates=True) as buf:
+                    buf.insert({**voxels, 'annotation': region_names[region_ind[z, y, x]]},
+                               key=annotation_key)
 
         log.info('.. done.')
 
@@ -192,6 +203,7 @@ class AnnotatedBrainSurface(dj.Manual):
 
 # ========= HELPER METHODS ======
 _ccf_xyz_max = None
+_ccf_annotation_volumes = {}
 
 
 def get_ontology_regions():
@@ -210,3 +222,85 @@ def get_ccf_xyz_max():
                                      ymax='max(ccf_y)',
                                      zmax='max(ccf_z)').fetch1('xmax', 'ymax', 'zmax')
     return _ccf_xyz_max
+
+
+class CCFAnnotationVolume:
+    """
+    Dense (ML x DV x AP) volume of the CCFAnnotation labels of one annotation version,
+    one element per CCF voxel - label 0 is un-annotated, label i > 0 is the region in self.regions.loc[i]
+    Built from a single fetch of CCFAnnotation and, if dj.config['custom']['ccf.annotation_cache_dir']
+    is set, cached there as .npy - subsequently loaded as a memmap
+    """
+
+    def __init__(self, annotation_version, ccf_label_id=CCFLabel.CCF_R3_20UM_ID):
+        self.key = {'ccf_label_id': ccf_label_id, 'annotation_version': annotation_version}
+        self.resolution = CCFLabel.CCF_R3_20UM_RESOLUTION
+        self._volume = None
+
+        regions = (CCFBrainRegion & self.key).fetch(format='frame', order_by='region_id').reset_index()
+        regions.index = np.arange(1, len(regions) + 1)
+        self.regions = regions[['region_name', 'region_id', 'color_code']]
+
+        # per-label lookup arrays, with label 0 for un-annotated voxels
+        self._region_names = np.concatenate([[''], self.regions.region_name.values]).astype(object)
+        self._color_codes = np.concatenate([[''], self.regions.color_code.values]).astype(object)
+
+    @property
+    def volume(self):
+        if self._volume is None:
+            cache_dir = dj.config['custom'].get('ccf.annotation_cache_dir')
+            cache_file = None
+            if cache_dir:
+                # voxel count in the file name - a reloaded CCFAnnotation invalidates the cache
+                cache_file = pathlib.Path(cache_dir) / 'ccf_annotation_{}_{}_{}.npy'.format(
+                    self.key['annotation_version'], self.key['ccf_label_id'], len(CCFAnnotation & self.key))
+                if cache_file.exists():
+                    self._volume = np.load(cache_file, mmap_mode='r')
+                    return self._volume
+
+            self._volume = self._build_volume()
+
+            if cache_file is not None:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                np.save(cache_file, self._volume)
+                self._volume = np.load(cache_file, mmap_mode='r')
+        return self._volume
+
+    def _build_volume(self):
+        log.info('CCFAnnotationVolume: building the {annotation_version} annotation volume'.format(**self.key))
+        x, y, z, annotation = (CCFAnnotation & self.key).fetch('ccf_x', 'ccf_y', 'ccf_z', 'annotation')
+        labels = pd.Index(self.regions.region_name).get_indexer(annotation) + 1
+
+        x, y, z = (np.asarray(c, dtype=int) // self.resolution for c in (x, y, z))
+        volume = np.zeros((x.max() + 1, y.max() + 1, z.max() + 1), dtype=np.uint16)
+        volume[x, y, z] = labels
+        return volume
+
+    def labels(self, ccf_x, ccf_y, ccf_z):
+        """
+        Labels of the voxels at the given (broadcastable) CCF coordinates (um) - 0 if outside the volume
+        """
+        ind = np.broadcast_arrays(*(np.round(np.asarray(c, dtype=float) / self.resolution).astype(int)
+                                    for c in (ccf_x, ccf_y, ccf_z)))
+        in_volume = np.logical_and.reduce([(i >= 0) & (i < n) for i, n in zip(ind, self.volume.shape)])
+        labels = np.zeros(in_volume.shape, dtype=self.volume.dtype)
+        labels[in_volume] = self.volume[tuple(i[in_volume] for i in ind)]
+        return labels
+
+    def region_names(self, labels):
+        return self._region_names[labels]
+
+    def color_codes(self, labels):
+        return self._color_codes[labels]
+
+
+def get_ccf_annotation_volume(annotation_version=None):
+    """
+    Process-local CCFAnnotationVolume of `annotation_version`,
+    default to dj.config['custom']['ccf_data_paths']['version_name'] (CCF_2017)
+    """
+    if annotation_version is None:
+        annotation_version = dj.config['custom'].get('ccf_data_paths', {}).get('version_name', 'CCF_2017')
+    if annotation_version not in _ccf_annotation_volumes:
+        _ccf_annotation_volumes[annotation_version] = CCFAnnotationVolume(annotation_version)
+    return _ccf_annotation_volumes[annotation_version]
@@ -8,7 +8,7 @@ import logging
 import scipy.io as spio
 
 from pipeline import lab, experiment, ccf
-from pipeline import get_schema_name, create_schema_settings
+from pipeline import get_schema_name, create_schema_settings, ColumnarInsertBuffer
 from pipeline.ingest.utils.paths import get_sess_dir, gen_probe_insert, match_probe_to_ephys
 from pipeline.ingest.utils.spike_sorter_loader import cluster_loader_map
 
@@ -140,6 +140,56 @@ class ProbeInsertionQuality(dj.Manual):
         """
 
 
+class SiteElectrodeMap:
+    """
+    Mapping of the recorded sites of a neuropixels recording (ordered as in the SpikeGLX shankmap)
+     to the electrodes of the electrode config, built from a single fetch of the electrode table
+     into a dense (shank, shank_col, shank_row) -> electrode lookup array
+    Recorded sites are 1-indexed, as in the spike sorting results (e.g. "spike_sites", "vmax_unit_site")
+    """
+
+    def __init__(self, electrode_config_key, shankmap):
+        q_electrodes = lab.ProbeType.Electrode * lab.ElectrodeConfig.Electrode & electrode_config_key
+        electrode_keys, shanks, shank_cols, shank_rows = q_electrodes.fetch(
+            'KEY', 'shank', 'shank_col', 'shank_row')
+
+        lookup = np.full((shanks.max() + 1, shank_cols.max() + 1, shank_rows.max() + 1), -1)
+        lookup[shanks, shank_cols, shank_rows] = np.arange(len(electrode_keys))
+
+        # shankmap is 0-indexed, this pipeline is 1-indexed
+        site_shanks, site_cols, site_rows = (np.array(shankmap['data'])[:, :3] + 1).T
+        in_range = ((site_shanks < lookup.shape[0])
+                    & (site_cols < lookup.shape[1])
+                    & (site_rows < lookup.shape[2]))
+        site_ind = np.full(len(site_shanks), -1)
+        site_ind[in_range] = lookup[site_shanks[in_range], site_cols[in_range], site_rows[in_range]]
+        if (site_ind < 0).any():
+            raise ValueError('Recorded site(s) not found in electrode config {}: {}'.format(
+                electrode_config_key, np.where(site_ind < 0)[0] + 1))
+
+        self.electrode_keys = [electrode_keys[i] for i in site_ind]
+        self.electrodes = np.array([k['electrode'] for k in self.electrode_keys])
+
+    def __getitem__(self, site):
+        """ electrode key of a (1-indexed) recorded site """
+        return self.electrode_keys[self._site_index(site)]
+
+    def __len__(self):
+        return len(self.electrode_keys)
+
+    def map_sites(self, sites):
+        """ vectorized mapping of (1-indexed) recorded sites to electrodes """
+        return self.electrodes[self._site_index(np.asarray(sites, dtype=int))]
+
+    def _site_index(self, sites):
+        """ 0-indexed position of (1-indexed) recorded sites - raise IndexError on sites out of [1, len] """
+        invalid = (np.asarray(sites) < 1) | (np.asarray(sites) > len(self))
+        if np.any(invalid):
+            raise IndexError('Recorded site(s) out of range [1, {}]: {}'.format(
+                len(self), np.unique(np.asarray(sites)[invalid])))
+        return sites - 1
+
+
 # ---- LFP ----
 
 
@@ -161,6 +211,8 @@ class LFP(dj.Imported):
         lfp: longblob           # recorded lfp at this electrode
         """
 
+    default_memory_budget = 2 * 1024 ** 3
+
     def make(self, key):
         from .ingest.utils.spike_sorter_loader import SpikeGLX
 
@@ -184,35 +236,64 @@ class LFP(dj.Imported):
         f, cluster_method, npx_meta = clustering_files[probe_no]
         spikeglx_recording = SpikeGLX(pathlib.Path(npx_meta.fname).parent)
 
-        electrode_keys, lfp = [], []
-
         lfp_channel_ind = spikeglx_recording.lfmeta.recording_channels
-
-        # Extract LFP data at specified channels and convert to uV
-        lfp = spikeglx_recording.lf_timeseries[:, lfp_channel_ind]  # (sample x channel)
-        lfp = (lfp * spikeglx_recording.get_channel_bit_volts('lf')[lfp_channel_ind]).T  # (channel x sample)
+        n_channels = len(lfp_channel_ind)
+        n_samples = spikeglx_recording.lf_timeseries.shape[0]
+
+        # optional downsampling to dj.config['custom']['ephys.lfp_sample_rate'] (Hz)
+        fs = spikeglx_recording.lfmeta.meta['imSampRate']
+        target_fs = dj.config['custom'].get('ephys.lfp_sample_rate')
+        decimation = max(int(fs // target_fs), 1) if target_fs else 1
+        lfp_sample_rate = fs / decimation
+        n_out = -(-n_samples // decimation)
+
+        # bound the memory footprint to dj.config['custom']['ephys.lfp_memory_budget'] (bytes):
+        #   full-length traces are held for a block of channels at a time (at least one channel),
+        #   the recording is read in time chunks across the channels of a block
+        memory_budget = dj.config['custom'].get('ephys.lfp_memory_budget', self.default_memory_budget)
+        block_size = int(np.clip(memory_budget // (2 * 8 * n_out), 1, n_channels))
+        chunk_samples = max(memory_budget // (2 * 8 * 8 * n_channels), decimation)
+
+        def stream_lfp(channel_ind):
+            """ (channel x sample) LFP in uV at the `channel_ind` channels """
+            lfp = np.empty((len(channel_ind), n_out))
+            i = 0
+            for chunk in spikeglx_recording.stream_lf_timeseries(
+                    channel_ind, chunk_samples, decimation=decimation):
+                lfp[:, i:i + len(chunk)] = chunk.T
+                i += len(chunk)
+            return lfp
+
+        lfp = None
+        if block_size == n_channels:
+            lfp = stream_lfp(lfp_channel_ind)
+            lfp_mean = lfp.mean(axis=0)
+        else:
+            # first pass for the mean across channels, channel blocks are read again below
+            lfp_mean, i = np.empty(n_out), 0
+            for chunk in spikeglx_recording.stream_lf_timeseries(
+                    lfp_channel_ind, chunk_samples, decimation=decimation):
+                lfp_mean[i:i + len(chunk)] = chunk.mean(axis=1)
+                i += len(chunk)
 
         self.insert1(dict(key,
-                          lfp_sample_rate=spikeglx_recording.lfmeta.meta['imSampRate'],
-                          lfp_time_stamps=(np.arange(lfp.shape[1])
-                                           / spikeglx_recording.lfmeta.meta['imSampRate']),
-                          lfp_mean=lfp.mean(axis=0)))
-
-        electrode_query = (lab.ProbeType.Electrode
-                           * lab.ElectrodeConfig.Electrode
-                           * ProbeInsertion & key)
-        probe_electrodes = {
-            (shank, shank_col, shank_row): key
-            for key, shank, shank_col, shank_row in zip(*electrode_query.fetch(
-                'KEY', 'shank', 'shank_col', 'shank_row'))}
-
-        for recorded_site in lfp_channel_ind:
-            shank, shank_col, shank_row, _ = spikeglx_recording.apmeta.shankmap['data'][recorded_site]
-            electrode_keys.append(probe_electrodes[(shank, shank_col, shank_row)])
-
-        # single insert in loop to mitigate potential memory issue
-        for electrode_key, lfp_trace in zip(electrode_keys, lfp):
-            self.Channel.insert1({**key, **electrode_key, 'lfp': lfp_trace})
+                          lfp_sample_rate=lfp_sample_rate,
+                          lfp_time_stamps=np.arange(n_out) / lfp_sample_rate,
+                          lfp_mean=lfp_mean))
+
+        e_config_key = (lab.ElectrodeConfig & (ProbeInsertion & key)).fetch1('KEY')
+        site2electrode_map = SiteElectrodeMap(e_config_key, spikeglx_recording.apmeta.shankmap)
+        electrode_keys = [site2electrode_map[recorded_site + 1] for recorded_site in lfp_channel_ind]
+
+        # bulk insert of the channel traces, one block of channels at a time
+        with ColumnarInsertBuffer(self.Channel) as ib:
+            for start in range(0, n_channels, block_size):
+                block_ind = lfp_channel_ind[start:start + block_size]
+                block = lfp if lfp is not None else stream_lfp(block_ind)
+                block_keys = electrode_keys[start:start + block_size]
+                ib.insert({k: [e[k] for e in block_keys] for k in block_keys[0] if k not in key},
+                          key=key, ragged={'lfp': (block.ravel(), np.arange(len(block) + 1) * n_out)})
+                ib.flush()
 
 
 # ---- Clusters/Units/Spiketimes ----
@@ -1,11 +1,17 @@
+import datetime
+import functools
+import logging
+
 import datajoint as dj
-from pipeline import experiment, get_schema_name, create_schema_settings
+from pipeline import experiment, get_schema_name, create_schema_settings, ColumnarInsertBuffer, populate_batched
 
 import numpy as np
 import pandas as pd
 import math
 
 
+log = logging.getLogger(__name__)
+
 schema = dj.schema(get_schema_name('foraging_analysis'), **create_schema_settings)
 
 dj.config["enable_python_native_blobs"] = True
@@ -44,6 +50,58 @@ class TrialStats(dj.Computed):
         
         self.insert1({**key, **trial_stats})
 
+    @classmethod
+    def populate_by_session(cls, *restrictions, reserve_jobs=False, display_progress=False,
+                            suppress_errors=False):
+        """
+        Session-level batched alternative to TrialStats.populate() - same results, computed with
+         one fetch of the go cues and licks per session and a bulk insert (see TrialStats.make_session)
+        Jobs are reserved per session (in the foraging_analysis schema's jobs table) -
+         not exclusive of a concurrent `populate()` (see `populate_batched`)
+        """
+        return populate_batched(cls, experiment.Session, cls.make_session, restrictions, schema,
+                                reserve_jobs=reserve_jobs, display_progress=display_progress,
+                                suppress_errors=suppress_errors)
+
+    @classmethod
+    def make_session(cls, session_key, *restrictions):
+        """
+        Compute TrialStats for all the trials to be populated in a session:
+            + fetch the go cue times and the licks of all trials of the session once
+            + compute the reaction time and double dipping of every trial at once (see `compute_trial_stats`)
+            + insert all trials in bulk
+        Trials without exactly one go cue are skipped (as `make` fails on them)
+        """
+        trials = ((cls().key_source - cls) & session_key & dj.AndList(restrictions)).fetch('trial', order_by='trial')
+        if not len(trials):
+            return
+
+        go_trials, go_times = (experiment.TrialEvent & session_key & 'trial_event_type = "go"').fetch(
+            'trial', 'trial_event_time', order_by='trial')
+        lick_trials, lick_types, lick_times = (experiment.ActionEvent & session_key
+                                               & 'action_event_type LIKE "%lick"').fetch(
+            'trial', 'action_event_type', 'action_event_time', order_by='trial')
+
+        go_trial_ids, go_counts = np.unique(go_trials, return_counts=True)
+        single_go_trials = go_trial_ids[go_counts == 1]
+        skipped = np.setdiff1d(trials, single_go_trials)
+        if len(skipped):
+            log.warning('TrialStats: {} - skipped trials without exactly one go cue: {}'.format(
+                session_key, skipped.tolist()))
+            trials = np.intersect1d(trials, single_go_trials)
+            if not len(trials):
+                return
+
+        go_times = np.asarray(go_times, dtype=float)[np.isin(go_trials, trials)]
+        reaction_time, double_dipping = compute_trial_stats(trials, go_times, lick_trials, lick_types,
+                                                            np.asarray(lick_times, dtype=float))
+
+        with ColumnarInsertBuffer(cls) as ib:
+            ib.insert({'trial': trials,
+                       'reaction_time': reaction_time,   # nan (no lick after the go cue) as NULL
+                       'double_dipping': double_dipping.astype(int)},
+                      key={k: session_key[k] for k in ('subject_id', 'session')})
+
         
 @schema # TODO remove bias check?
 class BlockStats(dj.Computed):
@@ -56,16 +114,48 @@ class BlockStats(dj.Computed):
     """
 
     def make(self, key):
-        
-        q_block_trials = experiment.BehaviorTrial * experiment.SessionBlock.BlockTrial & key
-
-        block_stats = {'block_trial_num': len((experiment.SessionBlock.BlockTrial & key)),
-                       'block_ignore_num': len(q_block_trials & 'outcome = "ignore"')}
-        try:
-            block_stats['block_reward_rate'] = len(q_block_trials & 'outcome = "hit"') / len(q_block_trials & 'outcome in ("hit", "miss")')
-        except:
-            pass
-        self.insert1({**key, **block_stats})
+        trial_num = len(experiment.SessionBlock.BlockTrial & key)
+        outcomes = (experiment.BehaviorTrial * experiment.SessionBlock.BlockTrial & key).fetch('outcome')
+        self.insert1({**key, **compute_block_stats([trial_num], np.zeros(len(outcomes), dtype=int), outcomes)[0]})
+
+    @classmethod
+    def populate_by_session(cls, *restrictions, reserve_jobs=False, display_progress=False,
+                            suppress_errors=False):
+        """
+        Session-level batched alternative to BlockStats.populate() - same results, computed with
+         one fetch of the block trials and their outcomes per session and a bulk insert
+        Jobs are reserved per session (in the foraging_analysis schema's jobs table) -
+         not exclusive of a concurrent `populate()` (see `populate_batched`)
+        """
+        return populate_batched(cls, experiment.Session, cls.make_session, restrictions, schema,
+                                reserve_jobs=reserve_jobs, display_progress=display_progress,
+                                suppress_errors=suppress_errors)
+
+    @classmethod
+    def make_session(cls, session_key, *restrictions):
+        """
+        Compute BlockStats for all the blocks to be populated in a session
+        """
+        blocks = ((cls().key_source - cls) & session_key & dj.AndList(restrictions)).fetch('block', order_by='block')
+        if not len(blocks):
+            return
+
+        # trials of the blocks (as BlockStats.make: with or without a BehaviorTrial), and outcomes of those with one
+        trial_blocks = (experiment.SessionBlock.BlockTrial & session_key).fetch('block')
+        trial_blocks = trial_blocks[np.isin(trial_blocks, blocks)]
+        trial_num = np.bincount(np.searchsorted(blocks, trial_blocks), minlength=len(blocks))
+
+        outcome_blocks, outcomes = (experiment.BehaviorTrial * experiment.SessionBlock.BlockTrial
+                                    & session_key).fetch('block', 'outcome')
+        in_blocks = np.isin(outcome_blocks, blocks)
+        block_stats = compute_block_stats(trial_num, np.searchsorted(blocks, outcome_blocks[in_blocks]),
+                                          outcomes[in_blocks])
+
+        with ColumnarInsertBuffer(cls) as ib:
+            ib.insert({'block': blocks,
+                       **{k: [bs[k] for bs in block_stats] for k in
+                          ('block_trial_num', 'block_ignore_num', 'block_reward_rate')}},
+                      key={k: session_key[k] for k in ('subject_id', 'session')})
  
     
 @schema #remove bias check trials from statistics # 03/25/20 NW added nobiascheck terms for hit, miss and ignore trial num
@@ -98,81 +188,73 @@ class SessionStats(dj.Computed):
     key_source = experiment.Session & (experiment.BehaviorTrial & 'task LIKE "foraging%"')
 
     def make(self, key):
-        # import pdb; pdb.set_trace()
-        q_all_trial = experiment.SessionTrial & key
-        q_block = experiment.SessionBlock & key
-        q_hit = experiment.BehaviorTrial & key & 'outcome = "hit"'
-        q_miss = experiment.BehaviorTrial & key & 'outcome = "miss"'
-        q_auto_water = experiment.TrialNote & key & 'trial_note_type = "autowater"'
-        q_actual_finished = q_hit.proj() + q_miss.proj()  - q_auto_water.proj()   # Real finished trial = 'hit' or 'miss' but not 'autowater'
-        
-        session_stats = {'session_total_trial_num': len(q_all_trial),
-                'session_block_num': len(q_block),
-                'session_hit_num': len(q_hit),
-                'session_miss_num': len(q_miss),
-                'session_ignore_num': len(experiment.BehaviorTrial & key & 'outcome = "ignore"'),
-                'session_early_lick_ratio': len(experiment.BehaviorTrial & key & 'early_lick="early"') / (len(q_hit) + len(q_miss)),
-                'session_autowater_num': len(q_auto_water),
-                'session_pure_choices_num': len(q_actual_finished)}
-        
+        # Fetch the trial-level data of the session once, then count with numpy
+        all_trials, stop_times = (experiment.SessionTrial & key).fetch('trial', 'stop_time')
+        trials, tasks, outcomes, early_licks = (experiment.BehaviorTrial & key).fetch(
+            'trial', 'task', 'outcome', 'early_lick', order_by='trial')
+        note_trials, note_types, notes = (experiment.TrialNote & key
+                                          & 'trial_note_type in ("autowater", "random_seed_start")').fetch(
+            'trial', 'trial_note_type', 'trial_note', order_by='trial')
+        double_dipping_trials = (TrialStats & key & 'double_dipping = 1').fetch('trial')
+
+        hit_trials, miss_trials = trials[outcomes == 'hit'], trials[outcomes == 'miss']
+        auto_water_trials = note_trials[note_types == 'autowater']
+        actual_finished_trials = np.setdiff1d(np.union1d(hit_trials, miss_trials), auto_water_trials)   # Real finished trial = 'hit' or 'miss' but not 'autowater'
+
+        session_stats = {'session_total_trial_num': len(all_trials),
+                'session_block_num': len(experiment.SessionBlock & key),
+                'session_hit_num': len(hit_trials),
+                'session_miss_num': len(miss_trials),
+                'session_ignore_num': int(np.sum(outcomes == 'ignore')),
+                'session_early_lick_ratio': int(np.sum(early_licks == 'early')) / (len(hit_trials) + len(miss_trials)),
+                'session_autowater_num': len(auto_water_trials),
+                'session_pure_choices_num': len(actual_finished_trials)}
+
         if session_stats['session_total_trial_num'] > 0:
-            session_stats['session_length'] = float(((experiment.SessionTrial() & key).fetch('stop_time')).max())
+            session_stats['session_length'] = float(stop_times.max())
         else:
             session_stats['session_length'] = 0
-            
+
         # -- Double dipping ratio --
-        q_double_dipping = TrialStats & key & 'double_dipping = 1'
-        session_stats.update(session_double_dipping_ratio_hit = len(q_double_dipping & q_hit) / len(q_hit))        
-        
-        # Double dipping in missed trial is detected only for sessions later than the first day of using new lickport retraction logic 
-        if (experiment.Session & key & 'session_date > "2020-08-11"'):   
-            session_stats.update(session_double_dipping_ratio_miss = len(q_double_dipping & q_miss) / len(q_miss),
-                                 session_double_dipping_ratio = len(q_double_dipping & q_actual_finished) / len(q_actual_finished))
-            
+        def double_dipping_num(trials):
+            return int(np.sum(np.isin(trials, double_dipping_trials)))
+
+        session_stats.update(session_double_dipping_ratio_hit = double_dipping_num(hit_trials) / len(hit_trials))
+
+        # Double dipping in missed trial is detected only for sessions later than the first day of using new lickport retraction logic
+        if (experiment.Session & key).fetch1('session_date') > datetime.date(2020, 8, 11):
+            session_stats.update(session_double_dipping_ratio_miss = double_dipping_num(miss_trials) / len(miss_trials),
+                                 session_double_dipping_ratio = double_dipping_num(actual_finished_trials) / len(actual_finished_trials))
+
         # -- Session-wise foraging efficiency and schedule stats (2lp only) --
-        if len(experiment.BehaviorTrial & key & 'task="foraging"'):
+        if np.any(tasks == 'foraging'):
             # Get reward rate (hit but not autowater) / (hit but not autowater + miss but not autowater)
-            q_pure_hit_num = q_hit.proj() - q_auto_water.proj()
-            reward_rate = len(q_pure_hit_num) / len(q_actual_finished)
-            
-            q_actual_finished_reward_prob = (experiment.SessionTrial * experiment.SessionBlock.BlockTrial  # Session-block-trial
-                                           * experiment.SessionBlock.WaterPortRewardProbability  # Block-trial-p_reward
-                                           & q_actual_finished)  # Select finished trials
-                                
+            reward_rate = len(np.setdiff1d(hit_trials, auto_water_trials)) / len(actual_finished_trials)
+
             # Get reward probability (only pure finished trials)
-            p_Ls = (q_actual_finished_reward_prob & 'water_port="left"').fetch(
-                'reward_probability', order_by='trial').astype(float)  # Note 'order_by'!!!
-            p_Rs = (q_actual_finished_reward_prob & 'water_port="right"').fetch(
-                'reward_probability', order_by='trial').astype(float)
-            
+            prob_trials, water_ports, reward_probs = (experiment.SessionBlock.BlockTrial  # Block-trial
+                                                      * experiment.SessionBlock.WaterPortRewardProbability  # Block-trial-p_reward
+                                                      & key).fetch('trial', 'water_port', 'reward_probability',
+                                                                   order_by='trial')  # Note 'order_by'!!!
+            is_finished = np.isin(prob_trials, actual_finished_trials)  # Select finished trials
+            p_Ls = reward_probs[is_finished & (water_ports == 'left')].astype(float)
+            p_Rs = reward_probs[is_finished & (water_ports == 'right')].astype(float)
+
             # Recover actual random numbers
-            random_number_Ls = np.empty(len(q_all_trial))
-            random_number_Ls[:] = np.nan
-            random_number_Rs = random_number_Ls.copy()
-            
-            rand_seed_starts = (experiment.TrialNote()  & key & 'trial_note_type="random_seed_start"').fetch('trial', 'trial_note', order_by='trial')
-            
-            if len(rand_seed_starts[0]):  # Random seed exists
-                for start_idx, start_seed in zip(rand_seed_starts[0], rand_seed_starts[1]):  # For each pybpod session
-                    # Must be exactly the same as the pybpod protocol 
-                    # https://github.com/hanhou/Foraging-Pybpod/blob/5e19e1d227657ed19e27c6e1221495e9f180c323/pybpod_protocols/Foraging_baptize_by_fire_new_lickport_retraction.py#L478
-                    np.random.seed(int(start_seed))
-                    random_number_L_this = np.random.uniform(0.,1.,2000).tolist()
-                    random_number_R_this = np.random.uniform(0.,1.,2000).tolist()
-                    
-                    # Fill in random numbers
-                    random_number_Ls[start_idx - 1 :] = random_number_L_this[: len(random_number_Ls) - start_idx + 1]
-                    random_number_Rs[start_idx - 1 :] = random_number_R_this[: len(random_number_Rs) - start_idx + 1]
-                    
+            is_seed_start = note_types == 'random_seed_start'
+            if np.any(is_seed_start):  # Random seed exists
+                random_number_Ls, random_number_Rs = session_random_numbers(
+                    len(all_trials), note_trials[is_seed_start], notes[is_seed_start])
+
                 # Select finished trials
-                actual_finished_idx = q_actual_finished.fetch('trial', order_by='trial')-1
+                actual_finished_idx = actual_finished_trials - 1
                 random_number_Ls = random_number_Ls[actual_finished_idx]
                 random_number_Rs = random_number_Rs[actual_finished_idx]
             else:  # No random seed (backward compatibility)
                 print(f'No random seeds for {key}')
                 random_number_Ls = None
                 random_number_Rs = None
-                
+
             # Compute foraging efficiency
             for_eff_optimal, for_eff_optimal_random_seed = foraging_eff(reward_rate, p_Ls, p_Rs, random_number_Ls, random_number_Rs)
 
@@ -434,6 +516,97 @@ class BlockEfficiency(dj.Computed):  # bias check excluded
 
 # ====================== HELPER FUNCTIONS ==========================     
    
+def compute_trial_stats(trials, go_times, lick_trials, lick_types, lick_times):
+    """
+    Reaction time and double dipping of trials, from their go cue and licks (as TrialStats.make):
+        + reaction time: first lick after the go cue, relative to the go cue (nan if no lick after the go cue)
+        + double dipping: licks of more than one type (e.g. left and right) after the go cue
+    Times are compared and subtracted on the 0.1 ms grid of their decimal(8,4) definition
+    :param trials: sorted trial numbers, (n_trials,), and go_times: their go cue time
+    :param lick_trials, lick_types, lick_times: trial, action_event_type and time of the licks (any trials)
+    :return: reaction_time (n_trials,), double_dipping (n_trials,) bool
+    """
+    trials = np.asarray(trials)
+    go_ticks = np.round(np.asarray(go_times, dtype=float) * 1e4).astype(np.int64)
+    lick_trials = np.asarray(lick_trials)
+    lick_ticks = np.round(np.asarray(lick_times, dtype=float) * 1e4).astype(np.int64)
+
+    # licks after the go cue of the selected trials
+    trial_idx = np.searchsorted(trials, lick_trials)
+    in_trials = trial_idx < len(trials)
+    in_trials[in_trials] = trials[trial_idx[in_trials]] == lick_trials[in_trials]
+    after_go = np.zeros(len(lick_trials), dtype=bool)
+    after_go[in_trials] = lick_ticks[in_trials] > go_ticks[trial_idx[in_trials]]
+    trial_idx, lick_ticks = trial_idx[after_go], lick_ticks[after_go]
+
+    first_lick = np.full(len(trials), np.iinfo(np.int64).max)
+    np.minimum.at(first_lick, trial_idx, lick_ticks)
+    has_lick = first_lick != np.iinfo(np.int64).max
+    reaction_time = np.full(len(trials), np.nan)
+    reaction_time[has_lick] = (first_lick[has_lick] - go_ticks[has_lick]) / 1e4
+
+    # number of distinct lick types after the go cue
+    _, lick_type_idx = np.unique(np.asarray(lick_types)[after_go], return_inverse=True)
+    trial_lick_types = np.unique(trial_idx * (lick_type_idx.max(initial=0) + 1) + lick_type_idx)
+    n_lick_types = np.bincount(trial_lick_types // (lick_type_idx.max(initial=0) + 1), minlength=len(trials))
+    double_dipping = n_lick_types > 1
+
+    return reaction_time, double_dipping
+
+
+def compute_block_stats(trial_num, block_idx, outcomes):
+    """
+    BlockStats of blocks, from their number of trials and the outcome of their behavior trials (as BlockStats.make)
+    :param trial_num: number of trials (SessionBlock.BlockTrial) of each block, (n_blocks,)
+    :param block_idx: index of the block of each behavior trial, in [0, n_blocks), and outcomes: outcome of each trial
+    :return: list of n_blocks dicts of block_trial_num, block_ignore_num and block_reward_rate (None if no hit nor miss)
+    """
+    trial_num, n_blocks = np.asarray(trial_num, dtype=int), len(trial_num)
+    block_idx, outcomes = np.asarray(block_idx, dtype=int), np.asarray(outcomes)
+    ignore_num = np.bincount(block_idx[outcomes == 'ignore'], minlength=n_blocks)
+    hit_num = np.bincount(block_idx[outcomes == 'hit'], minlength=n_blocks)
+    miss_num = np.bincount(block_idx[outcomes == 'miss'], minlength=n_blocks)
+
+    return [{'block_trial_num': int(trial_num[b]),
+             'block_ignore_num': int(ignore_num[b]),
+             'block_reward_rate': int(hit_num[b]) / int(hit_num[b] + miss_num[b]) if hit_num[b] + miss_num[b] else None}
+            for b in range(n_blocks)]
+
+
+@functools.lru_cache(maxsize=128)
+def pybpod_random_numbers(seed, n_trials=2000):
+    """
+    Random numbers of the reward refills (L, R) drawn by the pybpod protocol from `seed` - read-only, cached per seed
+    Must be exactly the same as the pybpod protocol
+    https://github.com/hanhou/Foraging-Pybpod/blob/5e19e1d227657ed19e27c6e1221495e9f180c323/pybpod_protocols/Foraging_baptize_by_fire_new_lickport_retraction.py#L478
+    (np.random.seed + np.random.uniform, i.e. the legacy RandomState - without re-seeding the global state here)
+    """
+    rng = np.random.RandomState(seed)
+    random_numbers = rng.uniform(0., 1., n_trials), rng.uniform(0., 1., n_trials)
+    for random_number in random_numbers:
+        random_number.flags.writeable = False
+    return random_numbers
+
+
+def session_random_numbers(n_trials, seed_start_trials, seeds):
+    """
+    Random numbers (L, R) of all the trials of a session, nan before the first random seed
+    :param n_trials: number of trials of the session
+    :param seed_start_trials, seeds: first trial and random seed of each pybpod session, ordered by trial
+    """
+    random_number_Ls = np.full(n_trials, np.nan)
+    random_number_Rs = random_number_Ls.copy()
+
+    for start_idx, start_seed in zip(seed_start_trials, seeds):  # For each pybpod session
+        random_number_L_this, random_number_R_this = pybpod_random_numbers(int(start_seed))
+
+        # Fill in random numbers
+        random_number_Ls[start_idx - 1:] = random_number_L_this[: n_trials - start_idx + 1]
+        random_number_Rs[start_idx - 1:] = random_number_R_this[: n_trials - start_idx + 1]
+
+    return random_number_Ls, random_number_Rs
+
+
 def draw_bs_pairs_linreg(x, y, size=1): 
     """Perform pairs bootstrap for linear regression."""#from serhan aya
     # Get rid of infs/nans
@@ -463,15 +636,18 @@ def draw_bs_pairs_linreg(x, y, size=1):
 def foraging_eff(reward_rate, p_Ls, p_Rs, random_number_L=None, random_number_R=None):  # Calculate foraging efficiency (only for 2lp)
         
     # --- Optimal-aver (use optimal expectation as 100% efficiency) ---
-    p_stars = np.zeros_like(p_Ls)
-    for i, (p_L, p_R) in enumerate(zip(p_Ls, p_Rs)):   # Sum over all ps 
+    # Once per distinct (p_L, p_R), i.e. per block rather than per trial
+    p_pairs, pair_idx = np.unique(np.column_stack([p_Ls, p_Rs]), axis=0, return_inverse=True)
+    p_stars_pairs = np.zeros(len(p_pairs))
+    for i, (p_L, p_R) in enumerate(p_pairs):   # Sum over all ps
         p_max = np.max([p_L, p_R])
         p_min = np.min([p_L, p_R])
         if p_min == 0 or p_max >= 1:
-            p_stars[i] = p_max
+            p_stars_pairs[i] = p_max
         else:
             m_star = np.floor(np.log(1-p_max)/np.log(1-p_min))
-            p_stars[i] = p_max + (1-(1-p_min)**(m_star + 1)-p_max**2)/(m_star+1)
+            p_stars_pairs[i] = p_max + (1-(1-p_min)**(m_star + 1)-p_max**2)/(m_star+1)
+    p_stars = p_stars_pairs[pair_idx.ravel()]
 
     for_eff_optimal = reward_rate / np.nanmean(p_stars)
     
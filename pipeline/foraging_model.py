@@ -1,8 +1,21 @@
+import logging
+import multiprocessing as mp
+from collections import defaultdict, OrderedDict
+
 import datajoint as dj
+from datajoint.hash import key_hash
 import numpy as np
+import pandas as pd
 from . import experiment, ephys, foraging_analysis
 from . import get_schema_name, create_schema_settings
 from .model.bandit_model_comparison import BanditModelComparison
+from .model.fitting_tasks import (FitCheckpoint, make_fit_tasks, run_dependent_fit_tasks, task_label,
+                                  warm_start_dependencies)
+from .model.models import MODELS
+
+log = logging.getLogger(__name__)
+
+_session_history_cache = OrderedDict()  # (subject_id, session) -> see get_cached_session_history
 
 schema = dj.schema(get_schema_name('foraging_model'), **create_schema_settings)
 
@@ -83,96 +96,6 @@ class Model(dj.Manual):
 
     @classmethod
     def load_models(cls):
-        # Original definition from the Dynamic-Foraging repo, using the format: [forager, [para_names], [lower bounds], [higher bounds], desc(optional)]
-        MODELS = [
-            # No bias
-            ['LossCounting', ['loss_count_threshold_mean', 'loss_count_threshold_std'],
-             [0, 0], [40, 10], 'LossCounting: mean, std, no bias'],
-
-            ['RW1972_epsi', ['learn_rate', 'epsilon'],
-             [0, 0], [1, 1], 'SuttonBarto: epsilon, no bias'],
-
-            ['RW1972_softmax', ['learn_rate', 'softmax_temperature'],
-             [0, 1e-2], [1, 15], 'SuttonBarto: softmax, no bias'],
-
-            ['LNP_softmax', ['tau1', 'softmax_temperature'],
-             [1e-3, 1e-2], [100, 15], 'Sugrue2004, Corrado2005: one tau, no bias'],
-
-            ['LNP_softmax', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature'],
-             [1e-3, 1e-1, 0, 1e-2], [15, 40, 1, 15], 'Corrado2005, Iigaya2019: two taus, no bias'],
-
-            ['Bari2019', ['learn_rate', 'forget_rate', 'softmax_temperature'],
-             [0, 0, 1e-2], [1, 1, 15], 'RL: chosen, unchosen, softmax, no bias'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature'],
-             [0, 0, 1e-2], [1, 1, 15], 'RL: rew, unrew, softmax, no bias'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature'],
-             [0, 0, 0, 1e-2], [1, 1, 1, 15], 'RL: rew, unrew, unchosen, softmax, no bias'],
-
-            # With bias
-            ['RW1972_epsi', ['learn_rate', 'epsilon', 'biasL'],
-             [0, 0, -0.5], [1, 1, 0.5], 'SuttonBarto: epsilon'],
-
-            ['RW1972_softmax', ['learn_rate', 'softmax_temperature', 'biasL'],
-             [0, 1e-2, -5], [1, 15, 5], 'SuttonBarto: softmax'],
-
-            ['LNP_softmax', ['tau1', 'softmax_temperature', 'biasL'],
-             [1e-3, 1e-2, -5], [100, 15, 5], 'Sugrue2004, Corrado2005: one tau'],
-
-            ['LNP_softmax', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature', 'biasL'],
-             [1e-3, 1e-1, 0, 1e-2, -5], [15, 40, 1, 15, 5], 'Corrado2005, Iigaya2019: two taus'],
-
-            ['Bari2019', ['learn_rate', 'forget_rate', 'softmax_temperature', 'biasL'],
-             [0, 0, 1e-2, -5], [1, 1, 15, 5], 'RL: chosen, unchosen, softmax'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature', 'biasL'],
-             [0, 0, 1e-2, -5], [1, 1, 15, 5], 'RL: rew, unrew, softmax'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, 1e-2, -5], [1, 1, 1, 15, 5], '(full Hattori) RL: rew, unrew, unchosen, softmax'],
-
-            # With bias and choice kernel 
-            ['RW1972_softmax_CK', ['learn_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 1e-2, -5, 0, 1e-2], [1, 15, 5, 1, 20], 'SuttonBarto: softmax, choice kernel'],
-
-            ['LNP_softmax_CK', ['tau1', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [1e-3, 1e-2, -5, 0, 1e-2], [100, 15, 5, 1, 20], 'Sugrue2004, Corrado2005: one tau, choice kernel'],
-
-            ['LNP_softmax_CK', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [1e-3, 1e-1, 0, 1e-2, -5, 0, 1e-2], [15, 40, 1, 15, 5, 1, 20], 'Corrado2005, Iigaya2019: two taus, choice kernel'],
-
-            ['Bari2019_CK', ['learn_rate', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 15, 5, 1, 20], 'RL: chosen, unchosen, softmax, choice kernel'],
-
-            ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 15, 5, 1, 20], 'RL: rew, unrew, softmax, choice kernel'],
-
-            ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 1, 15, 5, 1, 20], 'Hattori + choice kernel'],
-
-            ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 0, 1e-2, -5, 1, 1e-2], [1, 1, 1, 15, 5, 1, 20], 'choice_step_size fixed at 1 --> Bari 2019: only the last choice matters'],
-
-            ['CANN', ['learn_rate', 'tau_cann', 'softmax_temperature', 'biasL'],
-             [0, 0, 1e-2, -5], [1, 1000, 15, 5], "Ulises' CANN model, ITI decay, with bias"],
-            
-            ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, 0, 1e-2, -5], [1, 1, 10, 1, 15, 5], "Ulises' synaptic model"],
-            
-            ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, -100, 1e-2, -5], [1, 1, 10, 100, 15, 5], "Ulises' synaptic model (unconstrained \\rho)"],
-            
-            ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, -1e6, 1e-2, -5], [1, 1, 1e6, 1e6, 15, 5], "Ulises' synaptic model (really unconstrained I_0 and \\rho)"],
-            
-            # ['Synaptic_W>0', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-            #  [0, 0, 0, -100, 1e-2, -5], [1, 1, 10, 100, 15, 5], "Ulises' synaptic model (W > 0, partially constrained I_0 and \\rho)"],
-            
-            # ['Synaptic_W>0', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-            #  [0, 0, 0, -1e6, 1e-2, -5], [1, 1, 10, 1e6, 15, 5], "Ulises' synaptic model (W > 0, unconstrained I_0 and \\rho)"],
-        ]
-
         # Parse and insert MODELS
         for model_id, model in enumerate(MODELS):
             # Insert Model
@@ -304,23 +227,42 @@ class FittedSessionModel(dj.Computed):
         """
 
     def make(self, key):
-        choice_history, reward_history, iti, p_reward, q_choice_outcome = get_session_history(key)
+        choice_history, reward_history, iti, p_reward, trials = get_cached_session_history(key)
         model_str = (Model & key).fetch('fit_cmd')
 
+        # Optional warm start of DE from the fitted related models (dj.config['custom']['foraging_model.warm_start'])
+        fit_settings = {'DE_pop_size': 16}
+        if dj.config['custom'].get('foraging_model.warm_start', False):
+            fit_settings['DE_seeds'] = get_warm_start_seeds(key)
+
         # --- Actual fitting ---
         if (Model & key).fetch1('model_class') in ['CANN']:  # Only pass ITI if this is CANN model (to save some time?)
             model_comparison_this = BanditModelComparison(choice_history, reward_history, iti=iti, model=model_str)
         else:
             model_comparison_this = BanditModelComparison(choice_history, reward_history, iti=None, model=model_str)
-        model_comparison_this.fit(pool='', plot_predictive=None, if_verbose=False)  # Parallel on sessions, not on DE
-        model_comparison_this.cross_validate(pool='', k_fold=2, if_verbose=False)
+        model_comparison_this.fit(fit_settings=fit_settings, pool='', plot_predictive=None, if_verbose=False)  # Parallel on sessions, not on DE
+        model_comparison_this.cross_validate(fit_settings=fit_settings, pool='', k_fold=2, if_verbose=False)
 
         # ------ Grab results ----
         fit_result = model_comparison_this.results_raw[0]
         cross_valid_result = model_comparison_this.prediction_accuracy_CV.iloc[0]
 
+        self.insert_fitted_model(key, fit_result, cross_valid_result.prediction_accuracy_test,
+                                 cross_valid_result.prediction_accuracy_fit,
+                                 cross_valid_result.prediction_accuracy_test_bias_only,
+                                 trials)
+
+    @classmethod
+    def insert_fitted_model(cls, key, fit_result, prediction_accuracy_test, prediction_accuracy_fit,
+                            prediction_accuracy_test_bias_only, trials):
+        '''
+        Insert the fitting result of a session and a model, with its cross-validation accuracies (of each fold)
+        :param trials: the fitted trials, in order
+        '''
+        key = {k: key[k] for k in cls.primary_key}
+
         # Insert session fitted stats
-        self.insert1(dict(**key,
+        cls.insert1(dict(**key,
                           n_trials=fit_result.n_trials,
                           n_params=fit_result.k_model,
                           log_likelihood=fit_result.log_likelihood,
@@ -330,15 +272,17 @@ class FittedSessionModel(dj.Computed):
                           lpt_aic=fit_result.LPT_AIC,
                           lpt_bic=fit_result.LPT_BIC,
                           prediction_accuracy=fit_result.prediction_accuracy,
-                          cross_valid_accuracy_fit=np.mean(cross_valid_result.prediction_accuracy_fit),
-                          cross_valid_accuracy_test=np.mean(cross_valid_result.prediction_accuracy_test),
-                          cross_valid_accuracy_test_bias_only=np.mean(cross_valid_result.prediction_accuracy_test_bias_only),
-                          )
-                     )
+                          cross_valid_accuracy_fit=np.mean(prediction_accuracy_fit),
+                          cross_valid_accuracy_test=np.mean(prediction_accuracy_test),
+                          cross_valid_accuracy_test_bias_only=np.mean(prediction_accuracy_test_bias_only),
+                          ),
+                    allow_direct_insert=True
+                    )
 
         # Insert fitted params (`order_by` is critical!)
-        self.Param.insert([dict(**key, model_param=param, fitted_value=x) 
-	                         for param, x in zip((Model.Param & key).fetch('model_param', order_by='param_idx'), fit_result.x)])
+        cls.Param.insert([dict(**key, model_param=param, fitted_value=x) 
+	                         for param, x in zip((Model.Param & key).fetch('model_param', order_by='param_idx'), fit_result.x)],
+                         allow_direct_insert=True)
         
         # Insert latent variables (trial number offset -1 here!!)
         choice_prob = fit_result.predictive_choice_prob[:, 1:]  # Model must have this
@@ -348,12 +292,13 @@ class FittedSessionModel(dj.Computed):
         for water_port_idx, water_port in enumerate(['left', 'right']):
             key['water_port'] = water_port
 
-            self.TrialLatentVariable.insert(
+            cls.TrialLatentVariable.insert(
                 [{**key, 'trial': i, 'choice_prob': prob, 'action_value': value, 'choice_kernel': ck}
-                 for i, prob, value, ck in zip(q_choice_outcome.fetch('trial', order_by='trial'),
+                 for i, prob, value, ck in zip(trials,
                                                choice_prob[water_port_idx, :],
                                                action_value[water_port_idx, :],
-                                               choice_kernel[water_port_idx, :])]
+                                               choice_kernel[water_port_idx, :])],
+                allow_direct_insert=True
             )                
 
 @schema
@@ -483,3 +428,205 @@ def get_session_history(session_key, remove_ignored=True):
                           (q_p_reward & 'water_port="right"').fetch('reward_probability', order_by='trial').astype(float)])
 
     return choice_history, reward_history, iti, p_reward, q_choice_outcome
+
+
+def get_cached_session_history(session_key):
+    """
+    get_session_history (without the ignored trials), cached across the fits of all models of a session (in this process):
+    the dj.config['custom']['foraging_model.session_history_cache_size'] (default: 16) most recently used sessions are kept
+    :return: choice_history, reward_history, iti, p_reward, trials (the fitted trials, in order) - read-only arrays
+    """
+    cache_key = (session_key['subject_id'], session_key['session'])
+
+    if cache_key in _session_history_cache:
+        _session_history_cache.move_to_end(cache_key)
+        return _session_history_cache[cache_key]
+
+    choice_history, reward_history, iti, p_reward, q_choice_outcome = get_session_history(
+        {'subject_id': cache_key[0], 'session': cache_key[1]})
+    history = (choice_history, reward_history, iti, p_reward, q_choice_outcome.fetch('trial', order_by='trial'))
+    for x in history:
+        x.setflags(write=False)
+
+    _session_history_cache[cache_key] = history
+    while len(_session_history_cache) > dj.config['custom'].get('foraging_model.session_history_cache_size', 16):
+        _session_history_cache.popitem(last=False)
+
+    return history
+
+
+def get_warm_start_seeds(key, fitted=None):
+    """
+    Warm start of the DE fit of a (session, model): the fitted params of
+        + the models of the same model class already fitted to the same session (e.g. their nested models)
+        + the same model fitted to the previous session of the same animal
+    from the models inserted and those fitted in the current run (see `populate_fitted_session_models`)
+    :param fitted: {(subject_id, session, model_id): {param name: value}} of the models fitted in the current run
+    :return: list of {param name: value} (see fitting_functions.DE_init_population)
+    """
+    model_class = (Model & key).fetch1('model_class')
+    q_related = (FittedSessionModel & {'subject_id': key['subject_id'], 'session': key['session']}
+                 & (Model & {'model_class': model_class}) & 'model_id != {}'.format(key['model_id']))
+    related_ids = set((Model & {'model_class': model_class}).fetch('model_id')) - {key['model_id']}
+
+    q_previous = (FittedSessionModel & {'subject_id': key['subject_id'], 'model_id': key['model_id']}
+                  & 'session < {}'.format(key['session']))
+    fitted = {(session, model_id): params for (subject_id, session, model_id), params in (fitted or {}).items()
+              if subject_id == key['subject_id']}
+    previous_session = max(list(q_previous.fetch('session', order_by='session desc', limit=1))
+                           + [session for session, model_id in fitted
+                              if model_id == key['model_id'] and session < key['session']], default=None)
+
+    seeds = defaultdict(dict)
+    for q in [q_related] + ([q_previous & {'session': previous_session}] if previous_session is not None else []):
+        for session, model_id, param, value in zip(*(FittedSessionModel.Param & q).fetch(
+                'session', 'model_id', 'model_param', 'fitted_value', order_by='session, model_id')):
+            seeds[(session, model_id)][param] = value
+
+    for (session, model_id), params in sorted(fitted.items()):
+        if ((session == key['session'] and model_id in related_ids)
+                or (session == previous_session and model_id == key['model_id'])):
+            seeds[(session, model_id)] = params
+
+    return list(seeds.values())
+
+
+def get_fit_workers(workers=None):
+    """
+    Number of processes for the parallel model fitting - `workers` if given,
+    else dj.config['custom']['foraging_model.fit_workers'] (default: all cores)
+    """
+    return int(workers or dj.config['custom'].get('foraging_model.fit_workers', mp.cpu_count()))
+
+
+def populate_fitted_session_models(restriction={}, workers=None, checkpoint_dir=None, k_fold=2, DE_pop_size=16,
+                                   warm_start=None, reserve_jobs=False, suppress_errors=False):
+    """
+    Parallel, resumable alternative to FittedSessionModel.populate():
+        + the fit and each cross-validation fold of all (session, model) to populate are separate tasks,
+          scheduled across a process pool
+        + each completed task is checkpointed in `checkpoint_dir`, such that an interrupted run resumes without refitting
+        + a (session, model) is inserted by this process as soon as all of its tasks are done
+    With warm start, the tasks of a (session, model) are only scheduled once the fits seeding it are done - its nested
+     models (same model class, lower model_id) on the same session, and the same model on the previous session
+     (see `fitting_tasks.warm_start_dependencies`) - such that the models fitted in the run seed each other
+    Jobs are reserved per (session, model) (in the foraging_model schema's jobs table) as they are planned;
+     the reservations of the (session, model) not inserted on exit (interrupted, or on an error) are released,
+     for a later run to resume them
+    :param workers: number of processes - default to dj.config['custom']['foraging_model.fit_workers']
+    :param checkpoint_dir: default to dj.config['custom']['foraging_model.checkpoint_dir'] (no checkpoint if not set)
+    :param warm_start: seed the DE fits with the related models already fitted (see `get_warm_start_seeds`) -
+                       default to dj.config['custom']['foraging_model.warm_start']
+    :return: wall time of each task (pandas DataFrame) - its sum per model is also logged
+    """
+    workers = get_fit_workers(workers)
+    if warm_start is None:
+        warm_start = dj.config['custom'].get('foraging_model.warm_start', False)
+    checkpoint_dir = checkpoint_dir or dj.config['custom'].get('foraging_model.checkpoint_dir')
+    checkpoint = FitCheckpoint(checkpoint_dir) if checkpoint_dir else None
+
+    todo = ((FittedSessionModel.key_source - FittedSessionModel) & restriction).fetch('KEY')
+
+    # (session, model) reserved by this run and not yet inserted (nor errored) - released on exit
+    reserved = {}
+
+    try:
+        # -- The (session, model) to fit - the session history is fetched once per session --
+        fitted_keys, fits, fit_cmds, session_histories, session_trials = {}, {}, {}, {}, {}
+        session_keys = (experiment.Session & todo).fetch('KEY')
+        for session_key in session_keys:
+            keys = (FittedSessionModel.key_source & session_key & todo).fetch('KEY')
+            if reserve_jobs:
+                keys = [key for key in keys if schema.jobs.reserve(FittedSessionModel.table_name, key)]
+                reserved.update(('{subject_id}_{session}_{model_id}'.format(**key), key) for key in keys)
+            if not keys:
+                continue
+
+            choice_history, reward_history, iti, _, trials = get_cached_session_history(session_key)
+            session = (session_key['subject_id'], session_key['session'])
+            session_histories[session] = choice_history, reward_history, iti
+            session_trials[session] = trials
+
+            for key in keys:
+                fit_cmd, model_class = (Model & key).fetch1('fit_cmd', 'model_class')
+                name = '{subject_id}_{session}_{model_id}'.format(**key)
+                fitted_keys[name] = key
+                fits[name] = (key['subject_id'], key['session'], model_class, key['model_id'])
+                fit_cmds[name] = fit_cmd
+
+        log.info('------ Fitting {} models of {} sessions ------'.format(len(fitted_keys), len(session_trials)))
+
+        # -- Tasks of a (session, model), made once the fits seeding it are done (if warm_start) --
+        n_tasks = {}
+
+        def make_tasks(name, fitted):
+            key = fitted_keys[name]
+            subject_id, session, model_class, _ = fits[name]
+            choice_history, reward_history, iti = session_histories[(subject_id, session)]
+            DE_seeds = get_warm_start_seeds(
+                key, {tuple(fitted_keys[n][k] for k in ('subject_id', 'session', 'model_id')):
+                      dict(zip(fit_cmds[n][1], result.x)) for n, result in fitted.items()}) if warm_start else None
+            tasks = make_fit_tasks(name, fit_cmds[name], choice_history, reward_history,
+                                   iti=iti if model_class in ['CANN'] else None,  # Only pass ITI if this is CANN model
+                                   k_fold=k_fold, DE_pop_size=DE_pop_size, DE_seeds=DE_seeds, checkpoint=checkpoint)
+            n_tasks[name] = len(tasks)
+            return tasks
+
+        # -- Run the tasks, and insert each (session, model) once complete --
+        results, failed, wall_times = defaultdict(dict), set(), []
+
+        for task, result, wall_time, error in run_dependent_fit_tasks(
+                list(fits), warm_start_dependencies(fits) if warm_start else {}, make_tasks,
+                workers=workers, checkpoint=checkpoint):
+            name = task['name']
+            key = fitted_keys[name]
+            wall_times.append(dict(**key, task=task_label(task), wall_time=wall_time))
+            if name in failed:
+                continue
+            if error is not None:
+                failed.add(name)
+                if reserve_jobs:
+                    schema.jobs.error(FittedSessionModel.table_name, key, error_message=repr(error))
+                    del reserved[name]
+                if not suppress_errors:
+                    raise error
+                log.error('populate_fitted_session_models(): {} - {}'.format(key, repr(error)))
+                continue
+
+            results[name][task['fold'] if task['kind'] == 'fold' else 'fit'] = result
+            if len(results[name]) < n_tasks[name]:
+                continue
+
+            # All tasks of this (session, model) are done
+            fit_result = results[name].pop('fit')
+            folds = [results[name][kk] for kk in sorted(results[name])]
+            del results[name]
+
+            with dj.conn().transaction:
+                FittedSessionModel.insert_fitted_model(
+                    key, fit_result,
+                    [acc_test for acc_test, _, _ in folds],
+                    [acc_fit for _, acc_fit, _ in folds],
+                    [acc_bias for _, _, acc_bias in folds if acc_bias is not None],
+                    session_trials[(key['subject_id'], key['session'])])
+
+            if checkpoint is not None:
+                checkpoint.remove(name)
+            if reserve_jobs:
+                schema.jobs.complete(FittedSessionModel.table_name, key)
+                del reserved[name]
+
+    finally:
+        # Release the reservations of the unfinished (session, model) - e.g. on KeyboardInterrupt or an error -
+        # such that the next run resumes them (from their checkpointed tasks)
+        for key in reserved.values():
+            (schema.jobs & {'table_name': FittedSessionModel.table_name, 'key_hash': key_hash(key)}).delete_quick()
+        if reserved:
+            log.info('Released the reservation of {} unfinished models'.format(len(reserved)))
+
+    wall_times = pd.DataFrame(wall_times, columns=list(FittedSessionModel.primary_key) + ['task', 'wall_time'])
+    if len(wall_times):
+        log.info('Fitting wall time per model (s; checkpointed tasks excluded):\n{}'.format(
+            wall_times.groupby('model_id').wall_time.agg(['count', 'sum', 'mean', 'max'])))
+
+    return wall_times
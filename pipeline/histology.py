@@ -386,16 +386,17 @@ def retrieve_pseudocoronal_slice(probe_insertion, shank_no=1):
     ap_coords = (voxel_res * np.round(ap_coords / voxel_res)).astype(np.int)
     ml_coords = (voxel_res * np.round(ml_coords / voxel_res)).astype(np.int)
 
-    # ---- extract pseudoconoral plane from DB ----
-    q_ccf = ccf.CCFAnnotation * ccf.CCFBrainRegion.proj(..., annotation='region_name')
-    dv_pts, lr_pts, ap_pts, color_codes = (
-            q_ccf & [{'ccf_y': dv, 'ccf_z': ap} for ap, dv in zip(ap_coords, dv_coords)]).fetch(
-        'ccf_y', 'ccf_x', 'ccf_z', 'color_code', order_by='ccf_y')
+    # ---- extract pseudoconoral plane from the annotation volume ----
+    annotation_volume = ccf.get_ccf_annotation_volume()
+    lr_grid = np.arange(annotation_volume.volume.shape[0]) * voxel_res
+    plane_labels = annotation_volume.labels(lr_grid[np.newaxis, :],
+                                            dv_coords[:, np.newaxis], ap_coords[:, np.newaxis])
+    dv_ind, lr_ind = np.nonzero(plane_labels)  # ordered by DV
+    dv_pts, lr_pts, ap_pts = dv_coords[dv_ind], lr_grid[lr_ind], ap_coords[dv_ind]
+    color_codes = annotation_volume.color_codes(plane_labels[dv_ind, lr_ind])
 
     # ---- CCF coords for voxels on the interpolated probe/shank track ----
-    coronal_point_cloud = set(zip(lr_pts, dv_pts, ap_pts))  # ML, DV, AP
-    shank_ccfs = np.vstack([(ml, dv, ap)
-                            for dv, ap, ml in zip(dv_coords, ap_coords, ml_coords)
-                            if (ml, dv, ap) in coronal_point_cloud])
+    on_track = annotation_volume.labels(ml_coords, dv_coords, ap_coords) > 0
+    shank_ccfs = np.vstack([ml_coords, dv_coords, ap_coords]).T[on_track]  # ML, DV, AP
 
     return np.vstack([dv_pts, lr_pts, ap_pts, color_codes]).T, shank_ccfs
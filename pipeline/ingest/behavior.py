@@ -11,15 +11,16 @@ from collections import namedtuple
 import scipy.io as spio
 import numpy as np
 import pandas as pd
-import decimal
 import warnings
 import datajoint as dj
 
-from pybpodgui_api.models.project import Project as BPodProject
 from . import InvalidBehaviorTrialError
 
 from pipeline import lab, experiment
-from pipeline import get_schema_name, dict_to_hash, create_schema_settings
+from pipeline import get_schema_name, create_schema_settings, ColumnarInsertBuffer
+from .utils.behavior_file_index import get_behavior_file_index
+from .utils.bpod_session_index import get_bpod_session_index
+from .utils.bpod_trials import build_trial_rows, water_port_name_mapper
 
 schema = dj.schema(get_schema_name('ingest_behavior'), **create_schema_settings)
 
@@ -120,75 +121,30 @@ class BehaviorIngest(dj.Imported):
 
     @property
     def key_source(self):
-
-        # 2 letters, anything, _, anything, 8 digits, _, 6 digits, .mat
-        # where:
-        # (2 letters, anything): water restriction
-        # (anything): task name
-        # (8 digits): date YYYYMMDD
-        # (6 digits): time HHMMSS
-
-        rexp = '^[a-zA-Z]{2}.*_.*_[0-9]{8}_[0-9]{6}.mat$'
-
         # water_restriction_number -> subject
         h2os = {k: v for k, v in zip(*lab.WaterRestriction().fetch(
             'water_restriction_number', 'subject_id'))}
 
-        def buildrec(rig, rigpath, root, f):
-
-            if not re.match(rexp, f):
-                log.debug("{f} skipped - didn't match rexp".format(f=f))
-                return
-
-            log.debug('found file {f}'.format(f=f))
-
-            fullpath = pathlib.Path(root, f)
-            subpath = fullpath.relative_to(rigpath)
-
-            fsplit = subpath.stem.split('_')
-            h2o = fsplit[0]
-            ymd = fsplit[-2:-1][0]
+        recs = []
+        done = set(BehaviorIngest.BehaviorFile().fetch('behavior_file'))
 
-            if h2o not in h2os:
+        # behavior files found in the rig directories, in rig search order
+        # (only the directories modified since the last evaluation are listed again)
+        for r in get_behavior_file_index().records:
+            if r['h2o'] not in h2os:
                 log.warning('{f} skipped - no animal for {h2o}'.format(
-                    f=f, h2o=h2o))
-                return
-
-            animal = h2os[h2o]
-
-            log.debug('animal is {animal}'.format(animal=animal))
+                    f=r['filename'], h2o=r['h2o']))
+                continue
+            if r['filename'] in done:
+                log.debug('skipping already ingested file {}'.format(r['subpath']))
+                continue
 
-            return {
-                'subject_id': animal,
-                'session_date': date(
-                    int(ymd[0:4]), int(ymd[4:6]), int(ymd[6:8])),
-                'rig': rig,
-                'rig_data_path': rigpath.as_posix(),
-                'subpath': subpath.as_posix()
-            }
-
-        recs = []
-        found = set()
-        known = set(BehaviorIngest.BehaviorFile().fetch('behavior_file'))
-        rigs = get_behavior_paths()
-
-        for (rig, rigpath, _) in rigs:
-            rigpath = pathlib.Path(rigpath)
-
-            log.info('RigDataFile.make(): traversing {}'.format(rigpath))
-            for root, dirs, files in os.walk(rigpath):
-                log.debug('RigDataFile.make(): entering {}'.format(root))
-                for f in files:
-                    log.debug('RigDataFile.make(): visiting {}'.format(f))
-                    r = buildrec(rig, rigpath, root, f)
-                    if not r:
-                        continue
-                    if f in set.union(known, found):
-                        log.info('skipping already ingested file {}'.format(
-                            r['subpath']))
-                    else:
-                        found.add(f)  # block duplicate path conf
-                        recs.append(r)
+            done.add(r['filename'])  # block duplicate path conf
+            recs.append({'subject_id': h2os[r['h2o']],
+                         'session_date': r['session_date'],
+                         'rig': r['rig'],
+                         'rig_data_path': r['rig_data_path'],
+                         'subpath': r['subpath']})
 
         return recs
 
@@ -384,21 +340,12 @@ class BehaviorBpodIngest(dj.Imported):
         behavior_file:              varchar(255)          # behavior file name
         """
 
-    water_port_name_mapper = {'left': 'L', 'right': 'R', 'middle': 'M'}
-
-    @staticmethod
-    def get_bpod_projects():
-        projectdirs = dj.config.get('custom', {}).get('behavior_bpod', []).get('project_paths')
-        # construct a list of BPod Projects
-        projects = []
-        for projectdir in projectdirs:
-            projects.append(BPodProject())
-            projects[-1].load(projectdir)
-        return projects
+    water_port_name_mapper = water_port_name_mapper
 
     @property
     def key_source(self):
         key_source = []
+        session_index = get_bpod_session_index()
 
         IDs = {k: v for k, v in zip(*lab.WaterRestriction().fetch(
             'water_restriction_number', 'subject_id'))}
@@ -432,6 +379,10 @@ class BehaviorBpodIngest(dj.Imported):
                                 df_wr_row.Date))
                             continue
 
+                    if not session_index.get_sessions(subject_now, date_now):
+                        log.debug('No BPod session found for {} on {}'.format(subject_now, date_now))
+                        continue
+
                     if not (experiment.Session & {'subject_id': subject_id_now,
                                                   'session_date': date_now}):
                         key_source.append({'subject_id': subject_id_now,
@@ -445,10 +396,8 @@ class BehaviorBpodIngest(dj.Imported):
         return key_source
 
     def populate(self, *args, **kwargs):
-        # Load project info (just once)
-        log.info('------ Loading pybpod project -------')
-        self.projects = self.get_bpod_projects()
-        log.info('------------   Done! ----------------')
+        # Refresh the pybpod session index (just once)
+        self.session_index = get_bpod_session_index(refresh=True)
 
         # 'populate' which won't require upstream tables
         # 'reserve_jobs' not parallel, overloaded to mean "don't exit on error"                          
@@ -462,6 +411,8 @@ class BehaviorBpodIngest(dj.Imported):
                     raise
 
     def make(self, key):
+        from .utils import foraging_bpod as util  # circular import
+
         log.info(
             '----------------------\nBehaviorBpodIngest.make(): key: {key}'.format(key=key))
 
@@ -471,24 +422,12 @@ class BehaviorBpodIngest(dj.Imported):
         date_now_str = key['session_date'].strftime('%Y%m%d')
         log.info('h2o: {h2o}, date: {d}'.format(h2o=subject_now, d=date_now_str))
 
-        # ---- Ingest information for BPod projects ----
-        sessions_now, session_start_times_now, experimentnames_now = [], [], []
-        for proj in self.projects:  #
-            exps = proj.experiments
-            for exp in exps:
-                stps = exp.setups
-                for stp in stps:
-                    for session in stp.sessions:
-                        if (session.subjects and session.subjects[0].find(subject_now) > -1
-                                and session.name.startswith(date_now_str)):
-                            sessions_now.append(session)
-                            session_start_times_now.append(session.started)
-                            experimentnames_now.append(exp.name)
-                            
-        bpodsess_order = np.argsort(session_start_times_now)
+        # ---- BPod sessions of the subject on that date, sorted by start time ----
+        session_index = getattr(self, 'session_index', None) or get_bpod_session_index()
+        sessions_now = session_index.get_sessions(subject_now, date_now_str)
 
         # --- Handle missing BPod session ---
-        if len(bpodsess_order) == 0:
+        if not sessions_now:
             log.error('BPod session not found!')
             return
 
@@ -501,18 +440,19 @@ class BehaviorBpodIngest(dj.Imported):
                          'valve_setting', 'valve_open_dur', 'available_reward')
 
         # getting started
-        concat_rows = {k: list() for k in tbls_2_insert}
+        concat_rows = {k: list() for k in tbls_2_insert}  # one batch per bpod session
         sess_key = None
-        trial_num = 0  # trial numbering starts at 1
+        # trial numbering starts at 1, trial_uid continues from the subject's trial count
+        trial_state = {'trial_num': 0, 'gocue_time': None, 'blocks': []}
+        subject_trial_count = len(experiment.SessionTrial & {'subject_id': subject_id_now})
 
-        for s_idx, session_idx in enumerate(bpodsess_order):
-            session = sessions_now[session_idx]
-            experiment_name = experimentnames_now[session_idx]
-            csvfilename = (pathlib.Path(session.path) / (
-                        pathlib.Path(session.path).name + '.csv'))
+        for s_idx, session in enumerate(sessions_now):
+            experiment_name = session['experiment']
+            csvfilename = (pathlib.Path(session['path']) / (
+                        pathlib.Path(session['path']).name + '.csv'))
 
             # ---- Special parsing for csv file ----
-            log.info('Load session file(s) ({}/{}): {}'.format(s_idx + 1, len(bpodsess_order),
+            log.info('Load session file(s) ({}/{}): {}'.format(s_idx + 1, len(sessions_now),
                                                                csvfilename))
             df_behavior_session = util.load_and_parse_a_csv_file(csvfilename)
 
@@ -551,19 +491,19 @@ class BehaviorBpodIngest(dj.Imported):
             # ---- New session - construct a session key (from the first bpodsess that passes the integrity check) ----
             if sess_key is None:
                 session_time = df_behavior_session['PC-TIME'][trial_start_idxs[0]]
-                if session.setup_name.lower() in ['day1', 'tower-2', 'day2-7', 'day_1',
+                if session['setup_name'].lower() in ['day1', 'tower-2', 'day2-7', 'day_1',
                                                   'real foraging']:
                     setupname = 'Training-Tower-2'
-                elif session.setup_name.lower() in ['tower-3', 'tower-3beh', ' tower-3', '+',
+                elif session['setup_name'].lower() in ['tower-3', 'tower-3beh', ' tower-3', '+',
                                                     'tower 3']:
                     setupname = 'Training-Tower-3'
-                elif session.setup_name.lower() in ['tower-1']:
+                elif session['setup_name'].lower() in ['tower-1']:
                     setupname = 'Training-Tower-1'
-                elif session.setup_name.lower() in ['ephys_han']:
+                elif session['setup_name'].lower() in ['ephys_han']:
                     setupname = 'Ephys-Han'
                 else:
                     log.info('ERROR: unhandled setup name {} (from {}). Skipping...'.format(
-                        session.setup_name, session.path))
+                        session['setup_name'], session['path']))
                     continue  # Another integrity check here
 
                 log.debug('synthesizing session ID')
@@ -588,296 +528,17 @@ class BehaviorBpodIngest(dj.Imported):
                 water_port_channels[lick_port] = df_behavior_session[chn_varname][0]
 
             # ---- Ingestion of trials ----
-
-            # extracting trial data
             session_start_time = datetime.combine(sess_key['session_date'], sess_key['session_time'])
-            trial_start_idxs = df_behavior_session[(df_behavior_session['TYPE'] == 'TRIAL') & (df_behavior_session['MSG'] == 'New trial')].index
-            trial_start_idxs -= 2 # To reflect the change that bitcode is moved before the "New trial" line
-            trial_start_idxs = pd.Index([0]).append(trial_start_idxs[1:])  # so the random seed will be present
-            trial_end_idxs = trial_start_idxs[1:].append(pd.Index([(max(df_behavior_session.index))]))
-
-            # trial_end_idxs = df_behavior_session[(df_behavior_session['TYPE'] == 'END-TRIAL')].index
-            prevtrialstarttime = np.nan
-            blocknum_local_prev = np.nan
-
-            # getting ready
-            rows = {k: list() for k in
-                    tbls_2_insert}  # lists of various records for batch-insert
-
-            for trial_start_idx, trial_end_idx in zip(trial_start_idxs, trial_end_idxs):
-                df_behavior_trial = df_behavior_session[trial_start_idx:trial_end_idx + 1]
-
-                # Trials without GoCue are skipped
-                if not len(
-                        df_behavior_trial[(df_behavior_trial['MSG'] == 'GoCue') & (
-                        df_behavior_trial['TYPE'] == 'STATE')]):
-                    continue
-
-                # ---- session trial ----
-                trial_num += 1  # increment trial number
-                trial_uid = len(experiment.SessionTrial & {'subject_id': subject_id_now}) + trial_num  # Fix trial_uid here
-                
-                # Note that the following trial_start/stop_time SHOULD NEVER BE USED in ephys related analysis 
-                # because they are PC-TIME, which is not accurate (4 ms average delay, sometimes up to several seconds!)!
-                # In fact, from bpod.csv, we can only accurately retrieve (local) trial-wise, but not (global) session-wise, times
-                # See comments below.
-                trial_start_time = df_behavior_session['PC-TIME'][
-                                       trial_start_idx].to_pydatetime() - session_start_time
-                trial_stop_time = df_behavior_session['PC-TIME'][
-                                      trial_end_idx].to_pydatetime() - session_start_time
-
-                sess_trial_key = {**sess_key,
-                                  'trial': trial_num,
-                                  'trial_uid': trial_uid,
-                                  'start_time': trial_start_time.total_seconds(),
-                                  'stop_time': trial_stop_time.total_seconds()}
-                rows['sess_trial'].append(sess_trial_key)
-
-                # ---- session block ----
-                if 'Block_number' in df_behavior_session:
-                    if np.isnan(df_behavior_trial['Block_number'].to_list()[0]):
-                        blocknum_local = 0 if np.isnan(
-                            blocknum_local_prev) else blocknum_local_prev
-                    else:
-                        blocknum_local = int(
-                            df_behavior_trial['Block_number'].to_list()[0]) - 1
-                        blocknum_local_prev = blocknum_local
-
-                    reward_probability = {}
-                    for lick_port in lick_ports:
-                        p_reward_varname = 'var:reward_probabilities_{}'.format(
-                            self.water_port_name_mapper[lick_port])
-                        reward_probability[lick_port] = decimal.Decimal(
-                            df_behavior_session[p_reward_varname][0][blocknum_local]).quantize(
-                            decimal.Decimal(
-                                '.001'))  # Note: Reward probabilities never changes during a **bpod** session
-
-                    # determine if this is a new block: compare reward probability with the previous block
-                    if rows['sess_block']:
-                        itsanewblock = dict_to_hash(reward_probability) != dict_to_hash(
-                            rows['sess_block'][-1]['reward_probability'])
-                    else:
-                        itsanewblock = True
-
-                    if itsanewblock:
-                        all_blocks = [b['block'] for b in
-                                      rows['sess_block'] + concat_rows['sess_block']]
-                        block_num = (np.max(all_blocks) + 1 if all_blocks else 1)
-                        rows['sess_block'].append({**sess_key,
-                                                   'block': block_num,
-                                                   'block_start_time': trial_start_time.total_seconds(),
-                                                   'reward_probability': reward_probability})
-                    else:
-                        block_num = rows['sess_block'][-1]['block']
-
-                    rows['sess_block_trial'].append({**sess_trial_key, 'block': block_num})
-
-
-                # ====== Event times ======
-                # Foraging trial structure: (*...*: events of interest in experiment.EventType; [...]: optional)
-                # -> (ITI) -> *bitcodestart* -> bitcode -> lickport movement -> *delay* (lickport in position) 
-                #          -> [effective delay period] -> *go* -> [*choice*] -> [*reward*] -> *trialend* -> (ITI) ->
-                # Notes:
-                # 1. Differs from the delay-task:
-                #       (1) no sample and presample epoch
-                #       (2) effective delay period could be zero (ITI as an inherent delay). 
-                #           Also note that if the delay_period in bpod protocol < lickport movement time (~100 ms), the effective delay period is also zero, 
-                #           where the go-cue sound actually appears BEFORE the lickport stops moving.
-                #       (3) we are interested in not only go-cue aligned PSTH (ephys.Unit.TrialSpikes), but need more flexible event alignments, especially ITI firings.
-                #           So we should use the session-wise untrialized spike times stored in ephys.Unit['spike_times']. See below.
-                # 2. Two "trial start"s:
-                #       (1) *bitcodestart* = onset of the first bitcode = *sTrig* in NIDQ bitcode.mat
-                #       (2) `trial_start_idx` in this for loop = the start of bpod-trial ('New Trial' in bpod csv file)
-                #            = the reference point of BPOD-TIME  = NIDQ bpod-trial channel
-                #    They are far from each other because I start the bpod trial at the middle of ITI (Foraging_bpod: e9a8ffd6) to cover video recording during ITI.
-                # 3. In theory, *bitcodestart* = *delay* (since there's no sample period),
-                #    but in practice, the bitcode (21*20=420 ms) and lickport movement (~100 ms) also take some time.
-                #    Note that bpod doesn't know the exact time when lickports are in place, so we can get *delay* only from NIDQ zaber channel (ephys.TrialEvent.'zaberinposition').
-                # 4. In early lick trials, effective delay start should be the last 'DelayStart' (?)
-                # 5. Finally, to perform session-wise alignment between behavior and ephys, there are two ways, which could be cross-checked with each other:
-                #       (1) (most straightforward) use all event markers directly from NIDQ bitcode.mat,
-                #           then align them to ephys.Unit['spike_times'] by looking at the *sTrig* of the first trial of a session
-                #       (2) (can be used as a sanity check) extract trial-wise BPOD-TIME from pybpod.csv,
-                #           and then convert the local trial-wise times to global session-wise times by aligning
-                #           the same events from pybpod.csv and bitcode.mat across all trials, e.g., *bitcodestart* <--> *sTrig*, or 0 <--> NIDQ bpod-"trial trigger" channel
-                #    Note that one should NEVER use PC-TIME from the bpod csv files (at least for ephys-related alignment)!!!
-                
-                # ----- BPOD STATES (all events except licks) -----
-                bpod_states_this_trial = df_behavior_trial[(df_behavior_trial['TYPE'] == 'STATE') & (df_behavior_trial['BPOD-INITIAL-TIME'] > 0)]   # All states of this trial
-                trial_event_count = 0
-
-                # Use BPOD-INITIAL-TIME and BPOD-FINAL-TIME (all relative to bpod-trialstart)
-                bpod_states_of_interest = { # experiment.TrialEventType: Bpod state name
-                                           'videostart': ['ITIBeforeVideoOn'],
-                                           'bitcodestart': ['Start'],
-                                           'delay': ['DelayStart'],     # (1) in a non early lick trial, effective delay start = max(DelayStart, LickportInPosition).
-                                                                        #       where LickportIntInPosition is only available from NIDQ
-                                                                        # (2) in an early lick trial, there are multiple DelayStarts, the last of which is the effective delay start
-                                           'go': ['GoCue'],
-                                           'choice': [f'Choice_{lickport}' for lickport in self.water_port_name_mapper.values()],
-                                           'reward': [f'Reward_{lickport}' for lickport in self.water_port_name_mapper.values()],
-                                           'doubledip': ['Double_dipped'],   # Only for non-double-dipped trials, ITI = last lick + 1 sec (maybe I should not use double dipping punishment for ehpys?)
-                                           'trialend': ['ITI'],
-                                           'videoend': ['ITIAfterVideoOff'],
-                                           }
-
-                for trial_event_type, bpod_state in bpod_states_of_interest.items():
-                    _idx = bpod_states_this_trial.index[bpod_states_this_trial['MSG'].isin(bpod_state)]   # One state could have multiple appearances, such as DelayStart in early-lick trials
-                    if not len(_idx):
-                        continue
-
-                    initials, finals = bpod_states_this_trial.loc[_idx][['BPOD-INITIAL-TIME', 'BPOD-FINAL-TIME']].values.T.astype(float)
-                    initials[initials > 9999] = 9999   # Wordaround for bug #9: BPod protocol was paused and then resumed after an impossible long period of time (> decimal(8, 4)).
-                    finals[finals > 9999] = 9999
-
-                    # cache event times
-                    for idx, (initial, final) in enumerate(zip(initials, finals)):
-                        rows['trial_event'].extend(
-                            [{**sess_trial_key,
-                              'trial_event_id': trial_event_count + idx,
-                              'trial_event_type': trial_event_type,
-                              'trial_event_time': initial,
-                              'duration': final - initial}])   # list comprehension doesn't work here
-
-                    trial_event_count += len(initials)
-                    
-                    # save gocue time for early-lick below
-                    if trial_event_type == 'go':
-                        gocue_time = initials[0]
-
-                # ------ Licks (use EVENT instead of STATE because not all licks triggered a state change) -------
-                lick_times = {}
-                for lick_port in lick_ports:
-                    lick_times[lick_port] = df_behavior_trial['BPOD-INITIAL-TIME'][(
-                                df_behavior_trial['+INFO'] == water_port_channels[lick_port])].to_numpy()
-                    
-                # cache licks
-                all_lick_types = np.concatenate(
-                    [[ltype] * len(ltimes) for ltype, ltimes in lick_times.items()])
-
-                all_lick_times = np.concatenate(
-                    [ltimes for ltimes in lick_times.values()])
-
-                # sort by lick times
-                sorted_licks = sorted(zip(all_lick_types, all_lick_times), key=lambda x: x[-1])
-
-                rows['action_event'].extend([{**sess_trial_key, 'action_event_id': idx,
-                                              'action_event_type': '{} lick'.format(ltype),
-                                              'action_event_time': ltime} for
-                                             idx, (ltype, ltime)
-                                            in enumerate(sorted_licks)])
-
-                # ====== Trial facts (nontemporal) ======
-                # WaterPort Choice 
-                trial_choice = {'water_port': None}
-                for lick_port in lick_ports:
-                    if any((df_behavior_trial['MSG'] == 'Choice_{}'.format(
-                            self.water_port_name_mapper[lick_port]))
-                           & (df_behavior_trial['TYPE'] == 'TRANSITION')):
-                        trial_choice['water_port'] = lick_port
-                        break
-
-                rows['trial_choice'].append({**sess_trial_key, **trial_choice})
-
-                # early lick
-                early_lick = 'no early'
-                if any(all_lick_times < gocue_time):
-                    early_lick = 'early'
-
-                # outcome
-                outcome = 'miss' if trial_choice['water_port'] else 'ignore'
-                for lick_port in lick_ports:
-                    if any((df_behavior_trial['MSG'] == 'Reward_{}'.format(
-                            self.water_port_name_mapper[lick_port]))
-                           & (df_behavior_trial['TYPE'] == 'TRANSITION')):
-                        outcome = 'hit'
-                        break
-
-                # ---- accumulated reward ----
-                for lick_port in lick_ports:
-                    reward_var_name = 'reward_{}_accumulated'.format(
-                        self.water_port_name_mapper[lick_port])
-                    if reward_var_name not in df_behavior_trial:
-                        log.error('Bpod CSV KeyError: {} - Available columns: {}'.format(
-                            reward_var_name, df_behavior_trial.columns))
-                        return
-
-                    reward = df_behavior_trial[reward_var_name].values[0]
-                    rows['available_reward'].append({
-                        **sess_trial_key, 'water_port': lick_port,
-                        'reward_available': False if np.isnan(reward) else reward})
-
-                # ---- auto water and notes ----
-                auto_water = False
-                auto_water_times = {}
-                for lick_port in lick_ports:
-                    auto_water_varname = 'Auto_Water_{}'.format(
-                        self.water_port_name_mapper[lick_port])
-                    auto_water_ind = (df_behavior_trial['TYPE'] == 'STATE') & (
-                                df_behavior_trial['MSG'] == auto_water_varname)
-                    if any(auto_water_ind):
-                        auto_water = True
-                        auto_water_times[lick_port] = float(
-                            df_behavior_trial['+INFO'][auto_water_ind.idxmax()])
-
-                if auto_water_times:
-                    auto_water_ports = [k for k, v in auto_water_times.items() if v > 0.001]
-                    rows['trial_note'].append({**sess_trial_key,
-                                               'trial_note_type': 'autowater',
-                                               'trial_note': 'and '.join(auto_water_ports)})
-
-                # add random seed start note
-                if any(df_behavior_trial['MSG'] == 'Random seed:'):
-                    seedidx = (df_behavior_trial['MSG'] == 'Random seed:').idxmax() + 1
-                    rows['trial_note'].append({**sess_trial_key,
-                                               'trial_note_type': 'random_seed_start',
-                                               'trial_note': str(df_behavior_trial['MSG'][seedidx])})
-                    
-                # add randomID (TrialBitCode)
-                if any(df_behavior_trial['MSG'] == 'TrialBitCode: '):
-                    bitcode_ind = (df_behavior_trial['MSG'] == 'TrialBitCode: ').idxmax() + 1
-                    rows['trial_note'].append({**sess_trial_key,
-                                               'trial_note_type': 'bitcode',
-                                               'trial_note': str(df_behavior_trial['MSG'][bitcode_ind])})
-
-
-                # ---- Behavior Trial ----
-                rows['behavior_trial'].append({**sess_trial_key,
-                                               'task': task,
-                                               'task_protocol': task_protocol,
-                                               'trial_instruction': 'none',
-                                               'early_lick': early_lick,
-                                               'outcome': outcome,
-                                               'auto_water': auto_water,
-                                               'free_water': False})  # TODO: verify this
-
-                # ---- Water Valve Setting ----
-                valve_setting = {**sess_trial_key}  
-
-                if 'var_motor:LickPort_Lateral_pos' in df_behavior_trial.keys():
-                    valve_setting['water_port_lateral_pos'] = \
-                        df_behavior_trial['var_motor:LickPort_Lateral_pos'].values[0]
-                if 'var_motor:LickPort_RostroCaudal_pos' in df_behavior_trial.keys():
-                    valve_setting['water_port_rostrocaudal_pos'] = \
-                        df_behavior_trial['var_motor:LickPort_RostroCaudal_pos'].values[0]
-                if 'var_motor:LickPort_DorsoVentral_pos' in df_behavior_trial.keys():
-                    valve_setting['water_port_dorsoventral_pos'] = \
-                        df_behavior_trial['var_motor:LickPort_DorsoVentral_pos'].values[0]
-
-                rows['valve_setting'].append(valve_setting)
-
-                for lick_port in lick_ports:
-                    valve_open_varname = 'var:ValveOpenTime_{}'.format(
-                        self.water_port_name_mapper[lick_port])
-                    if valve_open_varname in df_behavior_trial:
-                        rows['valve_open_dur'].append({
-                            **sess_trial_key, 'water_port': lick_port,
-                            'open_duration': df_behavior_trial[valve_open_varname].values[0]})
+            rows = build_trial_rows(df_behavior_session, session_start_time,
+                                    task, task_protocol, lick_ports, water_port_channels,
+                                    subject_trial_count, trial_state)
+            if rows is None:
+                return
 
             # add to the session-concat
             for tbl in tbls_2_insert:
-                concat_rows[tbl].extend(rows[tbl])
-                
+                concat_rows[tbl].append(rows[tbl])
+
         # ---- The insertions to relevant tables ----
         # Session, SessionComment, SessionDetails insert
         log.info('BehaviorIngest.make(): adding session record')
@@ -885,55 +546,40 @@ class BehaviorBpodIngest(dj.Imported):
         experiment.SessionComment.insert1(sess_key, ignore_extra_fields=True)
         experiment.SessionDetails.insert1(sess_key, ignore_extra_fields=True)
 
-        # Behavior Insertion
+        # Behavior Insertion - columnar batches, one per bpod session
         insert_settings = {'ignore_extra_fields': True, 'allow_direct_insert': True}
+        session_key = {'subject_id': sess_key['subject_id'], 'session': sess_key['session']}
 
         log.info('BehaviorIngest.make(): bulk insert phase')
 
-        log.info('BehaviorIngest.make(): ... experiment.Session.Trial')
-        experiment.SessionTrial.insert(concat_rows['sess_trial'], **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.BehaviorTrial')
-        experiment.BehaviorTrial.insert(concat_rows['behavior_trial'], **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.WaterPortChoice')
-        experiment.WaterPortChoice.insert(concat_rows['trial_choice'], **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.TrialNote')
-        experiment.TrialNote.insert(concat_rows['trial_note'], **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.TrialEvent')
-        experiment.TrialEvent.insert(concat_rows['trial_event'], **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.ActionEvent')
-        experiment.ActionEvent.insert(concat_rows['action_event'], **insert_settings)
-
         log.info('BehaviorIngest.make(): ... experiment.SessionBlock')
-        experiment.SessionBlock.insert(concat_rows['sess_block'], **insert_settings)
-        experiment.SessionBlock.BlockTrial.insert(concat_rows['sess_block_trial'],
-                                                  **insert_settings)
-        block_reward_prob = []
-        for block in concat_rows['sess_block']:
-            block_reward_prob.extend(
-                [{**block, 'water_port': water_port, 'reward_probability': reward_p}
-                 for water_port, reward_p in block.pop('reward_probability').items()])
-        experiment.SessionBlock.WaterPortRewardProbability.insert(block_reward_prob,
-                                                                  **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.TrialAvailableReward')
-        experiment.TrialAvailableReward.insert(concat_rows['available_reward'],
-                                               **insert_settings)
-
-        log.info('BehaviorIngest.make(): ... experiment.WaterValveSetting')
-        experiment.WaterPortSetting.insert(concat_rows['valve_setting'], **insert_settings)
-        experiment.WaterPortSetting.OpenDuration.insert(concat_rows['valve_open_dur'],
-                                                        **insert_settings)
+        sess_blocks = [block for batch in concat_rows['sess_block'] for block in batch]
+        experiment.SessionBlock.insert([{**sess_key, **block} for block in sess_blocks], **insert_settings)
+        experiment.SessionBlock.WaterPortRewardProbability.insert(
+            [{**session_key, 'block': block['block'], 'water_port': water_port, 'reward_probability': reward_p}
+             for block in sess_blocks for water_port, reward_p in block['reward_probability'].items()],
+            **insert_settings)
+
+        for tbl, table in (('sess_trial', experiment.SessionTrial),
+                           ('behavior_trial', experiment.BehaviorTrial),
+                           ('trial_choice', experiment.WaterPortChoice),
+                           ('trial_note', experiment.TrialNote),
+                           ('trial_event', experiment.TrialEvent),
+                           ('action_event', experiment.ActionEvent),
+                           ('sess_block_trial', experiment.SessionBlock.BlockTrial),
+                           ('available_reward', experiment.TrialAvailableReward),
+                           ('valve_setting', experiment.WaterPortSetting),
+                           ('valve_open_dur', experiment.WaterPortSetting.OpenDuration)):
+            log.info('BehaviorIngest.make(): ... experiment.{}'.format(table.__name__))
+            for columns in concat_rows[tbl]:
+                with ColumnarInsertBuffer(table) as ib:
+                    ib.insert(columns, key=session_key)
 
         # Behavior Ingest Insertion
         log.info('BehaviorBpodIngest.make(): saving ingest {}'.format(sess_key))
         self.insert1(sess_key, **insert_settings)
         self.BehaviorFile.insert(
-            [{**sess_key, 'behavior_file': pathlib.Path(s.path).as_posix()}
+            [{**sess_key, 'behavior_file': pathlib.Path(s['path']).as_posix()}
              for s in sessions_now], **insert_settings)
 
 
@@ -2,6 +2,7 @@
 
 import os
 import logging
+import multiprocessing as mp
 import pathlib
 from datetime import datetime
 from tqdm import tqdm
@@ -11,7 +12,7 @@ import pandas as pd
 import numpy as np
 import datajoint as dj
 
-from pipeline import InsertBuffer
+from pipeline import InsertBuffer, ColumnarInsertBuffer
 
 from .. import get_schema_name, create_schema_settings
 from .. import lab, experiment, ephys, tracking, report
@@ -57,6 +58,10 @@ class EphysIngest(dj.Imported):
 
         ephys.ProbeInsertion.generate_entries(key)
 
+        if get_ingest_workers() > 1:
+            ingest_session_units(key)
+            return
+
         for insertion_key in (ephys.ProbeInsertion & key).fetch('KEY'):
             ephys.Unit().make(insertion_key)
             ephys.ClusterMetric().make(insertion_key)
@@ -173,57 +178,22 @@ class EphysIngest(dj.Imported):
         if probe == 1 and 'digMarkerPerTrial' in bitcode_raw:   # Only import once for one session
             insert_ephys_events(skey, bitcode_raw, shared_trial_num)
 
-        # trialize the spikes & subtract go cue
-        t, trial_spikes, trial_units = 0, [], []
-
-        spike_trial_num = np.full_like(spikes, np.nan)
-
-        while t < len(trial_start) - 1:
-
-            s0, s1 = trial_start[t], trial_start[t+1]
-
-            trial_idx = np.where((spikes > s0) & (spikes < s1))
-            spike_trial_num[trial_idx] = trials[t]   # Assign (behavioral) trial number to each spike
-
-            trial_spikes.append(spikes[trial_idx] - trial_go[t])
-            trial_units.append(units[trial_idx])
-
-            t += 1
-
-        # ... including the last trial
-        trial_idx = np.where((spikes > s1))
-        trial_spikes.append(spikes[trial_idx] - trial_go[t])
-        trial_units.append(units[trial_idx])
-
-        trial_spikes = np.array(trial_spikes)
-        trial_units = np.array(trial_units)
-
-        # convert spike data to seconds
-        spikes = spikes / hz
-        trial_start = trial_start / hz
-        trial_spikes = trial_spikes / hz
+        # trialize the spikes & subtract go cue - spike data converted to seconds
+        trialized_spikes = TrializedSpikes(spikes, units, trial_start, trial_go, trials, hz)
 
         # units
-        unit_set = set(units)
+        unit_set = trialized_spikes.unit_set
 
         # build spike arrays
-        unit_spikes = np.array([spikes[np.where(units == u)] for u in unit_set]) - trial_start[0]
+        unit_spikes = trialized_spikes.unit_spikes
+        unit_trial_spikes = trialized_spikes.unit_trial_spikes
+        spike_trial_num = trialized_spikes.spike_trial_num
 
-        unit_trial_spikes = np.array(
-            [[trial_spikes[t][np.where(trial_units[t] == u)]
-              for t in range(len(trials))] for u in unit_set])
+        site2electrode_map = ephys.SiteElectrodeMap(e_config_key, npx_meta.shankmap)
 
-        q_electrodes = lab.ProbeType.Electrode * lab.ElectrodeConfig.Electrode & e_config_key
-        site2electrode_map = {}
-        for recorded_site, (shank, shank_col, shank_row, _) in enumerate(npx_meta.shankmap['data']):
-            site2electrode_map[recorded_site + 1] = (q_electrodes
-                                                     & {'shank': shank + 1,  # this is a 1-indexed pipeline
-                                                        'shank_col': shank_col + 1,
-                                                        'shank_row': shank_row + 1}).fetch1('KEY')
-
-        spike_sites = np.array([site2electrode_map[s]['electrode'] for s in spike_sites])
-        unit_spike_sites = np.array([spike_sites[np.where(units == u)] for u in unit_set])
-        unit_spike_depths = np.array([spike_depths[np.where(units == u)] for u in unit_set])
+        spike_sites = site2electrode_map.map_sites(spike_sites)
+        unit_spike_sites = trialized_spikes.unit_attribute(spike_sites)
+        unit_spike_depths = trialized_spikes.unit_attribute(spike_depths)
 
         if into_archive:
             logger.info('.. inserting clustering timestamp and label')
@@ -241,7 +211,7 @@ class EphysIngest(dj.Imported):
                 'ephys_file': ef_path.relative_to(rigpath).as_posix()},
                 allow_direct_insert=True)
 
-            unit_spike_trial_num = np.array([spike_trial_num[np.where(units == u)] for u in unit_set])
+            unit_spike_trial_num = trialized_spikes.unit_attribute(spike_trial_num)
 
             with InsertBuffer(ephys.ArchivedClustering.Unit, 10, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
@@ -414,35 +384,124 @@ class EphysIngest(dj.Imported):
             logger.info('-- ephys ingest for {} - probe {} complete'.format(skey, probe))
 
 
-def ingest_units(insertion_key, data, npx_meta):
-    skey = data['skey']
+class TrializedSpikes:
+    """
+    Spikes of a probe grouped by unit and by trial, in a single pass:
+        + trial membership of every spike is found with `searchsorted` on `trial_start`
+        + spikes are stably sorted on (unit, trial) into one flat buffer (go-cue aligned, in second)
+        + per-(unit, trial) spike trains are slices (views) into that buffer
+
+    Matches the trialization convention of the ingestion:
+        + a spike belongs to trial t if trial_start[t] < spike < trial_start[t+1]
+        + the last trial includes all spikes after its trial_start
+        + spikes before the first trial_start or exactly on a trial_start are not trialized
+
+    :param spikes: spike times (in sample) - (spike,)
+    :param units: unit id of each spike - (spike,)
+    :param trial_start: trial start times (in sample), in ascending order - (trial,)
+    :param trial_go: go-cue times (in sample) - (trial,)
+    :param trials: (behavioral) trial number of each ephys trial - (trial,)
+    :param hz: sampling rate
+    """
+
+    def __init__(self, spikes, units, trial_start, trial_go, trials, hz):
+        spikes = np.asarray(spikes)
+        trial_start = np.asarray(trial_start)
+        trial_go = np.asarray(trial_go)
+
+        self.trials = np.asarray(trials)
+        self.unit_set, unit_idx = np.unique(units, return_inverse=True)
+
+        n_units, n_trials = len(self.unit_set), len(trial_start)
+
+        # -- trial index of each spike --
+        before = np.searchsorted(trial_start, spikes, side='left')
+        trial_idx = before - 1
+        is_trialized = (before == np.searchsorted(trial_start, spikes, side='right')) & (trial_idx >= 0)
+
+        # (behavioral) trial number of each spike, NaN for non-trialized spikes;
+        # as in the original per-trial loop, spikes of the last trial are not numbered
+        self.spike_trial_num = np.full(spikes.shape, np.nan)
+        is_numbered = is_trialized & (trial_idx < n_trials - 1)
+        self.spike_trial_num[is_numbered] = self.trials[trial_idx[is_numbered]]
+
+        # -- per-unit spike trains (in second, relative to the first trial start) --
+        unit_order = np.argsort(unit_idx, kind='stable')
+        unit_offsets = np.concatenate([[0], np.cumsum(np.bincount(unit_idx, minlength=n_units))])
+        self._unit_order = unit_order
+        self._unit_offsets = unit_offsets
+        self._unit_spike_buffer = spikes[unit_order] / hz - trial_start[0] / hz
+
+        # -- per-(unit, trial) spike trains (in second, relative to go-cue) --
+        trialized_ind = np.where(is_trialized)[0]
+        unit_trial_idx = unit_idx[trialized_ind] * n_trials + trial_idx[trialized_ind]
+        unit_trial_order = np.argsort(unit_trial_idx, kind='stable')
+        trialized_ind = trialized_ind[unit_trial_order]
+
+        self.trial_spike_times = (spikes[trialized_ind] - trial_go[trial_idx[trialized_ind]]) / hz
+        self.trial_spike_offsets = np.concatenate([[0], np.cumsum(np.bincount(unit_trial_idx,
+                                                                   minlength=n_units * n_trials))])
+        self._n_trials = n_trials
+
+    def __len__(self):
+        return len(self.unit_set)
+
+    @property
+    def unit_trial_ids(self):
+        """ (unit, trial) of each row of `trial_spike_offsets` - i.e. all units x all trials """
+        return (np.repeat(self.unit_set, self._n_trials),
+                np.tile(self.trials, len(self.unit_set)))
+
+    @property
+    def unit_spikes(self):
+        """ per-unit spike times (s) relative to the first trial start - list of (spike,) """
+        return [self._unit_spike_buffer[s:e] for s, e in zip(self._unit_offsets[:-1], self._unit_offsets[1:])]
+
+    def unit_attribute(self, values):
+        """ split a per-spike attribute (e.g. spike_sites, spike_depths) into per-unit arrays """
+        values = np.asarray(values)[self._unit_order]
+        return [values[s:e] for s, e in zip(self._unit_offsets[:-1], self._unit_offsets[1:])]
+
+    def trial_spikes(self, unit_idx, trial_idx):
+        """ spike times (s) relative to go-cue of the unit at `unit_idx` in the trial at `trial_idx` """
+        pos = unit_idx * self._n_trials + trial_idx
+        return self.trial_spike_times[self.trial_spike_offsets[pos]:self.trial_spike_offsets[pos + 1]]
+
+    @property
+    def unit_trial_spikes(self):
+        """ per-unit, per-trial spike times (s) relative to go-cue - indexable as [unit_idx][trial_idx] """
+        return [[self.trial_spikes(i, t) for t in range(self._n_trials)] for i in range(len(self.unit_set))]
+
+    def items(self):
+        """ yield (unit_idx, trial_idx, spike_times) for every unit and trial """
+        for i in range(len(self.unit_set)):
+            for t in range(self._n_trials):
+                yield i, t, self.trial_spikes(i, t)
+
+
+def trialize_units(data, npx_meta, behav_trials):
+    """
+    File-level part of `ingest_units` (no database access) - trial (re)numbering and
+    trialization of the spikes of a loaded clustering result
+    :param data: output of a `cluster_loader_map` loader
+    :param npx_meta: SpikeGLXMeta of the recording
+    :param behav_trials: the trial numbers of the session's experiment.SessionTrial, ordered
+    :return: dict of the (noise-filtered) spike sites/depths, unit amplitudes,
+             number of shared ephys/behavior trials and the TrializedSpikes
+    """
     method = data['method']
     hz = data['hz'] if data['hz'] else npx_meta.meta['imSampRate']
     spikes = data['spikes']
     spike_sites = data['spike_sites']
     spike_depths = data['spike_depths']
     units = data['units']
-    unit_wav = data['unit_wav']  # (unit x channel x sample)
-    unit_notes = data['unit_notes']
-    unit_xpos = data['unit_xpos']
-    unit_ypos = data['unit_ypos']
     unit_amp = data['unit_amp']
-    unit_snr = data['unit_snr']
-    vmax_unit_site = data['vmax_unit_site']
     trial_start = data['trial_start']
     trial_go = data['trial_go']
     sync_ephys = data['sync_ephys']
     sync_behav = data['sync_behav']
     trial_fix = data['trial_fix']
-    creation_time = data['creation_time']
     clustering_label = data['clustering_label']
-    cluster_noise_label = data.get('cluster_noise_label')
-    bitcode_raw = data['bitcode_raw']
-
-    probe_no = insertion_key['insertion_number']
-
-    logger.info('-- Start insertions for probe: {} - Clustering method: {} - Label: {}'.format(
-        probe_no, method, clustering_label))
 
     assert len(trial_start) == len(trial_go), 'Unequal number of bitcode "trial_start" ({}) and "trial_go" ({})'.format(
         len(trial_start), len(trial_go))
@@ -501,75 +560,77 @@ def ingest_units(insertion_key, data, npx_meta):
 
         # mapping to the behav-trial numbering
         # "trials" here is just the 0-based indices of the behavioral trials
-        behav_trials = (experiment.SessionTrial & insertion_key).fetch('trial', order_by='trial')
         trials = behav_trials[trial_indices]
 
         # TODO: this is a workaround to deal with the case where ephys stops later than behavior
         # but with the assumption that ephys will NEVER start earlier than behavior
         trial_start = trial_start[:shared_trial_num]  # Truncate ephys 'trial_start' at the tail
-        # And also truncate the ingestion of digital markers (see immediate below)
+        # And also truncate the ingestion of digital markers (see `ingest_units`)
 
     assert len(trial_start) == len(trials),\
         'Unequal number of bitcode "trial_start" ({}) and ingested behavior trials ({})'.format(len(trial_start), len(trials))
 
-    # -- Ingest time markers from NIDQ channels --
-    # This is redudant for delay response task because aligning spikes to the go-cue is enough (trial_spikes below)
-    # But this is critical for the foraging task, because we need global session-wise times to plot flexibly-aligned PSTHs (in particular, spikes during ITI).
-    # However, we CANNOT get this from behavior pybpod .csv files (PC-TIME is inaccurate, whereas BPOD-TIME is trial-based)
-    if probe_no == 1 and 'digMarkerPerTrial' in bitcode_raw:  # Only import once for one session
-        insert_ephys_events(skey, bitcode_raw, shared_trial_num)
-
-    # trialize the spikes & subtract go cue
-    t, trial_spikes, trial_units = 0, [], []
+    # trialize the spikes & subtract go cue - spike data converted to seconds
+    trialized_spikes = TrializedSpikes(spikes, units, trial_start, trial_go, trials, hz)
 
-    spike_trial_num = np.full_like(spikes, np.nan)
+    return {'spike_sites': spike_sites,
+            'spike_depths': spike_depths,
+            'unit_amp': unit_amp,
+            'shared_trial_num': shared_trial_num,
+            'trialized_spikes': trialized_spikes}
 
-    while t < len(trial_start) - 1:
-        s0, s1 = trial_start[t], trial_start[t + 1]
 
-        trial_idx = np.where((spikes > s0) & (spikes < s1))
-        spike_trial_num[trial_idx] = trials[t]  # Assign (behavioral) trial number to each spike
+def ingest_units(insertion_key, data, npx_meta, trialized=None):
+    """
+    Insert the units of a loaded clustering result (see `cluster_loader_map`) for a probe insertion
+    :param trialized: output of `trialize_units` for `data` - computed if not provided
+    """
+    skey = data['skey']
+    method = data['method']
+    unit_wav = data['unit_wav']  # (unit x channel x sample)
+    unit_notes = data['unit_notes']
+    unit_xpos = data['unit_xpos']
+    unit_ypos = data['unit_ypos']
+    unit_snr = data['unit_snr']
+    vmax_unit_site = data['vmax_unit_site']
+    creation_time = data['creation_time']
+    clustering_label = data['clustering_label']
+    cluster_noise_label = data.get('cluster_noise_label')
+    bitcode_raw = data['bitcode_raw']
 
-        trial_spikes.append(spikes[trial_idx] - trial_go[t])
-        trial_units.append(units[trial_idx])
+    probe_no = insertion_key['insertion_number']
 
-        t += 1
+    logger.info('-- Start insertions for probe: {} - Clustering method: {} - Label: {}'.format(
+        probe_no, method, clustering_label))
 
-    # ... including the last trial
-    trial_idx = np.where((spikes > s1))
-    trial_spikes.append(spikes[trial_idx] - trial_go[t])
-    trial_units.append(units[trial_idx])
+    if trialized is None:
+        behav_trials = (experiment.SessionTrial & insertion_key).fetch('trial', order_by='trial')
+        trialized = trialize_units(data, npx_meta, behav_trials)
 
-    trial_spikes = np.array(trial_spikes)
-    trial_units = np.array(trial_units)
+    spike_sites = trialized['spike_sites']
+    spike_depths = trialized['spike_depths']
+    unit_amp = trialized['unit_amp']
+    trialized_spikes = trialized['trialized_spikes']
 
-    # convert spike data to seconds
-    spikes = spikes / hz
-    trial_start = trial_start / hz
-    trial_spikes = trial_spikes / hz
+    # -- Ingest time markers from NIDQ channels --
+    # This is redudant for delay response task because aligning spikes to the go-cue is enough (trial_spikes below)
+    # But this is critical for the foraging task, because we need global session-wise times to plot flexibly-aligned PSTHs (in particular, spikes during ITI).
+    # However, we CANNOT get this from behavior pybpod .csv files (PC-TIME is inaccurate, whereas BPOD-TIME is trial-based)
+    if probe_no == 1 and 'digMarkerPerTrial' in bitcode_raw:  # Only import once for one session
+        insert_ephys_events(skey, bitcode_raw, trialized['shared_trial_num'])
 
     # units
-    unit_set = set(units)
+    unit_set = trialized_spikes.unit_set
 
     # build spike arrays
-    unit_spikes = np.array([spikes[np.where(units == u)] for u in unit_set]) - trial_start[0]
-
-    unit_trial_spikes = np.array(
-        [[trial_spikes[t][np.where(trial_units[t] == u)]
-          for t in range(len(trials))] for u in unit_set])
+    unit_spikes = trialized_spikes.unit_spikes
 
     e_config_key = (lab.ElectrodeConfig & (ephys.ProbeInsertion & insertion_key)).fetch1('KEY')
-    q_electrodes = lab.ProbeType.Electrode * lab.ElectrodeConfig.Electrode & e_config_key
-    site2electrode_map = {}
-    for recorded_site, (shank, shank_col, shank_row, _) in enumerate(npx_meta.shankmap['data']):
-        site2electrode_map[recorded_site + 1] = (q_electrodes
-                                                 & {'shank': shank + 1,  # this is a 1-indexed pipeline
-                                                    'shank_col': shank_col + 1,
-                                                    'shank_row': shank_row + 1}).fetch1('KEY')
-
-    spike_sites = np.array([site2electrode_map[s]['electrode'] for s in spike_sites])
-    unit_spike_sites = np.array([spike_sites[np.where(units == u)] for u in unit_set])
-    unit_spike_depths = np.array([spike_depths[np.where(units == u)] for u in unit_set])
+    site2electrode_map = ephys.SiteElectrodeMap(e_config_key, npx_meta.shankmap)
+
+    spike_sites = site2electrode_map.map_sites(spike_sites)
+    unit_spike_sites = trialized_spikes.unit_attribute(spike_sites)
+    unit_spike_depths = trialized_spikes.unit_attribute(spike_depths)
 
     # insert Unit
     logger.info('.. ephys.Unit')
@@ -601,36 +662,23 @@ def ingest_units(insertion_key, data, npx_meta):
             if ib.flush():
                 logger.debug('.... {}'.format(u))
 
-    # insert Unit.UnitTrial
+    # insert Unit.UnitTrial and Unit.TrialSpikes - columnar bulk inserts
+    unit_trial_key = {**insertion_key, 'clustering_method': method}
+    row_units, row_trials = trialized_spikes.unit_trial_ids
+    offsets = trialized_spikes.trial_spike_offsets
+    with_spikes = np.diff(offsets) > 0
+
     logger.info('.. ephys.Unit.UnitTrial')
     dj.conn().ping()
-    with InsertBuffer(ephys.Unit.UnitTrial, 10000, skip_duplicates=True,
-                      allow_direct_insert=True) as ib:
-
-        for i, u in enumerate(unit_set):
-            for t in range(len(trials)):
-                if len(unit_trial_spikes[i][t]):
-                    ib.insert1({**insertion_key,
-                                'clustering_method': method,
-                                'unit': u,
-                                'trial': trials[t]})
-                    if ib.flush():
-                        logger.debug('.... (u: {}, t: {})'.format(u, t))
+    with ColumnarInsertBuffer(ephys.Unit.UnitTrial, skip_duplicates=True) as ib:
+        ib.insert({'unit': row_units[with_spikes], 'trial': row_trials[with_spikes]},
+                  key=unit_trial_key)
 
-    # insert TrialSpikes
     logger.info('.. ephys.Unit.TrialSpikes')
     dj.conn().ping()
-    with InsertBuffer(ephys.Unit.TrialSpikes, 10000, skip_duplicates=True,
-                      allow_direct_insert=True) as ib:
-        for i, u in enumerate(unit_set):
-            for t in range(len(trials)):
-                ib.insert1({**insertion_key,
-                            'clustering_method': method,
-                            'unit': u,
-                            'trial': trials[t],
-                            'spike_times': unit_trial_spikes[i][t]})
-                if ib.flush():
-                    logger.debug('.... (u: {}, t: {})'.format(u, t))
+    with ColumnarInsertBuffer(ephys.Unit.TrialSpikes, skip_duplicates=True) as ib:
+        ib.insert({'unit': row_units, 'trial': row_trials}, key=unit_trial_key,
+                  ragged={'spike_times': (trialized_spikes.trial_spike_times, offsets)})
 
     if cluster_noise_label is not None and cluster_noise_label:
         dj.conn().ping()
@@ -874,6 +922,101 @@ def extend_ephys_ingest(session_key):
     ephys.ClusterMetric.populate(session_key)
 
 
+def get_ingest_workers(workers=None):
+    """
+    Number of processes for the parallel units ingestion - `workers` if given,
+    else dj.config['custom']['ephys.ingest_workers'] (default: 1, i.e. sequential)
+    """
+    return int(workers or dj.config['custom'].get('ephys.ingest_workers', 1))
+
+
+def _load_and_trialize(sinfo, cluster_method, f, npx_meta, rigpath, behav_trials):
+    """
+    Worker of `ingest_session_units` - load a probe's clustering results and trialize its spikes
+    """
+    data = cluster_loader_map[cluster_method](sinfo, *f)
+    data['rigpath'] = rigpath
+    return data, trialize_units(data, npx_meta, behav_trials)
+
+
+def ingest_session_units(session_key, workers=None):
+    """
+    Parallel ephys.Unit and ephys.ClusterMetric ingestion for all probe insertions (without units) of a session:
+        + the clustering results of all probes are loaded and trialized concurrently in a process pool
+        + a single writer (this process) then inserts the units and metrics of all probes in one transaction
+    :param workers: number of processes - default to dj.config['custom']['ephys.ingest_workers']
+    """
+    insertion_keys = ((ephys.ProbeInsertion & session_key) - ephys.Unit).fetch('KEY', order_by='insertion_number')
+    if not insertion_keys:
+        return
+
+    sinfo = ((lab.WaterRestriction
+              * lab.Subject.proj()
+              * experiment.Session.proj(..., '-session_time')) & session_key).fetch1()
+    h2o = sinfo['water_restriction_number']
+
+    dpath, dglob, rigpath = get_sess_dir(session_key)
+
+    if dpath is None:
+        return
+
+    try:
+        clustering_files = match_probe_to_ephys(h2o, dpath, dglob)
+    except FileNotFoundError as e:
+        logger.warning(str(e) + '. Skipping...')
+        return
+
+    behav_trials = (experiment.SessionTrial & session_key).fetch('trial', order_by='trial')
+
+    load_args = [(sinfo, clustering_files[k['insertion_number']][1], clustering_files[k['insertion_number']][0],
+                  clustering_files[k['insertion_number']][2], rigpath, behav_trials) for k in insertion_keys]
+
+    logger.info('------ Loading clustering results for probes: {} ------'.format(
+        [k['insertion_number'] for k in insertion_keys]))
+
+    # "spawn" - workers open their own database connection rather than sharing this one
+    with mp.get_context('spawn').Pool(processes=min(get_ingest_workers(workers), len(load_args))) as pool:
+        loaded = pool.starmap(_load_and_trialize, load_args)
+
+    def do_insert():
+        for insertion_key, (data, trialized), args in zip(insertion_keys, loaded, load_args):
+            npx_meta = args[3]
+            dj.conn().ping()
+            ingest_units(insertion_key, data, npx_meta, trialized)
+            ingest_metrics(insertion_key, data)
+
+    # the insert part
+    if dj.conn().in_transaction:
+        do_insert()
+    else:
+        with dj.conn().transaction:
+            do_insert()
+
+
+def populate_units(workers=None, reserve_jobs=False, display_progress=False, suppress_errors=False):
+    """
+    Session-level alternative to ephys.Unit.populate() + ephys.ClusterMetric.populate(),
+    with the probes of each session loaded in parallel (see `ingest_session_units`)
+    Jobs are reserved per session (in the ephys schema's jobs table)
+    """
+    todo = (experiment.Session & (ephys.Unit.key_source - ephys.Unit).proj()).fetch('KEY')
+
+    for session_key in (tqdm(todo) if display_progress else todo):
+        if reserve_jobs and not ephys.schema.jobs.reserve(ephys.Unit.table_name, session_key):
+            continue
+        try:
+            ingest_session_units(session_key, workers=workers)
+        except Exception as e:
+            if reserve_jobs:
+                ephys.schema.jobs.error(ephys.Unit.table_name, session_key, error_message=str(e))
+            if not suppress_errors:
+                raise
+            logger.error('populate_units(): {} - {}'.format(session_key, e))
+        else:
+            if reserve_jobs:
+                ephys.schema.jobs.complete(ephys.Unit.table_name, session_key)
+
+
 def archive_ingested_clustering_results(key, archive_trial_spike=False):
     """
     The input-argument "key" should be at the level of ProbeInsertion or its ancestor.
@@ -216,15 +216,7 @@ class HistologyIngest(dj.Imported):
                 histology.ElectrodeCCFPosition.insert1(self.egroup, ignore_extra_fields=True,
                                                        skip_duplicates=True)
 
-                for r in recs:
-                    log.debug('... adding probe/position: {}'.format(r))
-                    try:
-                        histology.ElectrodeCCFPosition.ElectrodePosition.insert1(
-                            r, ignore_extra_fields=True, allow_direct_insert=True)
-                    except Exception as e:  # XXX: no way to be more precise in dj
-                        # log.warning('... ERROR!: {}'.format(repr(e)))
-                        histology.ElectrodeCCFPosition.ElectrodePositionError.insert1(
-                            r, ignore_extra_fields=True, allow_direct_insert=True)
+                _insert_electrode_positions(list(recs))
 
                 log.info('... ok.')
 
@@ -309,23 +301,17 @@ class HistologyIngest(dj.Imported):
                 histology.ElectrodeCCFPosition.insert1(
                     self.egroup, ignore_extra_fields=True, skip_duplicates=True)
 
+                recs = []
                 for z in zip(probe_electrodes[rec_to_elec_idx]['electrode'],
                              pos_xyz[:, 0], pos_xyz[:, 1], pos_xyz[:, 2]):
 
                     z = [int(i) for i in z]  # integer CCF voxels, electrodes.
-                    rec = {**self.egroup, 'electrode': z[0],
-                           'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
-                           'ccf_x': z[1], 'ccf_y': z[2], 'ccf_z': z[3]}
-                            # via nullable: 'mri_x': 0, 'mri_y': 0, 'mri_z': 0
-
-                    log.debug('...... adding ElectrodePosition: {}'.format(rec))
+                    recs.append({**self.egroup, 'electrode': z[0],
+                                 'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
+                                 'ccf_x': z[1], 'ccf_y': z[2], 'ccf_z': z[3]})
+                    # via nullable: 'mri_x': 0, 'mri_y': 0, 'mri_z': 0
 
-                    try:
-                        histology.ElectrodeCCFPosition.ElectrodePosition.insert1(rec)
-                    except Exception as e:  # XXX: no way to be more precise in dj
-                        log.warning('...... ElectrodePositionError: {}'.format(
-                            repr(e)))
-                        histology.ElectrodeCCFPosition.ElectrodePositionError.insert1(rec)
+                _insert_electrode_positions(recs)
 
         return True
 
@@ -566,6 +552,26 @@ class HistologyIngest(dj.Imported):
 # ================== HELPER FUNCTIONS ====================
 
 
+def _insert_electrode_positions(recs):
+    """
+    Insert the electrode CCF positions `recs` in bulk - into ElectrodePosition for those
+    in annotated CCF voxels, looked up in the annotation volume, else into ElectrodePositionError
+    """
+    if not recs:
+        return
+
+    ccf_x, ccf_y, ccf_z = np.array([(r['ccf_x'], r['ccf_y'], r['ccf_z']) for r in recs]).T
+    in_ccf = ccf.get_ccf_annotation_volume().labels(ccf_x, ccf_y, ccf_z) > 0
+
+    log.debug('...... adding {} ElectrodePosition, {} ElectrodePositionError'.format(
+        in_ccf.sum(), (~in_ccf).sum()))
+
+    histology.ElectrodeCCFPosition.ElectrodePosition.insert(
+        [r for r, i in zip(recs, in_ccf) if i], ignore_extra_fields=True, allow_direct_insert=True)
+    histology.ElectrodeCCFPosition.ElectrodePositionError.insert(
+        [r for r, i in zip(recs, in_ccf) if not i], ignore_extra_fields=True, allow_direct_insert=True)
+
+
 def archive_electrode_histology(insertion_key, note='', delete=False):
     """
     For the specified "insertion_key" copy from histology.ElectrodeCCFPosition and histology.LabeledProbeTrack
@@ -1,15 +1,18 @@
 
 import os
+import re
 import logging
 import pathlib
+from fnmatch import fnmatchcase
 from glob import glob
 from datetime import datetime
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import datajoint as dj
 
-from pipeline import lab
+from pipeline import lab, ColumnarInsertBuffer
 from pipeline import tracking
 from pipeline import experiment
 from pipeline.ingest import behavior as behavior_ingest
@@ -63,6 +66,15 @@ class TrackingIngest(dj.Imported):
                               'bottom': ('bottom', 'bottom_face'),
                               'body': ('body', 'side_body')}
 
+    # tracked feature -> (Tracking part table, attribute prefix)
+    tracking_part_mapper = {'nose': ('NoseTracking', 'nose'),
+                            'tongue': ('TongueTracking', 'tongue'),
+                            'jaw': ('JawTracking', 'jaw'),
+                            'paw_left': ('LeftPawTracking', 'left_paw'),
+                            'paw_right': ('RightPawTracking', 'right_paw'),
+                            'lickport': ('LickPortTracking', 'lickport')}
+    tracking_attrs = ('x', 'y', 'likelihood')
+
     def make(self, key, tracking_exists=False):
         '''
         TrackingIngest .make() function
@@ -87,6 +99,8 @@ class TrackingIngest(dj.Imported):
                               else 'tracking_device in ("Camera 0", "Camera 1", "Camera 2")')
 
         tracking_files = []
+        trial_tracking = []  # (trial, tracking device, tracking file) to load
+        listings = {}  # directory -> file names, each tracking directory is listed once
         for device in (tracking.TrackingDevice & camera_restriction).fetch(as_dict=True):
             tdev = device['tracking_device']
             cam_pos = device['tracking_position']
@@ -103,7 +117,7 @@ class TrackingIngest(dj.Imported):
                 try:
                     if session_rig == 'RRig-MTL':
                         tracking_sess_dir, sdate_sml = _get_MTL_sess_tracking_dir(
-                            tracking_root_dir, session, cam_pos)
+                            tracking_root_dir, session, cam_pos, listings)
                     else:
                         tracking_sess_dir, sdate_sml = _get_sess_tracking_dir(
                             tracking_root_dir, session)
@@ -116,12 +130,14 @@ class TrackingIngest(dj.Imported):
                 log.warning('\tNo tracking directory found for {} ({}) - skipping...'.format(tdev, cam_pos))
                 continue
 
+            sess_dir_files = _list_dir(tracking_sess_dir, listings)
+
             campath = None
             tpos = None
             for tpos_candidate in self.camera_position_mapper[cam_pos]:
                 camtrial_fn = '{}_{}_{}.txt'.format(h2o, sdate_sml, tpos_candidate)
                 log.info('Trying camera position trial map: {}'.format(tracking_sess_dir / camtrial_fn))
-                if (tracking_sess_dir / camtrial_fn).exists():
+                if camtrial_fn in sess_dir_files:
                     campath = tracking_sess_dir / camtrial_fn
                     tpos = tpos_candidate
                     log.info('Matched! Using "{}"'.format(tpos))
@@ -135,7 +151,7 @@ class TrackingIngest(dj.Imported):
                 for tpos_candidate in self.camera_position_mapper[cam_pos]:
                     camtrial_fn = '{}*_{}_[0-9]*{}.csv'.format(h2o, tpos_candidate, csv_file_ending)
                     log.info('Trying camera position trial map: {}'.format(tracking_sess_dir / camtrial_fn))
-                    if list(tracking_sess_dir.glob(camtrial_fn)):
+                    if any(fnmatchcase(f, camtrial_fn) for f in sess_dir_files):
                         tpos = tpos_candidate
                         log.info('Matched! Using "{}"'.format(tpos))
                         break
@@ -151,10 +167,11 @@ class TrackingIngest(dj.Imported):
             # sanity check
             assert len(trials) >= n_tmap, '{} tracking trials found but only {} behavior trials available'.format(n_tmap, len(trials))
 
-            log.info('loading tracking data for {} trials'.format(n_tmap))
+            log.info('searching tracking files for {} trials'.format(n_tmap))
+            trial_files = _map_trial_files(sess_dir_files, h2o, tpos, csv_file_ending)
 
             i = 0
-            for t in tmap:  # load tracking for trial
+            for t in tmap:  # tracking file of each trial
                 if tmap[t] not in trials:
                     log.warning('nonexistant trial {}.. skipping'.format(t))
                     continue
@@ -162,108 +179,100 @@ class TrackingIngest(dj.Imported):
                 i += 1
 
                 # ex: dl59_side_1(-0000).csv
-                tracking_trial_filename = '{}*_{}_{}{}.csv'.format(h2o, tpos, t, csv_file_ending)
-                tracking_trial_filepath = list(tracking_sess_dir.glob(tracking_trial_filename))
+                tracking_trial_filepath = [tracking_sess_dir / f for f in trial_files.get(str(t), [])]
 
                 if not tracking_trial_filepath or len(tracking_trial_filepath) > 1:
                     log.debug('file mismatch: file: {} trial: {} ({})'.format(
                         t, tmap[t], tracking_trial_filepath))
                     continue
 
-                if i % 50 == 0:
-                    log.info('item {}/{}, trial #{} ({:.2f}%)'
-                             .format(i, n_tmap, t, (i/n_tmap)*100))
-                else:
-                    log.debug('item {}/{}, trial #{} ({:.2f}%)'
-                              .format(i, n_tmap, t, (i/n_tmap)*100))
-
                 tracking_trial_filepath = tracking_trial_filepath[-1]
-                try:
-                    trk = self.load_tracking(tracking_trial_filepath)
-                except Exception as e:
-                    log.warning('Error loading .csv: {}\n{}'.format(
-                        tracking_trial_filepath, str(e)))
-                    raise e
-
-                recs = {}
-                rec_base = dict(key, trial=tmap[t], tracking_device=tdev)
-
-                for k in trk:
-                    if k == 'samples':
-                        recs['tracking'] = {
-                            **rec_base,
-                            'tracking_samples': len(trk['samples']['ts']),
-                        }
-                    else:
-                        rec = dict(rec_base)
-
-                        for attr in trk[k]:
-                            rec_key = '{}_{}'.format(k, attr)
-                            rec[rec_key] = np.array(trk[k][attr])
-
-                        recs[k] = rec
-
-                tracking.Tracking.insert1(
-                    recs['tracking'], allow_direct_insert=True)
-
-                if 'nose' in recs:
-                    tracking.Tracking.NoseTracking.insert1(
-                        recs['nose'], allow_direct_insert=True)
-
-                if 'tongue' in recs:
-                    tracking.Tracking.TongueTracking.insert1(
-                        recs['tongue'], allow_direct_insert=True)
-
-                if 'jaw' in recs:
-                    tracking.Tracking.JawTracking.insert1(
-                        recs['jaw'], allow_direct_insert=True)
-
-                if 'paw_left' in recs:
-                    fmap = {'paw_left_x': 'left_paw_x',  # remap field names
-                            'paw_left_y': 'left_paw_y',
-                            'paw_left_likelihood': 'left_paw_likelihood'}
-
-                    tracking.Tracking.LeftPawTracking.insert1({
-                        **{k: v for k, v in recs['paw_left'].items()
-                           if k not in fmap},
-                        **{fmap[k]: v for k, v in recs['paw_left'].items()
-                           if k in fmap}}, allow_direct_insert=True)
-
-                if 'paw_right' in recs:
-                    fmap = {'paw_right_x': 'right_paw_x',  # remap field names
-                            'paw_right_y': 'right_paw_y',
-                            'paw_right_likelihood': 'right_paw_likelihood'}
-
-                    tracking.Tracking.RightPawTracking.insert1({
-                        **{k: v for k, v in recs['paw_right'].items()
-                           if k not in fmap},
-                        **{fmap[k]: v for k, v in recs['paw_right'].items()
-                           if k in fmap}}, allow_direct_insert=True)
-
-                if 'lickport' in recs:
-                    tracking.Tracking.LickPortTracking.insert1(
-                        recs['lickport'], allow_direct_insert=True)
-
-                # special handling for whisker(s)
-                whisker_keys = [k for k in recs if 'whisker' in k]
-                tracking.Tracking.WhiskerTracking.insert([
-                    {**recs[k], 'whisker_name': k} for k in whisker_keys],
-                    allow_direct_insert=True)
+                trial_tracking.append((tmap[t], tdev, tracking_trial_filepath))
 
                 tracking_files.append({
                     **key, 'trial': tmap[t], 'tracking_device': tdev,
                     'tracking_file': tracking_trial_filepath.relative_to(tracking_root_dir).as_posix()})
 
-            log.info('... completed {}/{} items.'.format(i, n_tmap))
+            log.info('... found {}/{} items.'.format(i, n_tmap))
 
         log.info('\n---------------------')
         if tracking_files:
-            if not tracking_exists:
-                self.insert1(key)
-            self.TrackingFile.insert(tracking_files)
+            log.info('loading tracking data of {} trials'.format(len(trial_tracking)))
+            trks = self.load_trial_tracking([f for _, _, f in trial_tracking])
+
+            def do_insert():
+                self.insert_tracking(key, [(trial, tdev, trk) for (trial, tdev, _), trk
+                                           in zip(trial_tracking, trks)])
+                if not tracking_exists:
+                    self.insert1(key)
+                self.TrackingFile.insert(tracking_files)
+
+            if dj.conn().in_transaction:
+                do_insert()
+            else:
+                with dj.conn().transaction:
+                    do_insert()
 
             log.info('Tracking ingestion completed: {k}'.format(k=key))
 
+    def load_trial_tracking(self, trkpaths, workers=None):
+        '''
+        load the tracking data of `trkpaths` (see `load_tracking`), in order
+        :param workers: number of threads reading the files concurrently
+            - default to dj.config['custom']['tracking.ingest_workers'] (default: 1, i.e. sequential)
+        '''
+        def load(trkpath):
+            try:
+                return self.load_tracking(trkpath)
+            except Exception as e:
+                log.warning('Error loading .csv: {}\n{}'.format(trkpath, str(e)))
+                raise e
+
+        workers = int(workers or dj.config['custom'].get('tracking.ingest_workers', 1))
+        if workers > 1 and len(trkpaths) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(trkpaths))) as executor:
+                return list(executor.map(load, trkpaths))
+        return [load(trkpath) for trkpath in trkpaths]
+
+    def insert_tracking(self, key, trial_tracking):
+        '''
+        bulk insert of tracking.Tracking and its feature parts, for the (trial, tracking device, tracking data)
+        of `trial_tracking` - one columnar insert per table, tracking.Tracking first
+        '''
+        rows = defaultdict(lambda: defaultdict(list))  # table -> column -> per-row values
+        for trial, tdev, trk in trial_tracking:
+            rows['Tracking']['trial'].append(trial)
+            rows['Tracking']['tracking_device'].append(tdev)
+            rows['Tracking']['tracking_samples'].append(len(trk['samples']['ts']))
+
+            for feature in trk:
+                if feature in self.tracking_part_mapper:
+                    part, prefix = self.tracking_part_mapper[feature]
+                    part_rows = rows[part]
+                elif 'whisker' in feature:  # special handling for whisker(s)
+                    part, prefix = 'WhiskerTracking', 'whisker'
+                    part_rows = rows[part]
+                    part_rows['whisker_name'].append(feature)
+                else:
+                    continue
+
+                part_rows['trial'].append(trial)
+                part_rows['tracking_device'].append(tdev)
+                for attr in self.tracking_attrs:
+                    part_rows['{}_{}'.format(prefix, attr)].append(trk[feature][attr])
+
+        for table_name, columns in sorted(rows.items(), key=lambda x: x[0] != 'Tracking'):
+            table = tracking.Tracking if table_name == 'Tracking' else getattr(tracking.Tracking, table_name)
+            ragged = {}
+            for attr in [c for c in columns if c.endswith(self.tracking_attrs)]:
+                values = columns.pop(attr)
+                ragged[attr] = (np.concatenate(values),
+                                np.concatenate([[0], np.cumsum([len(v) for v in values])]))
+
+            log.info('... {} ({} rows)'.format(table_name, len(columns['trial'])))
+            with ColumnarInsertBuffer(table) as ib:
+                ib.insert(columns, key=key, ragged=ragged)
+
     @staticmethod
     def load_campath(campath):
         ''' load camera position file-to-trial map '''
@@ -286,30 +295,28 @@ class TrackingIngest(dj.Imported):
 
         results are of the form:
 
-          {'feature': {'attr': [val, ...]}}
+          {'feature': {'attr': np.array([val, ...])}}
 
         where feature is e.g. 'nose', 'attr' is e.g. 'x'.
 
         the special 'feature'/'attr' pair "samples"/"ts" is used to store
         the first column/sample timestamp for each row in the input file.
         '''
-        res = defaultdict(lambda: defaultdict(list))
-
         with open(trkpath, 'r') as f:
             f.readline()  # discard 1st line
             parts, fields = f.readline(), f.readline()
             parts = parts.rstrip().split(',')
             fields = fields.rstrip().split(',')
 
-            for l in f:
-                if l.strip():
-                    lv = l.rstrip().split(',')
-                    for i, v in enumerate(lv):
-                        v = float(v)
-                        if i == 0:
-                            res['samples']['ts'].append(v)
-                        else:
-                            res[parts[i]][fields[i]].append(v)
+            values = np.loadtxt(f, delimiter=',', dtype=np.float64, comments=None, ndmin=2)
+
+        if not values.size:  # no sample
+            values = np.empty((0, len(parts)))
+
+        res = defaultdict(dict)
+        res['samples']['ts'] = values[:, 0]
+        for i in range(1, len(parts)):
+            res[parts[i]][fields[i]] = values[:, i]
 
         return res
 
@@ -372,7 +379,32 @@ def _get_sess_tracking_dir(tracking_path, session):
             dir.relative_to(tracking_path), legacy_dir.relative_to(tracking_path)))
 
 
-def _get_MTL_sess_tracking_dir(tracking_path, session, camera_position):
+def _list_dir(dirpath, listings):
+    """
+    Names of the entries of a directory, listed once and kept in `listings` (dict: directory -> names)
+    """
+    if dirpath not in listings:
+        listings[dirpath] = sorted(os.listdir(dirpath))
+    return listings[dirpath]
+
+
+def _map_trial_files(filenames, h2o, tracking_position, csv_file_ending):
+    """
+    Map the trial number (str) of the tracking files of a camera position to their file names:
+        {h2o}*_{tracking_position}_{trial}{csv_file_ending}.csv - e.g. dl59_side_1(-0000).csv
+    :param csv_file_ending: '-*' (filename containing e.g. '-0000') or ''
+    """
+    rexp = re.compile('^{}.*_{}_([0-9]+){}\\.csv$'.format(
+        re.escape(h2o), re.escape(tracking_position), '-.*' if csv_file_ending else ''))
+    trial_files = defaultdict(list)
+    for f in filenames:
+        match = rexp.match(f)
+        if match:
+            trial_files[match.group(1)].append(f)
+    return trial_files
+
+
+def _get_MTL_sess_tracking_dir(tracking_path, session, camera_position, listings=None):
     """
     Specialized directory searching method for "multi-target-licking" tracking data (recorded from RRig-MTL at Baylor)
     Given the session information, a tracking root data directory, and the camera position
@@ -382,6 +414,7 @@ def _get_MTL_sess_tracking_dir(tracking_path, session, camera_position):
 
     The directory structure conventions supported:
         tracking_path / camera_position / h2o / YYYY_mm_dd / *.csv(s)
+    :param listings: directory listings to reuse/extend (see `_list_dir`)
     """
     tracking_path = pathlib.Path(tracking_path)
     h2o = session['water_restriction_number']
@@ -394,7 +427,8 @@ def _get_MTL_sess_tracking_dir(tracking_path, session, camera_position):
         sess_dirname = sess_date.strftime('%Y_%m_%d') + session_nth_str
         dir = tracking_path / tpos_candidate / h2o / sess_dirname
 
-        if dir.exists() and list(dir.glob('*{}*.csv'.format(tpos_candidate))):
+        if dir.exists() and any(fnmatchcase(f, '*{}*.csv'.format(tpos_candidate))
+                                for f in _list_dir(dir, listings if listings is not None else {})):
             return dir, sess_date.strftime('%Y_%m_%d') + session_nth_str
 
     raise FileNotFoundError(
@@ -0,0 +1,91 @@
+import logging
+import pathlib
+import re
+from datetime import date
+
+import datajoint as dj
+
+from .dir_index import DirectoryIndex
+
+
+log = logging.getLogger(__name__)
+
+# 2 letters, anything, _, anything, 8 digits, _, 6 digits, .mat
+# where:
+# (2 letters, anything): water restriction
+# (anything): task name
+# (8 digits): date YYYYMMDD
+# (6 digits): time HHMMSS
+behavior_file_rexp = '^[a-zA-Z]{2}.*_.*_[0-9]{8}_[0-9]{6}.mat$'
+
+_behavior_file_index = None
+_behavior_file_index_config = None
+
+
+class BehaviorFileIndex(DirectoryIndex):
+    '''
+    BehaviorFileIndex: index of the behavior (.mat) files of a set of rig data directories,
+    with the water restriction number and session date parsed from the file names
+
+    Records are listed in the search order of the rigs
+    '''
+
+    def __init__(self, rigs, index_file=None):
+        '''
+        :param rigs: list of [rig name, rig full path, search order] - see `get_behavior_paths`
+        '''
+        rigs = sorted(rigs, key=lambda x: x[-1])
+        super().__init__([rigpath for _, rigpath, _ in rigs], index_file)
+        self.rigs = {pathlib.Path(rigpath): rig for rig, rigpath, _ in rigs}
+
+    def scan_file(self, root, dirpath, filename):
+        if not re.match(behavior_file_rexp, filename):
+            log.debug("{f} skipped - didn't match rexp".format(f=filename))
+            return None
+
+        fullpath = dirpath / filename
+        subpath = fullpath.relative_to(root)
+
+        fsplit = subpath.stem.split('_')
+        h2o = fsplit[0]
+        ymd = fsplit[-2:-1][0]
+        try:
+            session_date = date(int(ymd[0:4]), int(ymd[4:6]), int(ymd[6:8]))
+        except ValueError:
+            log.warning('{f} skipped - invalid date {ymd}'.format(f=filename, ymd=ymd))
+            return None
+
+        file_stat = fullpath.stat()
+        return {'filename': filename,
+                'rig': self.rigs[root],
+                'rig_data_path': root.as_posix(),
+                'subpath': subpath.as_posix(),
+                'h2o': h2o,
+                'session_date': session_date,
+                'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime_ns}
+
+
+def get_behavior_file_index(refresh=True):
+    '''
+    BehaviorFileIndex of dj.config['custom']['behavior_data_paths'],
+    kept on disk at dj.config['custom']['behavior_file_index'] if set
+    :param refresh: rescan the directories changed since the last refresh
+    '''
+    global _behavior_file_index, _behavior_file_index_config
+
+    rigs = dj.config.get('custom', {}).get('behavior_data_paths', None)
+    if rigs is None:
+        raise ValueError("Missing 'behavior_data_paths' in dj.config['custom']")
+    index_file = dj.config['custom'].get('behavior_file_index')
+
+    config = (repr(rigs), index_file)
+    if _behavior_file_index is None or config != _behavior_file_index_config:
+        _behavior_file_index = BehaviorFileIndex(rigs, index_file)
+        _behavior_file_index_config = config
+        refresh = True
+
+    if refresh:
+        _behavior_file_index.refresh()
+
+    return _behavior_file_index
@@ -0,0 +1,66 @@
+"""
+Decoding of the trial bitcodes of the nidq.XA.txt files, and their matching to the behavior trials (no database access)
+"""
+
+import numpy as np
+
+
+def match_bitcodes(bitcodes, trial_start_times, behavior_bitcodes, behav_trials, go_times):
+    """
+    Match the ephys trials (bitcodes) to the behavior trials with the same bitcode (the first one if repeated)
+    :return: ephys_bitcodes, trial_numbers, ephys_trial_start_times, ephys_trial_ref_times - of the matched ephys trials
+    """
+    behavior_trial_idx = {}
+    for idx, bitcode in enumerate(behavior_bitcodes):
+        behavior_trial_idx.setdefault(bitcode, idx)
+
+    matched = [(i, behavior_trial_idx[bitcode]) for i, bitcode in enumerate(bitcodes)
+               if bitcode in behavior_trial_idx]
+    if not matched:
+        return [], np.array([]), np.array([]), np.array([])
+
+    ephys_idx, behavior_idx = (np.array(idx) for idx in zip(*matched))
+    ephys_trial_start_times = np.asarray(trial_start_times)[ephys_idx]
+    return ([bitcodes[i] for i in ephys_idx],
+            np.asarray(behav_trials)[behavior_idx],
+            ephys_trial_start_times,
+            ephys_trial_start_times + np.asarray(go_times)[behavior_idx])
+
+
+def decode_bitcodes(trial_starts, bitcode_times, time_to_first_high_bit=0.05, inter_bit_interval=0.007,
+                    bitcode_length=10):
+    """
+    Decode the bitcode of each trial from the times of the high bits (rising edges) of the bitcode channel
+        + the high bits of a trial are those within [trial start, next trial start) - the last trial being 99s long
+        + the n-th bit is high at trial start + time_to_first_high_bit + (n - 1) * inter_bit_interval
+    The high bits of all trials are assigned to their trial and bit position at once
+     (assumes trial starts in ascending order)
+    :return: list of bitcodes (e.g. '0100110010'), one per trial
+    """
+    trial_starts, bitcode_times = np.asarray(trial_starts), np.asarray(bitcode_times)
+    trial_ends = np.concatenate([trial_starts[1:], [trial_starts[-1] + 99]])  # the last trial to be arbitrarily long
+
+    # trial of each high bit (in file order within a trial)
+    trial_idx = np.searchsorted(trial_starts, bitcode_times, side='right') - 1
+    in_trial = trial_idx >= 0
+    in_trial[in_trial] = bitcode_times[in_trial] < trial_ends[trial_idx[in_trial]]
+    order = np.argsort(trial_idx[in_trial], kind='stable')
+    trial_idx, bit_times = trial_idx[in_trial][order], bitcode_times[in_trial][order]
+
+    # bit position: number of inter-bit intervals since the previous high bit (or the first bit), accumulated per trial
+    is_first = np.ones(len(trial_idx), dtype=bool)
+    is_first[1:] = trial_idx[1:] != trial_idx[:-1]
+    previous_times = np.empty_like(bit_times)
+    previous_times[1:] = bit_times[:-1]
+    previous_times[is_first] = (trial_starts + time_to_first_high_bit - inter_bit_interval)[trial_idx[is_first]]
+    steps = np.cumsum(np.round((bit_times - previous_times) / inter_bit_interval))
+    first_idx = np.flatnonzero(is_first)
+    trial_offsets = np.where(first_idx > 0, steps[first_idx - 1], 0)
+    high_bit_ind = (steps - np.repeat(trial_offsets, np.diff(np.append(first_idx, len(steps))))).astype(int) - 1
+
+    if np.any((high_bit_ind < -bitcode_length) | (high_bit_ind >= bitcode_length)):
+        raise IndexError('High bit out of the {}-bit bitcode range'.format(bitcode_length))
+
+    bits = np.zeros((len(trial_starts), bitcode_length), dtype=np.uint8)
+    bits[trial_idx, high_bit_ind] = 1
+    return (bits + ord('0')).view('S{}'.format(bitcode_length)).ravel().astype(str).tolist()
@@ -0,0 +1,195 @@
+"""
+Loading and parsing of the pybpod csv files (no database access)
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import datajoint as dj
+
+from pipeline import dict_to_hash
+
+# Version of the parsed csv DataFrames - increment on any change to `_parse_csv_file`, to invalidate their cache
+csv_parser_version = 1
+
+
+def load_and_parse_a_csv_file(csvfilename, use_cache=True):
+    """
+    Load and parse a pybpod csv file into a DataFrame (one row per csv row)
+    :param use_cache: if dj.config['custom']['behavior_bpod']['csv_cache_dir'] is set,
+        reuse the DataFrame parsed from the same csv file (path, size and mtime) by the same parser version
+        (`csv_parser_version`) - else parse and cache it
+    """
+    cache_dir = dj.config['custom'].get('behavior_bpod', {}).get('csv_cache_dir')
+    if use_cache and cache_dir:
+        csv_stat = Path(csvfilename).stat()
+        cache_file = Path(cache_dir) / '{}.pkl'.format(dict_to_hash(
+            {'path': Path(csvfilename).resolve(), 'size': csv_stat.st_size, 'mtime': csv_stat.st_mtime_ns,
+             'parser_version': csv_parser_version}))
+        if cache_file.exists():
+            return pd.read_pickle(cache_file)
+        df = _parse_csv_file(csvfilename)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.{}.tmp'.format(os.getpid()))  # concurrent readers never see a partial file
+        df.to_pickle(tmp_file)
+        tmp_file.replace(cache_file)
+        return df
+
+    return _parse_csv_file(csvfilename)
+
+
+def _assign_per_trial(df, column, trial_values):
+    """
+    Assign to `column` the {trial number in session: value} of `trial_values`
+     to all rows of the corresponding trials
+    """
+    rows = df['Trial_number_in_session'].isin(list(trial_values))
+    df.loc[rows, column] = df['Trial_number_in_session'][rows].map(trial_values).values
+
+
+def _parse_csv_file(csvfilename):
+    df = pd.read_csv(csvfilename, delimiter = ';', skiprows = 6)
+    df = df[df['TYPE'] != '|']  # delete empty rows
+    df = df[df['TYPE'] != 'During handling of the above exception, another exception occurred:']  # delete empty rows
+    df = df[df['MSG'] != ' ']  # delete empty rows
+    df = df[df['MSG'] != '|']  # delete empty rows
+    df = df.reset_index(drop = True)  # resetting indexes after deletion
+
+    # converting string time to datetime - sometimes pybpod don't write out the whole number...
+    pc_time = df['PC-TIME'].astype(str)
+    pc_time = pc_time.where(pc_time.str.contains('.', regex=False), pc_time + '.000000')
+    df['PC-TIME'] = pd.to_datetime(pc_time, format='%Y-%m-%d %H:%M:%S.%f')
+
+    tempstr = df['+INFO'][df['MSG'] == 'CREATOR-NAME'].values[0]
+    experimenter = tempstr[2:tempstr[2:].find('"') + 2]  # +2
+    tempstr = df['+INFO'][df['MSG'] == 'SUBJECT-NAME'].values[0]
+    subject = tempstr[2:tempstr[2:].find("'") + 2]  # +2
+    df['experimenter'] = experimenter
+    df['subject'] = subject
+
+    # adding trial numbers in session - rows before the first 'TRIAL' row are trial 0
+    df['Trial_number_in_session'] = (df['TYPE'] == 'TRIAL').cumsum().astype(float)
+    # =============================================================================
+    #     # adding trial types
+    #     tic = time.time()
+    #     indexes = df[df['MSG'] == 'Trialtype:'].index + 1 #+2
+    #     if len(indexes)>0:
+    #         if 'Trialtype' not in df.columns:
+    #             df['Trialtype']=np.nan
+    #         trialtypes = df['MSG'][indexes]
+    #         trialnumbers = df['Trial_number_in_session'][indexes].values
+    #         for trialtype,trialnum in zip(trialtypes,trialnumbers):
+    #             #df['Trialtype'][df['Trial_number_in_session'] == trialnum] = trialtype
+    #             df.loc[df['Trial_number_in_session'] == trialnum, 'Trialtype'] = trialtype
+    #     toc = time.time()
+    #     print(['trial types:',toc-tic])
+    # =============================================================================
+    # adding block numbers
+    indexes = df[df['MSG'] == 'Blocknumber:'].index + 1  # +2
+    if len(indexes) > 0:
+        if 'Block_number' not in df.columns:
+            df['Block_number'] = np.nan
+        block_numbers = {}
+        for blocknumber, trialnum in zip(df['MSG'][indexes], df['Trial_number_in_session'][indexes].values):
+            try:
+                block_numbers[trialnum] = int(blocknumber)
+            except:
+                block_numbers[trialnum] = np.nan
+        _assign_per_trial(df, 'Block_number', block_numbers)
+
+    # adding accumulated rewards -L,R,M
+    for direction in ['L', 'R', 'M']:
+        indexes = df[df['MSG'] == 'reward_{}_accumulated:'.format(direction)].index + 1  # +2
+        if len(indexes) > 0:
+            if 'reward_{}_accumulated'.format(direction) not in df.columns:
+                # object: NaN or bool
+                df['reward_{}_accumulated'.format(direction)] = pd.Series(np.nan, index=df.index, dtype=object)
+            accumulated_rewards = {trialnum: accumulated_reward == 'True' for accumulated_reward, trialnum
+                                   in zip(df['MSG'][indexes], df['Trial_number_in_session'][indexes].values)}
+            _assign_per_trial(df, 'reward_{}_accumulated'.format(direction), accumulated_rewards)
+
+    # adding trial numbers -  the variable names are crappy.. sorry
+    indexes = df[df['MSG'] == 'Trialnumber:'].index + 1  # +2
+    if len(indexes) > 0:
+        if 'Trial_number' not in df.columns:
+            df['Trial_number'] = np.nan
+        trial_numbers, invalid_trials = {}, set()
+        for trialnumber, trialnum in zip(df['MSG'][indexes], df['Trial_number_in_session'][indexes].values):
+            try:
+                trial_numbers[trialnum] = int(trialnumber)
+            except:
+                invalid_trials.add(trialnum)
+        _assign_per_trial(df, 'Trial_number', trial_numbers)
+        if invalid_trials:
+            df.loc[df['Trial_number_in_session'].isin(invalid_trials), 'Block_number'] = np.nan
+
+    # saving variables (if any)
+    variableidx = (df[df['MSG'] == 'Variables:']).index.to_numpy()
+    if len(variableidx) > 0:
+        d = {}
+        exec('variables = ' + df['MSG'][variableidx + 1].values[0], d)
+        for varname in d['variables'].keys():
+            if ('reward_probabilities' in varname or '_ch_in' in varname or '_ch_out' in varname
+                or varname in ['retract_motor_signal', 'protract_motor_signal']):  
+                # For the variables that never change within one **bpod** session, 
+                # only save to the first row of the dataframe to save time and space
+                df['var:' + varname] = None   # Initialize with None
+                df.at[0, 'var:' + varname] = d['variables'][varname]   # Only save to the first row
+            else:        
+                if isinstance(d['variables'][varname], (list, tuple)):
+                    df['var:' + varname] = [d['variables'][varname]] * len(df)
+                else:
+                    df['var:' + varname] = d['variables'][varname]
+                    
+    # updating variables
+    variableidxs = (df[df['MSG'] == 'Variables updated:']).index.to_numpy()
+    for variableidx in variableidxs:
+        d = {}
+        exec('variables = ' + df['MSG'][variableidx + 1], d)
+        for varname in d['variables'].keys():
+            # Skip the variables that never change within one **bpod** session
+            if ('reward_probabilities' in varname 
+                or '_ch_in' in varname or '_ch_out' in varname
+                or varname in ['retract_motor_signal', 'protract_motor_signal']):     
+                continue
+            
+            if isinstance(d['variables'][varname], (list, tuple)):
+                templist = [d['variables'][varname]] * (len(df) - variableidx)
+                df['var:' + varname][variableidx:] = templist
+            # =============================================================================
+            #                 print(len(templist))
+            #                 print(len(idxs))
+            #                 print(templist)
+            #                 df.loc[idxs, 'var:'+varname] = templist
+            # =============================================================================
+            else:
+                # df['var:'+varname][variableidx:] = d['variables'][varname]
+                df.loc[range(variableidx, len(df)), 'var:' + varname] = d['variables'][varname]
+
+    # saving motor variables (if any)
+    variableidx = (df[df['MSG'] == 'LickportMotors:']).index.to_numpy()
+    if len(variableidx) > 0:
+        d = {}
+        exec('variables = ' + df['MSG'][variableidx + 1].values[0], d)
+        for varname in d['variables'].keys():
+            df['var_motor:' + varname] = d['variables'][varname]
+            
+    # extracting reward probabilities from variables (already in behavior.py; no need to broadcast to every time stamp in df)
+    # if ('var:reward_probabilities_L' in df.columns) and ('Block_number' in df.columns):
+    #     probs_l = df['var:reward_probabilities_L'][0]
+    #     probs_r = df['var:reward_probabilities_R'][0]
+    #     df['reward_p_L'] = np.nan
+    #     df['reward_p_R'] = np.nan
+    #     if ('var:reward_probabilities_M' in df.columns) and ('Block_number' in df.columns):
+    #         probs_m = df['var:reward_probabilities_M'][0]
+    #         df['reward_p_M'] = np.nan
+    #     for blocknum in df['Block_number'].unique():
+    #         if not np.isnan(blocknum):
+    #             df.loc[df['Block_number'] == blocknum, 'reward_p_L'] = probs_l[int(blocknum - 1)]
+    #             df.loc[df['Block_number'] == blocknum, 'reward_p_R'] = probs_r[int(blocknum - 1)]
+    #             if ('var:reward_probabilities_M' in df.columns) and ('Block_number' in df.columns):
+    #                 df.loc[df['Block_number'] == blocknum, 'reward_p_M'] = probs_m[int(blocknum - 1)]
+                    
+    return df
@@ -0,0 +1,126 @@
+import csv
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+import datajoint as dj
+
+from .dir_index import DirectoryIndex
+
+
+log = logging.getLogger(__name__)
+
+# pybpod project layout: <project>/experiments/<experiment>/setups/<setup>/sessions/<session>/<session>.csv
+_bpod_project_layout = ('experiments', None, 'setups', None, 'sessions', None)
+
+_bpod_session_index = None
+
+
+class BpodSessionIndex(DirectoryIndex):
+    '''
+    BpodSessionIndex: index of the pybpod sessions of a set of pybpod projects,
+    with the subject and start time read from the header of each session csv file
+
+    Sessions are looked up by (water restriction number, session date) - see `get_sessions`
+    '''
+
+    header_rows = 6  # rows preceding the column names in the pybpod csv files
+    max_scanned_rows = 200  # of a csv file, to find its subject and start time
+
+    def __init__(self, roots, index_file=None):
+        super().__init__(roots, index_file)
+        self._sessions = None
+
+    def skip_dir(self, root, dirpath):
+        parts = dirpath.relative_to(root).parts
+        return (len(parts) > len(_bpod_project_layout)
+                or _bpod_project_layout[len(parts) - 1] not in (None, parts[-1]))
+
+    def scan_file(self, root, dirpath, filename):
+        parts = dirpath.relative_to(root).parts
+        if len(parts) != len(_bpod_project_layout) or filename != dirpath.name + '.csv':
+            return None
+
+        csvfilename = dirpath / filename
+        subject, started = self.read_csv_header(csvfilename)
+        csv_stat = csvfilename.stat()
+        return {'path': dirpath.as_posix(),
+                'project': root.name,
+                'experiment': parts[1],
+                'setup_name': parts[3],
+                'session_name': dirpath.name,
+                'subject': subject,
+                'started': started,
+                'size': csv_stat.st_size,
+                'mtime': csv_stat.st_mtime_ns}
+
+    @classmethod
+    def read_csv_header(cls, csvfilename):
+        '''
+        subject and start time (first PC-TIME) of a pybpod session csv file
+        :return: (subject, started) - raises ValueError if not found within `max_scanned_rows`
+        '''
+        subject, started = None, None
+        with open(csvfilename, newline='') as f:
+            for _ in range(cls.header_rows):
+                f.readline()
+            reader = csv.reader(f, delimiter=';')
+            columns = next(reader)
+            msg_idx, info_idx, time_idx = (columns.index(c) for c in ('MSG', '+INFO', 'PC-TIME'))
+            for row_idx, row in enumerate(reader):
+                if row_idx >= cls.max_scanned_rows or (subject and started):
+                    break
+                if len(row) <= max(msg_idx, info_idx, time_idx):
+                    continue
+                if started is None and row[time_idx]:
+                    pc_time = row[time_idx] if '.' in row[time_idx] else row[time_idx] + '.000000'
+                    started = datetime.strptime(pc_time, '%Y-%m-%d %H:%M:%S.%f')
+                if subject is None and row[msg_idx] == 'SUBJECT-NAME':
+                    tempstr = row[info_idx]
+                    subject = tempstr[2:tempstr[2:].find("'") + 2]  # as in foraging_bpod
+
+        if not (subject and started):
+            raise ValueError('No subject/start time found in {}'.format(csvfilename))
+        return subject, started
+
+    def refresh(self):
+        rescanned = super().refresh()
+        self._sessions = None
+        return rescanned
+
+    def get_sessions(self, water_restriction_number, session_date):
+        '''
+        records of the pybpod sessions of a subject on a given date, sorted by start time
+        :param session_date: date, or 'YYYYMMDD' string
+        '''
+        if self._sessions is None:
+            sessions = defaultdict(list)
+            for rec in self.records:
+                sessions[(rec['subject'], rec['session_name'][:8])].append(rec)
+            self._sessions = {k: sorted(v, key=lambda rec: rec['started'])
+                              for k, v in sessions.items()}
+
+        if not isinstance(session_date, str):
+            session_date = session_date.strftime('%Y%m%d')
+        return self._sessions.get((water_restriction_number, session_date), [])
+
+
+def get_bpod_session_index(refresh=False):
+    '''
+    BpodSessionIndex of dj.config['custom']['behavior_bpod']['project_paths'] (refreshed on creation),
+    kept on disk at dj.config['custom']['behavior_bpod']['session_index'] if set
+    :param refresh: refresh an existing index
+    '''
+    global _bpod_session_index
+
+    if _bpod_session_index is None:
+        bpod_config = dj.config['custom'].get('behavior_bpod', {})
+        _bpod_session_index = BpodSessionIndex(bpod_config.get('project_paths', []),
+                                               bpod_config.get('session_index'))
+        refresh = True
+
+    if refresh:
+        log.info('------ Refreshing pybpod session index -------')
+        _bpod_session_index.refresh()
+
+    return _bpod_session_index
@@ -0,0 +1,302 @@
+"""
+Trial-level rows of a pybpod session (BehaviorBpodIngest), built from its parsed csv file (no database access)
+"""
+
+import decimal
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pipeline import dict_to_hash
+
+log = logging.getLogger(__name__)
+
+water_port_name_mapper = {'left': 'L', 'right': 'R', 'middle': 'M'}
+
+
+def build_trial_rows(df_behavior_session, session_start_time, task, task_protocol,
+                     lick_ports, water_port_channels, subject_trial_count, trial_state):
+    """
+    Build the trial-level rows of one bpod session, as columns (dict of lists) per table
+    - without the session key, in a single pass over the trials of the session:
+    rows of interest are located once for the whole session (sorted row indices per state/message),
+    and each trial only looks up the ranges of those falling within its rows
+    :param subject_trial_count: number of SessionTrial of this subject prior to this session (for trial_uid)
+    :param trial_state: {'trial_num', 'gocue_time', 'blocks'} - carried over across the bpod sessions
+        of the same datajoint session, and updated here
+    :return: dict of rows per table - or None if the csv file is missing required information
+    """
+    df = df_behavior_session
+    msg, typ, info = df['MSG'].values, df['TYPE'].values, df['+INFO'].values
+    initial_times = df['BPOD-INITIAL-TIME'].values.astype(float)
+    final_times = df['BPOD-FINAL-TIME'].values.astype(float)
+
+    trial_start_idxs = df[(df['TYPE'] == 'TRIAL') & (df['MSG'] == 'New trial')].index
+    trial_start_idxs -= 2  # To reflect the change that bitcode is moved before the "New trial" line
+    trial_start_idxs = pd.Index([0]).append(trial_start_idxs[1:])  # so the random seed will be present
+    trial_end_idxs = trial_start_idxs[1:].append(pd.Index([(max(df.index))]))
+
+    def find(mask):
+        return np.flatnonzero(mask)
+
+    def in_trial(positions, start, end):
+        """ the positions within rows [start, end] of a trial (both inclusive) """
+        return positions[np.searchsorted(positions, start):np.searchsorted(positions, end, side='right')]
+
+    is_state, is_transition = typ == 'STATE', typ == 'TRANSITION'
+    gocue_idx = find(is_state & (msg == 'GoCue'))
+    seed_idx, bitcode_idx = find(msg == 'Random seed:'), find(msg == 'TrialBitCode: ')
+
+    # bpod states of interest (all events except licks), with BPOD-INITIAL-TIME and BPOD-FINAL-TIME
+    # (all relative to bpod-trialstart)
+    bpod_states_of_interest = {  # experiment.TrialEventType: Bpod state name
+        'videostart': ['ITIBeforeVideoOn'],
+        'bitcodestart': ['Start'],
+        'delay': ['DelayStart'],  # (1) in a non early lick trial, effective delay start = max(DelayStart, LickportInPosition).
+                                  #       where LickportIntInPosition is only available from NIDQ
+                                  # (2) in an early lick trial, there are multiple DelayStarts, the last of which is the effective delay start
+        'go': ['GoCue'],
+        'choice': [f'Choice_{lickport}' for lickport in water_port_name_mapper.values()],
+        'reward': [f'Reward_{lickport}' for lickport in water_port_name_mapper.values()],
+        'doubledip': ['Double_dipped'],  # Only for non-double-dipped trials, ITI = last lick + 1 sec (maybe I should not use double dipping punishment for ehpys?)
+        'trialend': ['ITI'],
+        'videoend': ['ITIAfterVideoOff'],
+    }
+    event_types = list(bpod_states_of_interest)
+    state_event_type = {state: i for i, states in enumerate(bpod_states_of_interest.values()) for state in states}
+    state_idx = find(is_state & (initial_times > 0) & np.isin(msg, list(state_event_type)))
+    state_type = np.array([state_event_type[m] for m in msg[state_idx]], dtype=int)
+    # Workaround for bug #9: BPod protocol was paused and then resumed after an impossible long period of time (> decimal(8, 4)).
+    state_initial = np.minimum(initial_times[state_idx], 9999)
+    state_final = np.minimum(final_times[state_idx], 9999)
+
+    # licks (use EVENT instead of STATE because not all licks triggered a state change)
+    lick_idx = {lick_port: find(info == water_port_channels[lick_port]) for lick_port in lick_ports}
+    choice_idx = {lick_port: find(is_transition & (msg == 'Choice_{}'.format(water_port_name_mapper[lick_port])))
+                  for lick_port in lick_ports}
+    reward_idx = {lick_port: find(is_transition & (msg == 'Reward_{}'.format(water_port_name_mapper[lick_port])))
+                  for lick_port in lick_ports}
+    auto_water_idx = {lick_port: find(is_state & (msg == 'Auto_Water_{}'.format(water_port_name_mapper[lick_port])))
+                      for lick_port in lick_ports}
+
+    # per-trial values, taken from the first row of the trial
+    block_numbers = df['Block_number'].values if 'Block_number' in df else None
+    reward_vars = {lick_port: 'reward_{}_accumulated'.format(water_port_name_mapper[lick_port])
+                   for lick_port in lick_ports}
+    motor_vars = {attr: varname for attr, varname in (
+        ('water_port_lateral_pos', 'var_motor:LickPort_Lateral_pos'),
+        ('water_port_rostrocaudal_pos', 'var_motor:LickPort_RostroCaudal_pos'),
+        ('water_port_dorsoventral_pos', 'var_motor:LickPort_DorsoVentral_pos')) if varname in df}
+    valve_open_vars = {lick_port: 'var:ValveOpenTime_{}'.format(water_port_name_mapper[lick_port])
+                       for lick_port in lick_ports}
+    valve_open_vars = {k: v for k, v in valve_open_vars.items() if v in df}
+
+    rows = {'sess_trial': {'trial': [], 'trial_uid': [], 'start_time': [], 'stop_time': []},
+            'behavior_trial': {'trial': [], 'task': [], 'task_protocol': [], 'trial_instruction': [],
+                               'early_lick': [], 'outcome': [], 'auto_water': [], 'free_water': []},
+            'trial_note': {'trial': [], 'trial_note_type': [], 'trial_note': []},
+            'sess_block': [],
+            'sess_block_trial': {'trial': [], 'block': []},
+            'trial_choice': {'trial': [], 'water_port': []},
+            'trial_event': {'trial': [], 'trial_event_id': [], 'trial_event_type': [],
+                            'trial_event_time': [], 'duration': []},
+            'action_event': {'trial': [], 'action_event_id': [], 'action_event_type': [],
+                             'action_event_time': []},
+            'valve_setting': {'trial': [], **{attr: [] for attr in motor_vars}},
+            'valve_open_dur': {'trial': [], 'water_port': [], 'open_duration': []},
+            'available_reward': {'trial': [], 'water_port': [], 'reward_available': []}}
+    for tbl in ('photostim', 'photostim_location', 'photostim_trial', 'photostim_trial_event'):
+        rows[tbl] = {}
+
+    def append(tbl, **values):
+        for k, v in values.items():
+            rows[tbl][k].append(v)
+
+    blocknum_local_prev = np.nan
+    session_blocks = []
+
+    for trial_start_idx, trial_end_idx in zip(trial_start_idxs, trial_end_idxs):
+
+        # Trials without GoCue are skipped
+        if not len(in_trial(gocue_idx, trial_start_idx, trial_end_idx)):
+            continue
+
+        missing_vars = [v for v in reward_vars.values() if v not in df]
+        if missing_vars:
+            log.error('Bpod CSV KeyError: {} - Available columns: {}'.format(missing_vars[0], df.columns))
+            return None
+
+        # ---- session trial ----
+        trial_state['trial_num'] += 1  # increment trial number
+        trial = trial_state['trial_num']
+
+        # Note that the following trial_start/stop_time SHOULD NEVER BE USED in ephys related analysis
+        # because they are PC-TIME, which is not accurate (4 ms average delay, sometimes up to several seconds!)!
+        # In fact, from bpod.csv, we can only accurately retrieve (local) trial-wise, but not (global) session-wise, times
+        # See comments below.
+        trial_start_time = df['PC-TIME'][trial_start_idx].to_pydatetime() - session_start_time
+        trial_stop_time = df['PC-TIME'][trial_end_idx].to_pydatetime() - session_start_time
+
+        append('sess_trial', trial=trial, trial_uid=subject_trial_count + trial,
+               start_time=trial_start_time.total_seconds(), stop_time=trial_stop_time.total_seconds())
+
+        # ---- session block ----
+        if block_numbers is not None:
+            if np.isnan(block_numbers[trial_start_idx]):
+                blocknum_local = 0 if np.isnan(blocknum_local_prev) else blocknum_local_prev
+            else:
+                blocknum_local = int(block_numbers[trial_start_idx]) - 1
+                blocknum_local_prev = blocknum_local
+
+            reward_probability = {}
+            for lick_port in lick_ports:
+                p_reward_varname = 'var:reward_probabilities_{}'.format(
+                    water_port_name_mapper[lick_port])
+                reward_probability[lick_port] = decimal.Decimal(
+                    df[p_reward_varname][0][blocknum_local]).quantize(
+                    decimal.Decimal('.001'))  # Note: Reward probabilities never changes during a **bpod** session
+
+            # determine if this is a new block: compare reward probability with the previous block
+            if session_blocks:
+                itsanewblock = dict_to_hash(reward_probability) != dict_to_hash(
+                    session_blocks[-1]['reward_probability'])
+            else:
+                itsanewblock = True
+
+            if itsanewblock:
+                all_blocks = [b['block'] for b in session_blocks + trial_state['blocks']]
+                block_num = (np.max(all_blocks) + 1 if all_blocks else 1)
+                session_blocks.append({'block': block_num,
+                                       'block_start_time': trial_start_time.total_seconds(),
+                                       'reward_probability': reward_probability})
+            else:
+                block_num = session_blocks[-1]['block']
+
+            append('sess_block_trial', trial=trial, block=block_num)
+
+        # ====== Event times ======
+        # Foraging trial structure: (*...*: events of interest in experiment.EventType; [...]: optional)
+        # -> (ITI) -> *bitcodestart* -> bitcode -> lickport movement -> *delay* (lickport in position) 
+        #          -> [effective delay period] -> *go* -> [*choice*] -> [*reward*] -> *trialend* -> (ITI) ->
+        # Notes:
+        # 1. Differs from the delay-task:
+        #       (1) no sample and presample epoch
+        #       (2) effective delay period could be zero (ITI as an inherent delay). 
+        #           Also note that if the delay_period in bpod protocol < lickport movement time (~100 ms), the effective delay period is also zero, 
+        #           where the go-cue sound actually appears BEFORE the lickport stops moving.
+        #       (3) we are interested in not only go-cue aligned PSTH (ephys.Unit.TrialSpikes), but need more flexible event alignments, especially ITI firings.
+        #           So we should use the session-wise untrialized spike times stored in ephys.Unit['spike_times']. See below.
+        # 2. Two "trial start"s:
+        #       (1) *bitcodestart* = onset of the first bitcode = *sTrig* in NIDQ bitcode.mat
+        #       (2) `trial_start_idx` in this for loop = the start of bpod-trial ('New Trial' in bpod csv file)
+        #            = the reference point of BPOD-TIME  = NIDQ bpod-trial channel
+        #    They are far from each other because I start the bpod trial at the middle of ITI (Foraging_bpod: e9a8ffd6) to cover video recording during ITI.
+        # 3. In theory, *bitcodestart* = *delay* (since there's no sample period),
+        #    but in practice, the bitcode (21*20=420 ms) and lickport movement (~100 ms) also take some time.
+        #    Note that bpod doesn't know the exact time when lickports are in place, so we can get *delay* only from NIDQ zaber channel (ephys.TrialEvent.'zaberinposition').
+        # 4. In early lick trials, effective delay start should be the last 'DelayStart' (?)
+        # 5. Finally, to perform session-wise alignment between behavior and ephys, there are two ways, which could be cross-checked with each other:
+        #       (1) (most straightforward) use all event markers directly from NIDQ bitcode.mat,
+        #           then align them to ephys.Unit['spike_times'] by looking at the *sTrig* of the first trial of a session
+        #       (2) (can be used as a sanity check) extract trial-wise BPOD-TIME from pybpod.csv,
+        #           and then convert the local trial-wise times to global session-wise times by aligning
+        #           the same events from pybpod.csv and bitcode.mat across all trials, e.g., *bitcodestart* <--> *sTrig*, or 0 <--> NIDQ bpod-"trial trigger" channel
+        #    Note that one should NEVER use PC-TIME from the bpod csv files (at least for ephys-related alignment)!!!
+
+        # ----- BPOD STATES (all events except licks) -----
+        # events ordered by event type then by time - one state could have multiple appearances,
+        # such as DelayStart in early-lick trials
+        trial_states = slice(np.searchsorted(state_idx, trial_start_idx),
+                             np.searchsorted(state_idx, trial_end_idx, side='right'))
+        event_order = np.argsort(state_type[trial_states], kind='stable')
+        event_type = state_type[trial_states][event_order]
+        initials = state_initial[trial_states][event_order]
+        finals = state_final[trial_states][event_order]
+
+        rows['trial_event']['trial'].extend([trial] * len(event_type))
+        rows['trial_event']['trial_event_id'].extend(range(len(event_type)))
+        rows['trial_event']['trial_event_type'].extend(event_types[t] for t in event_type)
+        rows['trial_event']['trial_event_time'].extend(initials.tolist())
+        rows['trial_event']['duration'].extend((finals - initials).tolist())
+
+        # save gocue time for early-lick below
+        if (event_type == event_types.index('go')).any():
+            trial_state['gocue_time'] = initials[np.argmax(event_type == event_types.index('go'))]
+
+        # ------ Licks -------
+        lick_times = {lick_port: initial_times[in_trial(lick_idx[lick_port], trial_start_idx, trial_end_idx)]
+                      for lick_port in lick_ports}
+
+        all_lick_types = np.concatenate([[ltype] * len(ltimes) for ltype, ltimes in lick_times.items()])
+        all_lick_times = np.concatenate([ltimes for ltimes in lick_times.values()])
+
+        # sort by lick times
+        lick_order = np.argsort(all_lick_times, kind='stable')
+        rows['action_event']['trial'].extend([trial] * len(lick_order))
+        rows['action_event']['action_event_id'].extend(range(len(lick_order)))
+        rows['action_event']['action_event_type'].extend(
+            '{} lick'.format(ltype) for ltype in all_lick_types[lick_order])
+        rows['action_event']['action_event_time'].extend(all_lick_times[lick_order].tolist())
+
+        # ====== Trial facts (nontemporal) ======
+        # WaterPort Choice
+        water_port = next((lick_port for lick_port in lick_ports
+                           if len(in_trial(choice_idx[lick_port], trial_start_idx, trial_end_idx))), None)
+        append('trial_choice', trial=trial, water_port=water_port)
+
+        # early lick
+        early_lick = 'early' if any(all_lick_times < trial_state['gocue_time']) else 'no early'
+
+        # outcome
+        outcome = 'miss' if water_port else 'ignore'
+        if any(len(in_trial(reward_idx[lick_port], trial_start_idx, trial_end_idx)) for lick_port in lick_ports):
+            outcome = 'hit'
+
+        # ---- accumulated reward ----
+        for lick_port in lick_ports:
+            reward = df[reward_vars[lick_port]].values[trial_start_idx]
+            append('available_reward', trial=trial, water_port=lick_port,
+                   reward_available=False if np.isnan(reward) else bool(reward))
+
+        # ---- auto water and notes ----
+        auto_water_times = {}
+        for lick_port in lick_ports:
+            auto_water_ind = in_trial(auto_water_idx[lick_port], trial_start_idx, trial_end_idx)
+            if len(auto_water_ind):
+                auto_water_times[lick_port] = float(info[auto_water_ind[0]])
+        auto_water = bool(auto_water_times)
+
+        if auto_water_times:
+            auto_water_ports = [k for k, v in auto_water_times.items() if v > 0.001]
+            append('trial_note', trial=trial, trial_note_type='autowater',
+                   trial_note='and '.join(auto_water_ports))
+
+        # add random seed start note
+        trial_seed_idx = in_trial(seed_idx, trial_start_idx, trial_end_idx)
+        if len(trial_seed_idx):
+            append('trial_note', trial=trial, trial_note_type='random_seed_start',
+                   trial_note=str(msg[trial_seed_idx[0] + 1]))
+
+        # add randomID (TrialBitCode)
+        trial_bitcode_idx = in_trial(bitcode_idx, trial_start_idx, trial_end_idx)
+        if len(trial_bitcode_idx):
+            append('trial_note', trial=trial, trial_note_type='bitcode',
+                   trial_note=str(msg[trial_bitcode_idx[0] + 1]))
+
+        # ---- Behavior Trial ----
+        append('behavior_trial', trial=trial, task=task, task_protocol=task_protocol,
+               trial_instruction='none', early_lick=early_lick, outcome=outcome,
+               auto_water=auto_water, free_water=False)  # TODO: verify this
+
+        # ---- Water Valve Setting ----
+        append('valve_setting', trial=trial, **{attr: df[varname].values[trial_start_idx]
+                                                for attr, varname in motor_vars.items()})
+
+        for lick_port, valve_open_varname in valve_open_vars.items():
+            append('valve_open_dur', trial=trial, water_port=lick_port,
+                   open_duration=df[valve_open_varname].values[trial_start_idx])
+
+    rows['sess_block'] = session_blocks
+    trial_state['blocks'].extend(session_blocks)
+    return rows
@@ -0,0 +1,117 @@
+import abc
+import logging
+import os
+import pathlib
+import pickle
+
+
+log = logging.getLogger(__name__)
+
+
+class DirectoryIndex(abc.ABC):
+    '''
+    DirectoryIndex: a persistent, incrementally refreshed index of the files
+    found under a set of root directories
+
+    Each directory is listed once, then only again when its mtime changes -
+    unchanged directories reuse their cached subdirectories and file records.
+    File records are built by `scan_file`, an abstract method of subclasses;
+    a directory with a file that `scan_file` fails on (e.g. still being written)
+    is rescanned on the next refresh.
+
+    With `index_file`, the index is kept on disk across processes.
+
+    Note: a file modified in place does not change the mtime of its directory,
+    records are therefore only refreshed on files being added/removed/renamed.
+    '''
+
+    version = 1
+
+    def __init__(self, roots, index_file=None):
+        self.roots = [pathlib.Path(r) for r in roots]
+        self.index_file = pathlib.Path(index_file) if index_file else None
+        self._dirs = {}  # dirpath -> (mtime, subdirs, records)
+
+        if self.index_file is not None and self.index_file.exists():
+            try:
+                with open(self.index_file, 'rb') as f:
+                    index = pickle.load(f)
+                if index['version'] == self.version and index['class'] == type(self).__name__:
+                    self._dirs = index['dirs']
+            except Exception as e:
+                log.warning('Unable to load index {} ({}) - rebuilding'.format(self.index_file, repr(e)))
+
+    @abc.abstractmethod
+    def scan_file(self, root, dirpath, filename):
+        '''
+        record (dict) of the file `filename` in `dirpath` (under `root`), or None to skip the file
+        '''
+
+    def skip_dir(self, root, dirpath):
+        '''
+        whether to skip (not descend into) `dirpath`
+        '''
+        return False
+
+    def refresh(self):
+        '''
+        rescan the directories whose mtime changed since the last scan, and save the index
+        :return: number of directories (re)scanned
+        '''
+        dirs, rescanned = {}, 0
+        for root in self.roots:
+            if not root.is_dir():
+                log.warning('Directory not found: {}'.format(root))
+                continue
+            stack = [root]
+            while stack:
+                dirpath = stack.pop()
+                try:
+                    mtime = dirpath.stat().st_mtime_ns
+                except OSError:
+                    continue
+                cached = self._dirs.get(dirpath.as_posix())
+                if cached is not None and cached[0] == mtime:
+                    _, subdirs, records = cached
+                else:
+                    subdirs, records, complete = self._scan_dir(root, dirpath)
+                    mtime = mtime if complete else None
+                    rescanned += 1
+                dirs[dirpath.as_posix()] = (mtime, subdirs, records)
+                stack.extend(dirpath / d for d in subdirs)
+
+        self._dirs = dirs
+        log.info('{}: {} directories, {} rescanned'.format(type(self).__name__, len(dirs), rescanned))
+        if self.index_file is not None and rescanned:
+            self.save()
+        return rescanned
+
+    def _scan_dir(self, root, dirpath):
+        subdirs, records, complete = [], [], True
+        with os.scandir(dirpath) as entries:
+            entries = sorted(entries, key=lambda e: e.name)
+            for entry in entries:
+                if entry.is_dir():
+                    if not self.skip_dir(root, pathlib.Path(entry.path)):
+                        subdirs.append(entry.name)
+                elif entry.is_file():
+                    try:
+                        rec = self.scan_file(root, dirpath, entry.name)
+                    except Exception as e:
+                        log.debug('{} skipped - {}'.format(entry.path, repr(e)))
+                        complete = False
+                        continue
+                    if rec is not None:
+                        records.append(rec)
+        return sorted(subdirs), records, complete
+
+    def save(self):
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_suffix('.{}.tmp'.format(os.getpid()))  # concurrent refreshes of the index
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'version': self.version, 'class': type(self).__name__, 'dirs': self._dirs}, f)
+        tmp_file.replace(self.index_file)
+
+    @property
+    def records(self):
+        return [rec for _, _, records in self._dirs.values() for rec in records]
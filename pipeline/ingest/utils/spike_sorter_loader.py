@@ -1,4 +1,5 @@
 import logging
+import multiprocessing as mp
 import pathlib
 from datetime import datetime
 from os import path
@@ -7,6 +8,7 @@ from tqdm import tqdm
 import re
 import pandas as pd
 import scipy.io as spio
+from scipy import signal
 import h5py
 import numpy as np
 import datajoint as dj
@@ -14,6 +16,7 @@ import datajoint as dj
 from ... import get_schema_name
 from .. import BitCodeError
 from . import readSGLX
+from .bitcodes import decode_bitcodes, match_bitcodes
 
 log = logging.getLogger(__name__)
 
@@ -248,7 +251,8 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
 
     # ---- Unit-level results ----
     # -- Remove 0-spike units
-    withspike_idx = [i for i, u in enumerate(ks.data['cluster_ids']) if (ks.data['spike_clusters'] == u).any()]
+    cluster_summary = ks.cluster_summary()
+    withspike_idx = np.flatnonzero(np.isin(ks.data['cluster_ids'], cluster_summary.index))
 
     valid_units = ks.data['cluster_ids'][withspike_idx]
     valid_unit_labels = ks.data['cluster_groups'][withspike_idx]
@@ -278,8 +282,9 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
         unit_wav = unit_wav[np.ix_(metrics.index, ks.data['channel_map'], range(unit_wav.shape[-1]))]  # unit x channel x sample
     else:
         vmax_unit_site, unit_xpos, unit_ypos, unit_amp = [], [], [], []
-        for unit in valid_units:
-            template_idx = ks.data['spike_templates'][np.where(ks.data['spike_clusters'] == unit)[0][0]]
+        unit_summary = cluster_summary.loc[valid_units]
+        for first_spike, mean_amp in zip(unit_summary.first_spike, unit_summary.mean_amplitude):
+            template_idx = ks.data['spike_templates'][first_spike]
             chn_templates = ks.data['templates'][template_idx, :, :]
             site_idx = np.abs(np.abs(chn_templates).max(axis=0)).argmax()
             vmax_unit_site.append(ks.data['channel_map'][site_idx])
@@ -287,9 +292,8 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
             unit_xpos.append(ks.data['channel_positions'][site_idx, 0])
             unit_ypos.append(ks.data['channel_positions'][site_idx, 1])
             # unit amp
-            amps = ks.data['amplitudes'][ks.data['spike_clusters'] == unit]
             scaled_templates = np.matmul(chn_templates, ks.data['whitening_mat_inv'])
-            best_chn_wf = scaled_templates[:, site_idx] * amps.mean()
+            best_chn_wf = scaled_templates[:, site_idx] * mean_amp
             unit_amp.append(best_chn_wf.max() - best_chn_wf.min())
 
         # waveforms and SNR
@@ -440,19 +444,8 @@ def read_bitcode(bitcode_dir, h2o, skey):
                                         ' "*.XA_0_0.txt"'
                                         ' found in {}'.format(bitcode_dir))
         else:
-            ephys_bitcodes, trial_numbers, ephys_trial_start_times, ephys_trial_ref_times = [], [], [], []
-            for bitcode, start_time in zip(bitcodes, trial_start_times):
-                matched_trial_idx = np.where(behavior_bitcodes == bitcode)[0]
-                if len(matched_trial_idx):
-                    matched_trial_idx = matched_trial_idx[0]
-                    ephys_trial_start_times.append(start_time)
-                    ephys_bitcodes.append(bitcode)
-                    trial_numbers.append(behav_trials[matched_trial_idx])
-                    ephys_trial_ref_times.append(start_time + go_times[matched_trial_idx])
-
-            ephys_trial_ref_times = np.array(ephys_trial_ref_times)
-            trial_numbers = np.array(trial_numbers)
-            ephys_trial_start_times = np.array(ephys_trial_start_times)
+            ephys_bitcodes, trial_numbers, ephys_trial_start_times, ephys_trial_ref_times = match_bitcodes(
+                bitcodes, trial_start_times, behavior_bitcodes, behav_trials, go_times)
 
     else:
         raise ValueError('Unknown bitcode format: {}'.format(bitcode_format))
@@ -461,9 +454,6 @@ def read_bitcode(bitcode_dir, h2o, skey):
 
 
 def build_bitcode(bitcode_dir):
-    time_to_first_high_bit = 0.05
-    inter_bit_interval = 0.007
-
     bitcode_dir = pathlib.Path(bitcode_dir)
 
     # trial-start file
@@ -502,18 +492,7 @@ def build_bitcode(bitcode_dir):
             bitcode_times = bitcode_times.strip().split('\n')
             bitcode_times = np.array(bitcode_times).astype(float)
 
-        trial_ends = np.concatenate([trial_starts[1:], [trial_starts[-1] + 99]])  # the last trial to be arbitrarily long
-        bitcodes = []
-        for trial_start, trial_end in zip(trial_starts, trial_ends):
-            trial_bitcode_times = bitcode_times[np.logical_and(bitcode_times >= trial_start,
-                                                               bitcode_times < trial_end)]
-            trial_bitcode_times = np.concatenate(
-                [[trial_start + time_to_first_high_bit - inter_bit_interval], trial_bitcode_times])
-            high_bit_ind = np.cumsum(np.round(np.diff(trial_bitcode_times) / inter_bit_interval)).astype(int) - 1
-            bitcode = np.zeros(10).astype(int)
-            bitcode[high_bit_ind] = 1
-            bitcode = ''.join(bitcode.astype(str))
-            bitcodes.append(bitcode)
+        bitcodes = decode_bitcodes(trial_starts, bitcode_times)
 
     return bitcodes, trial_starts
 
@@ -577,6 +556,20 @@ class SpikeGLXMeta:
         self.shankmap = self._parse_shankmap(self.meta['~snsShankMap']) if '~snsShankMap' in self.meta else None
         self.imroTbl = self._parse_imrotbl(self.meta['~imroTbl']) if '~imroTbl' in self.meta else None
 
+        # Channels being recorded, exclude Sync channels - basically a 1-1 mapping to shankmap
+        self.recording_channels = (np.arange(len(self.imroTbl['data']))[
+                                       self.get_recording_channels_indices(exclude_sync=True)]
+                                   if self.imroTbl and self.chanmap else None)
+
+    def get_recording_channels_indices(self, exclude_sync=False):
+        """
+        The indices of recorded channels (in chanmap) with respect to the channels listed in the imro table
+        """
+        recording_channels = [int(v[0]) for k, v in self.chanmap.items()
+                              if k != 'shape' and (not k.startswith('SY') if exclude_sync else True)]
+        orig_channel_idx = [v[0] for v in self.imroTbl['data']]
+        return [orig_channel_idx.index(chn) for chn in recording_channels]
+
     @staticmethod
     def _parse_chanmap(raw):
         '''
@@ -758,6 +751,35 @@ class SpikeGLX:
 
         return vmax / imax / chn_gains * 1e6  # convert to uV as well
 
+    def stream_lf_timeseries(self, channel_ind, chunk_samples, decimation=1):
+        """
+        LFP data (in uV) at the `channel_ind` channels, read in time chunks of
+        `chunk_samples` samples - i.e. with memory bounded by the chunk size
+        :param decimation: integer downsampling factor - with the zero-phase FIR anti-aliasing
+            filter of scipy.signal.decimate(..., ftype='fir'), applied across chunk boundaries
+        :return: generator of (sample x channel) chunks
+        """
+        data = self.lf_timeseries
+        channel_bit_volts = self.get_channel_bit_volts('lf')[channel_ind]
+        n_samples = data.shape[0]
+
+        pad = 0
+        if decimation > 1:
+            aa_filter = signal.firwin(20 * decimation + 1, 1. / decimation, window='hamming')
+            # chunk edges and padding on the decimation grid, padding covering the filter
+            pad = int(np.ceil(len(aa_filter) / decimation)) * decimation
+            chunk_samples = max(1, chunk_samples // decimation) * decimation
+
+        for start in range(0, n_samples, chunk_samples):
+            stop = min(start + chunk_samples, n_samples)
+            first, last = max(start - pad, 0), min(stop + pad, n_samples)
+            chunk = data[first:last, channel_ind] * channel_bit_volts
+            if decimation > 1:
+                chunk = signal.resample_poly(chunk, 1, decimation, axis=0, window=aa_filter)
+                offset = (start - first) // decimation
+                chunk = chunk[offset:offset + -(-(stop - start) // decimation)]
+            yield chunk
+
     def _read_bin(self, fname):
         nchan = self.apmeta.meta['nSavedChans']
         dtype = np.dtype((np.int16, nchan))
@@ -781,13 +803,11 @@ class SpikeGLX:
                                        spikes < data.shape[0] - wf_win[-1])]
 
         np.random.shuffle(spikes)
-        spikes = spikes[:n_wf]
+        spikes = np.sort(spikes[:n_wf])
         if len(spikes) > 0:
-            # waveform at each spike: (sample x channel x spike)
-            spike_wfs = np.dstack([data[int(spk + wf_win[0]):int(spk + wf_win[-1]),
-                                   channel_ind] * channel_bit_volts
-                                   for spk in spikes])
-            return spike_wfs
+            # waveform at each spike, read in file order: (sample x channel x spike)
+            spike_wfs = np.concatenate([wfs for _, wfs in _read_spike_windows(data, spikes, wf_win, channel_ind)])
+            return (spike_wfs * channel_bit_volts).transpose((1, 2, 0))
         else:  # if no spike found, return NaN of size (sample x channel x 1)
             return np.full((len(range(*wf_win)), len(channel_ind), 1), np.nan)
 
@@ -868,6 +888,7 @@ class Kilosort:
         self._files = {}
         self._data = None
         self._clusters = None
+        self._cluster_summary = None
 
         self._info = {'time_created': datetime.fromtimestamp((kilosort_dir / 'params.py').stat().st_ctime),
                       'time_modified': datetime.fromtimestamp((kilosort_dir / 'params.py').stat().st_mtime)}
@@ -921,6 +942,25 @@ class Kilosort:
         else:
             raise FileNotFoundError('Neither cluster_groups.csv nor cluster_KSLabel.tsv found!')
 
+    def cluster_summary(self):
+        """
+        One-pass summary of the spikes per cluster - pd.DataFrame indexed by cluster id
+        (clusters with spikes only, sorted), with columns:
+            + first_spike: index of the first spike of the cluster
+            + spike_count: number of spikes
+            + mean_amplitude: mean spike amplitude (template scaling)
+        """
+        if self._cluster_summary is None:
+            cluster_ids, first_spike, spike_cluster_ind, spike_count = np.unique(
+                self.data['spike_clusters'], return_index=True, return_inverse=True, return_counts=True)
+            amplitude_sum = np.bincount(spike_cluster_ind.ravel(), weights=self.data['amplitudes'],
+                                        minlength=len(cluster_ids))
+            self._cluster_summary = pd.DataFrame(
+                {'first_spike': first_spike, 'spike_count': spike_count,
+                 'mean_amplitude': amplitude_sum / spike_count},
+                index=pd.Index(cluster_ids, name='cluster_id'))
+        return self._cluster_summary
+
     def extract_curated_cluster_notes(self):
         curated_cluster_notes = {}
         for cluster_file in pathlib.Path(self._kilosort_dir).glob('cluster_*.tsv'):
@@ -967,14 +1007,97 @@ class Kilosort:
         self._data['spike_sites'] = self.data['channel_map'][spike_site_ind]
 
 
-def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None):
+def _sample_unit_spikes(spike_times, spike_clusters, cluster_summary, cluster_ids, n_wf, wf_win, n_samples):
+    """
+    Randomly sample up to `n_wf` spikes per cluster - grouping the spikes by cluster with one argsort
+    :param cluster_summary: output of Kilosort.cluster_summary()
+    :return: sampled spike times (sorted), index into `cluster_ids` of each sampled spike
+    """
+    order = np.argsort(spike_clusters, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(cluster_summary.spike_count.values)])
+    cluster_pos = cluster_summary.index.get_indexer(cluster_ids)
+
+    spikes, spike_units = [], []
+    for unit_idx, pos in enumerate(cluster_pos):
+        lo, hi = (offsets[pos], offsets[pos + 1]) if pos >= 0 else (0, 0)
+        unit_spikes = np.asarray(spike_times[order[lo:hi]]).astype(np.int64)
+        np.random.shuffle(unit_spikes)
+        unit_spikes = unit_spikes[:n_wf]
+        # ignore spikes at the beginning or end of raw data
+        unit_spikes = unit_spikes[np.logical_and(unit_spikes > -wf_win[0], unit_spikes < n_samples - wf_win[-1])]
+        spikes.append(unit_spikes)
+        spike_units.append(np.full(len(unit_spikes), unit_idx))
+
+    if not sum(len(unit_spikes) for unit_spikes in spikes):  # no cluster, or no spike within the raw data
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=int)
+
+    spikes, spike_units = np.concatenate(spikes), np.concatenate(spike_units)
+    order = np.argsort(spikes, kind='stable')
+    return spikes[order], spike_units[order]
+
+
+def _read_spike_windows(data, spikes, wf_win, channel_ind, chunk_samples=2 ** 16, max_gap=2 ** 12):
+    """
+    Read the waveform windows around sorted spike samples in large sequential chunks
+     rather than one small read per spike - consecutive spikes are read as one block
+     unless they are more than `max_gap` samples apart or the block spans `chunk_samples`
+    :param data: (sample x channel) raw data, e.g. np.memmap of the .ap.bin
+    :param spikes: spike samples, sorted ascending
+    :param wf_win: number of sample pre and post a spike
+    :param channel_ind: channel indices to read
+    :return: generator of (slice into `spikes`, waveforms (spike x sample x channel) as stored)
+    """
+    if not len(spikes):
+        return
+
+    window = np.arange(wf_win[0], wf_win[-1])
+
+    new_block = np.concatenate([[True], np.diff(spikes) > max_gap])
+    block_start = spikes[new_block][np.cumsum(new_block) - 1]
+    chunk_id = np.cumsum(new_block) * (spikes[-1] // chunk_samples + 1) + (spikes - block_start) // chunk_samples
+    chunk_bounds = np.concatenate([[0], np.flatnonzero(np.diff(chunk_id)) + 1, [len(spikes)]])
+
+    for lo, hi in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+        first_sample = spikes[lo] + wf_win[0]
+        block = np.asarray(data[first_sample:spikes[hi - 1] + wf_win[-1]])[:, channel_ind]
+        yield slice(lo, hi), block[(spikes[lo:hi] - spikes[lo])[:, None] + window - wf_win[0]]
+
+
+def _accumulate_waveforms(bin_fp, channel_num, channel_ind, spikes, spike_units, n_units, wf_win, bit_volts):
+    """
+    Per-unit sum of waveforms (unit x sample x channel) and sum of squared samples (unit x channel)
+     over the sampled spikes, for the `channel_ind` channels - reading the raw data in sequential chunks
+    """
+    raw_data = np.memmap(bin_fp, dtype='int16', mode='r')
+    data = np.reshape(raw_data, (int(raw_data.size / channel_num), channel_num))
+
+    wf_sum = np.zeros((n_units, wf_win[-1] - wf_win[0], len(channel_ind)))
+    wf_sqsum = np.zeros((n_units, len(channel_ind)))
+
+    for chunk, spike_wfs in _read_spike_windows(data, spikes, wf_win, channel_ind):
+        spike_wfs = spike_wfs * bit_volts
+        # group the chunk's waveforms by unit, then sum each group
+        order = np.argsort(spike_units[chunk], kind='stable')
+        units, first = np.unique(spike_units[chunk][order], return_index=True)
+        wf_sum[units] += np.add.reduceat(spike_wfs[order], first, axis=0)
+        wf_sqsum[units] += np.add.reduceat((spike_wfs[order] ** 2).sum(axis=1), first, axis=0)
+
+    return wf_sum, wf_sqsum
+
+
+def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None, n_workers=None):
     """
     :param npx_dir: directory to the ap.bin and ap.meta
     :param ks: instance of Kilosort
     :param n_wf: number of spikes per unit to extract the waveforms
     :param wf_win: number of sample pre and post a spike
     :param bit_volts: scalar required to convert int16 values into microvolts
-    :return: dictionary of the clusters' waveform (sample x channel x spike) and snr per channel for each cluster
+    :param n_workers: number of processes to split the channels over
+        - default to dj.config['custom']['ephys.waveform_workers'] (1)
+    :return: dictionary of the clusters' mean waveform (sample x channel) and snr per channel for each cluster
+
+    The sampled spikes of all clusters are read together, in file order and in large sequential chunks;
+    the mean waveform and the per-channel SNR (see `calculate_wf_snr`) are accumulated per cluster.
     """
     bin_fp = next(pathlib.Path(npx_dir).glob('*.ap.bin'))
     meta_fp = next(pathlib.Path(npx_dir).glob('*.ap.meta'))
@@ -985,30 +1108,42 @@ def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None
     if bit_volts is None:
         bit_volts = npx_bit_volts[re.match('neuropixels (\d.0)', meta.probe_model).group()]
 
-    raw_data = np.memmap(bin_fp, dtype='int16', mode='r')
-    data = np.reshape(raw_data, (int(raw_data.size / channel_num), channel_num))
+    n_samples = int(bin_fp.stat().st_size / 2 / channel_num)
+    n_workers = n_workers or dj.config['custom'].get('ephys.waveform_workers', 1)
 
     chan_map = ks.data['channel_map']
+    cluster_ids = ks.data['cluster_ids']
 
-    unit_wfs = {}
-    for unit in tqdm(ks.data['cluster_ids']):
-        spikes = ks.data['spike_times'][ks.data['spike_clusters'] == unit]
-        np.random.shuffle(spikes)
-        spikes = spikes[:n_wf]
-        # ignore spikes at the beginning or end of raw data
-        spikes = spikes[np.logical_and(spikes > wf_win[0], spikes < data.shape[0] - wf_win[-1])]
+    spikes, spike_units = _sample_unit_spikes(ks.data['spike_times'], ks.data['spike_clusters'],
+                                              ks.cluster_summary(), cluster_ids, n_wf, wf_win, n_samples)
 
-        unit_wfs[unit] = {}
-        if len(spikes) > 0:
-            # waveform at each spike: (sample x channel x spike)
-            spike_wfs = np.dstack([data[int(spk+wf_win[0]):int(spk+wf_win[-1]), chan_map] for spk in spikes])
-            spike_wfs = spike_wfs * bit_volts
-            unit_wfs[unit]['snr'] = [calculate_wf_snr(chn_wfs)
-                                     for chn_wfs in spike_wfs.transpose((1, 2, 0))]  # (channel x spike x sample)
-            unit_wfs[unit]['mean_wf'] = np.nanmean(spike_wfs, axis=2)
+    args = [(bin_fp, channel_num, chan_block, spikes, spike_units, len(cluster_ids), wf_win, bit_volts)
+            for chan_block in np.array_split(chan_map, n_workers) if len(chan_block)]
+    if n_workers > 1:
+        with mp.get_context('spawn').Pool(processes=n_workers) as pool:
+            results = pool.starmap(_accumulate_waveforms, args)
+    else:
+        results = [_accumulate_waveforms(*a) for a in args]
+
+    wf_sum = np.concatenate([r[0] for r in results], axis=2)
+    wf_sqsum = np.concatenate([r[1] for r in results], axis=1)
+
+    # mean waveform, and SNR = (peak-to-peak of the mean) / (2 * std of the residuals), per channel
+    wf_count = np.bincount(spike_units, minlength=len(cluster_ids))
+    n_wf_samples = wf_win[-1] - wf_win[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_wfs = wf_sum / wf_count[:, None, None]
+        residual_var = wf_sqsum / (wf_count[:, None] * n_wf_samples) - (mean_wfs ** 2).mean(axis=1)
+        snrs = (mean_wfs.max(axis=1) - mean_wfs.min(axis=1)) / (2 * np.sqrt(np.maximum(residual_var, 0)))
+    snrs[np.isinf(snrs)] = 0
+
+    unit_wfs = {}
+    for unit_idx, unit in enumerate(cluster_ids):
+        if wf_count[unit_idx] > 0:
+            unit_wfs[unit] = {'snr': snrs[unit_idx], 'mean_wf': mean_wfs[unit_idx]}
         else:  # if no spike found, return NaN of size (sample x channel x 1)
-            unit_wfs[unit]['snr'] = np.full((1, len(chan_map)), np.nan)
-            unit_wfs[unit]['mean_wf'] = np.full((len(range(*wf_win)), len(chan_map)), np.nan)
+            unit_wfs[unit] = {'snr': np.full((1, len(chan_map)), np.nan),
+                              'mean_wf': np.full((n_wf_samples, len(chan_map)), np.nan)}
 
     return unit_wfs
 
@@ -0,0 +1,207 @@
+# =============================================================================
+#  Population-batched predictive simulation of the bandit models
+# =============================================================================
+# Same models as BanditModel (fitting mode only), for a population of parameter vectors at once:
+# the latent variables are arrays with a leading population axis, and only the trials are iterated over.
+# Used to evaluate the likelihood of a whole differential evolution population in one call.
+#
+# Note: as in BanditModel, 'RW1972_epsi' and the greedy limit of softmax (> 700) break ties randomly.
+
+import numpy as np
+from scipy.stats import norm
+
+
+class BatchBanditModel:
+    '''
+    Predictive simulation of a bandit model for a population of parameter vectors
+    '''
+
+    supported_foragers = ['LossCounting', 'RW1972_epsi', 'RW1972_softmax', 'LNP_softmax', 'Bari2019', 'Hattori2019',
+                          'RW1972_softmax_CK', 'LNP_softmax_CK', 'Bari2019_CK', 'Hattori2019_CK',
+                          'CANN', 'Synaptic']
+
+    def __init__(self, forager, params, fit_choice_history, fit_reward_history, fit_iti=None):
+        '''
+        :param params: dict of parameter name -> (S,) values (or scalar, shared by the population),
+            with the same names and defaults as the BanditModel arguments
+        :param fit_choice_history, fit_reward_history, fit_iti: as for BanditModel
+        '''
+        assert forager in self.supported_foragers, 'Unsupported forager {}'.format(forager)
+
+        self.forager = forager
+        self.fit_choice_history = fit_choice_history
+        self.fit_reward_history = fit_reward_history
+        self.iti = fit_iti
+        self.K, self.n_trials = np.shape(fit_reward_history)
+
+        self.n_pop = max([np.size(v) for v in params.values()] + [1])
+        self.params = {k: np.broadcast_to(np.asarray(v, dtype=float), (self.n_pop,)) for k, v in params.items()}
+
+        # -- Bias terms (see BanditModel) --
+        biasL, biasR = self.param('biasL', 0), self.param('biasR', 0)
+        if forager == 'RW1972_epsi':
+            self.bias_terms = (np.stack([biasL, -biasL], axis=1) if self.K == 2
+                               else np.stack([biasL, -(biasL + biasR), biasR], axis=1))
+        elif forager != 'LossCounting':
+            self.bias_terms = (np.stack([biasL, np.zeros(self.n_pop)], axis=1) if self.K == 2
+                               else np.stack([biasL, np.zeros(self.n_pop), biasR], axis=1))
+
+        # -- Forager-dependent --
+        if 'LNP_softmax' in forager:
+            if 'tau2' not in self.params:  # Only one tau ('Sugrue2004')
+                self.taus = [self.param('tau1')]
+                self.w_taus = [np.ones(self.n_pop)]
+            else:  # 'Corrado2005'
+                self.taus = [self.param('tau1'), self.param('tau2')]
+                self.w_taus = [self.param('w_tau1'), 1 - self.param('w_tau1')]
+
+        elif 'RW1972' in forager:
+            self.learn_rates = [self.param('learn_rate')] * 2
+            self.forget_rates = [np.zeros(self.n_pop)] * 2   # RW1972 does not forget
+
+        elif 'Bari2019' in forager or forager == 'Synaptic':
+            self.learn_rates = [self.param('learn_rate')] * 2
+            self.forget_rates = [self.param('forget_rate')] * 2
+
+        elif 'Hattori2019' in forager:
+            # 0: unrewarded, 1: rewarded / 0: unchosen, 1: chosen
+            self.learn_rates = [self.param('learn_rate_unrew'), self.param('learn_rate_rew')]
+            self.forget_rates = [self.param('forget_rate', 0), np.zeros(self.n_pop)]
+
+        elif forager == 'CANN':
+            assert self.iti is not None, 'CANN requires fit_iti'
+            self.learn_rates = [self.param('learn_rate')] * 2
+
+    def param(self, name, default=None):
+        if name not in self.params:
+            assert default is not None, 'Missing parameter {} for {}'.format(name, self.forager)
+            return np.full(self.n_pop, float(default))
+        return self.params[name]
+
+    def simulate(self):
+        '''
+        Predictive choice probabilities of the population: self.predictive_choice_prob, (S, K, n_trials + 1)
+        - with the final update after the last trial, as BanditModel.predictive_choice_prob
+        '''
+        choices = self.fit_choice_history[0].astype(int)
+        rewards = self.fit_reward_history[choices, np.arange(self.n_trials)]   # Reward of the chosen port
+
+        self.predictive_choice_prob = np.full([self.n_pop, self.K, self.n_trials + 1], np.nan)
+        self.predictive_choice_prob[:, :, 0] = 1 / self.K
+
+        if self.forager == 'LossCounting':
+            self._simulate_LossCounting(choices, rewards)
+            return
+
+        q_estimation = np.zeros([self.n_pop, self.K])
+        choice_kernel = np.zeros([self.n_pop, self.K]) if '_CK' in self.forager else None
+
+        if 'LNP_softmax' in self.forager:
+            # Exponential filters of the reward history, accumulated recursively
+            decays = [np.exp(-1 / tau) for tau in self.taus]
+            weights = [w_tau / np.sum(np.exp(-np.arange(self.n_trials + 1)[None, :] / tau[:, None]), axis=1)
+                       for tau, w_tau in zip(self.taus, self.w_taus)]
+            filtered_income = [np.zeros([self.n_pop, self.K]) for _ in self.taus]
+        elif self.forager == 'Synaptic':
+            w = np.full([self.n_pop, self.K], 0.1)
+
+        for t in range(self.n_trials + 1):
+            # -- Act: predictive choice prob of trial t --
+            self.predictive_choice_prob[:, :, t] = self._choice_prob(q_estimation, choice_kernel)
+
+            if t == self.n_trials:  # Only the final act after the last trial
+                break
+
+            # -- Step: update after the choice and reward of trial t --
+            choice, reward = choices[t], rewards[t]
+            unchosen = [cc for cc in range(self.K) if cc != choice]
+
+            if 'LNP_softmax' in self.forager:
+                for income, decay in zip(filtered_income, decays):
+                    income *= decay[:, None]
+                    income += self.fit_reward_history[:, t]
+                q_estimation = sum(weight[:, None] * income for weight, income in zip(weights, filtered_income))
+
+            else:
+                learn_rate = self.learn_rates[1] if reward else self.learn_rates[0]
+                q_last = q_estimation
+                q_estimation = np.empty_like(q_last)
+
+                if self.forager == 'CANN':
+                    decay = np.exp(-self.iti[t] / self.param('tau_cann'))
+                    q_estimation[:, choice] = (q_last[:, choice] + learn_rate * (reward - q_last[:, choice])) * decay
+                    q_estimation[:, unchosen] = q_last[:, unchosen] * decay[:, None]
+
+                elif self.forager == 'Synaptic':
+                    w_last = w
+                    w = np.empty_like(w_last)
+                    w[:, choice] = (1 - self.forget_rates[1]) * w_last[:, choice] \
+                        + learn_rate * (reward - q_last[:, choice]) * q_last[:, choice]
+                    w[:, 1 - choice] = (1 - self.forget_rates[0]) * w_last[:, 1 - choice]
+                    denominator = (w[:, 0] * w[:, 1] - (1 + self.param('rho') / 2) * (w[:, 0] + w[:, 1])
+                                   + 1 + self.param('rho'))
+                    for side in [0, 1]:
+                        q_estimation[:, side] = np.clip(self.param('I0') * (1 - w[:, 1 - side]) / denominator, 0, 1)
+
+                else:  # RW-like
+                    q_estimation[:, choice] = (1 - self.forget_rates[1]) * q_last[:, choice] \
+                        + learn_rate * (reward - q_last[:, choice])
+                    q_estimation[:, unchosen] = (1 - self.forget_rates[0])[:, None] * q_last[:, unchosen]
+
+            if choice_kernel is not None:
+                choice_vector = np.zeros([self.K])
+                choice_vector[choice] = 1
+                choice_kernel = choice_kernel + self.param('choice_step_size')[:, None] * (choice_vector - choice_kernel)
+
+    def _choice_prob(self, q_estimation, choice_kernel):
+        '''
+        Choice probabilities (S, K) given the current latent variables
+        '''
+        if self.forager == 'RW1972_epsi':
+            epsilon = self.param('epsilon')[:, None]
+            choice = self._random_argmax(q_estimation)
+            choice_prob = epsilon * (1 / self.K + self.bias_terms)
+            pop_idx = np.arange(self.n_pop)
+            choice_prob[pop_idx, choice] = 1 - epsilon[:, 0] + epsilon[:, 0] * (
+                1 / self.K + self.bias_terms[pop_idx, choice])
+            return choice_prob
+
+        # Softmax (with choice kernel)
+        X = q_estimation / self.param('softmax_temperature')[:, None]
+        if choice_kernel is not None:
+            X = X + choice_kernel / self.param('choice_softmax_temperature')[:, None]
+        X = X + self.bias_terms
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            choice_prob = np.exp(X) / np.sum(np.exp(X), axis=1, keepdims=True)
+
+        greedy = np.max(X, axis=1) > 700   # To prevent explosion of EXP
+        if np.any(greedy):
+            choice_prob[greedy] = 0
+            choice_prob[np.flatnonzero(greedy), self._random_argmax(X[greedy])] = 1
+        return choice_prob
+
+    @staticmethod
+    def _random_argmax(x):
+        '''
+        Index of the max of each row of x, with ties broken randomly
+        '''
+        is_max = x == np.max(x, axis=1, keepdims=True)
+        return np.argmax(np.random.uniform(size=x.shape) * is_max + is_max, axis=1)
+
+    def _simulate_LossCounting(self, choices, rewards):
+        # The loss count only depends on the choice and reward history:
+        # reset on a switch (c(t) != c(t-1)), +1 on each unrewarded trial
+        loss_count = np.zeros(self.n_trials + 1)
+        for t in range(self.n_trials):
+            switch = t > 0 and choices[t] != choices[t - 1]
+            loss_count[t + 1] = (0 if switch else loss_count[t]) + (0 if rewards[t] else 1)
+
+        # To be general, and ensure that alway switch when mean = 0, std = 0
+        prob_switch = norm.cdf(loss_count[None, 1:],
+                               self.param('loss_count_threshold_mean')[:, None] - 1e-6,
+                               self.param('loss_count_threshold_std', 0)[:, None] + 1e-16)
+
+        # Choice prob [last choice] = 1-prob_switch, [others] = prob_switch /(K-1)
+        self.predictive_choice_prob[:, :, 1:] = prob_switch[:, None, :] / (self.K - 1)
+        self.predictive_choice_prob[:, choices, np.arange(1, self.n_trials + 1)] = 1 - prob_switch
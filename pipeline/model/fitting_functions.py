@@ -3,12 +3,15 @@ Created on Thu Mar 19 16:30:26 2020
 
 @author: Han
 """
+import inspect
+
 import numpy as np
 import scipy.optimize as optimize
 import multiprocessing as mp
 # from tqdm import tqdm  # For progress bar. HH
 
 from .bandit_model import BanditModel
+from .batch_bandit_model import BatchBanditModel
 global fit_history
 
 def negLL_func(fit_value, *argss):
@@ -57,7 +60,7 @@ def negLL_func(fit_value, *argss):
     
     likelihood_all_trial = np.array(likelihood_all_trial)
     
-    if fit_set == []: # Use all trials
+    if len(fit_set) == 0: # Use all trials
         negLL = - sum(np.log(likelihood_all_trial))
     else:   # Only return likelihoods in the fit_set
         negLL = - sum(np.log(likelihood_all_trial[fit_set]))
@@ -68,6 +71,115 @@ def negLL_func(fit_value, *argss):
     
     return negLL
 
+def negLL_func_batch(fit_values, *argss):
+    '''
+    Compute negative likelihood of a population of parameter vectors at once (same as negLL_func for each of them)
+    :param fit_values: (n_fit_names, S) population, as passed by differential_evolution(vectorized = True),
+                       or a single parameter vector (n_fit_names,)
+    :return: negLL, (S,) (or a scalar for a single parameter vector)
+    '''
+    forager, fit_names, choice_history, reward_history, iti, session_num, para_fixed, fit_set = argss
+
+    fit_values = np.asarray(fit_values, dtype=float)
+    if_single = fit_values.ndim == 1
+    fit_values = np.atleast_2d(fit_values.T).T   # (n_fit_names, S)
+
+    params_all = {**para_fixed, **dict(zip(fit_names, fit_values))}
+
+    # Put constraint hack here!!
+    if_valid = np.ones(fit_values.shape[1], dtype=bool)
+    if 'tau2' in params_all:
+        if_valid = ~(np.asarray(params_all['tau2']) < np.asarray(params_all['tau1']))
+        if_valid = np.broadcast_to(if_valid, (fit_values.shape[1],))
+
+    negLL = np.full(fit_values.shape[1], np.inf)
+    if np.any(if_valid):
+        params_valid = {nn: (vv[if_valid] if np.ndim(vv) else vv) for nn, vv in params_all.items()}
+
+        # Handle data from different sessions
+        if session_num is None:
+            session_num = np.zeros_like(choice_history)[0]  # Regard as one session
+
+        likelihood_all_trial = []
+
+        # -- For each session --
+        for ss in np.unique(session_num):
+            # Data in this session
+            choice_this = choice_history[:, session_num == ss]
+            reward_this = reward_history[:, session_num == ss]
+
+            # Run **PREDICTIVE** simulation of the whole population
+            bandit = BatchBanditModel(forager, params_valid, fit_choice_history = choice_this, fit_reward_history = reward_this, fit_iti = iti)
+            bandit.simulate()
+
+            # Actual likelihood for each trial, (S, num_trials), excluding the final update after the last trial
+            likelihood_each_trial = bandit.predictive_choice_prob[:, choice_this[0, :], np.arange(len(choice_this[0]))]
+
+            # Deal with numerical precision
+            likelihood_each_trial[(likelihood_each_trial <= 0) & (likelihood_each_trial > -1e-5)] = 1e-16
+            likelihood_each_trial[likelihood_each_trial > 1] = 1
+
+            likelihood_all_trial.append(likelihood_each_trial)
+
+        likelihood_all_trial = np.hstack(likelihood_all_trial)
+
+        if len(fit_set) == 0:  # Use all trials
+            negLL[if_valid] = - np.sum(np.log(likelihood_all_trial), axis=1)
+        else:   # Only return likelihoods in the fit_set
+            negLL[if_valid] = - np.sum(np.log(likelihood_all_trial[:, fit_set]), axis=1)
+
+    return negLL[0] if if_single else negLL
+
+
+def DE_objective(forager, pool = '', if_vectorized = True):
+    '''
+    Objective function and extra differential_evolution settings:
+    the population-batched negLL_func_batch (vectorized = True) if possible, otherwise negLL_func
+    '''
+    if (if_vectorized and pool == '' and forager in BatchBanditModel.supported_foragers
+            and 'vectorized' in inspect.signature(optimize.differential_evolution).parameters):
+        return negLL_func_batch, {'vectorized': True, 'workers': 1, 'updating': 'deferred'}
+
+    return negLL_func, {'workers': 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
+                        'updating': 'immediate' if pool == '' else 'deferred'}
+
+
+# Values of the parameters that reduce a model to its nested model (no bias, no forgetting, no choice kernel, one tau)
+nested_param_values = {'biasL': 0, 'biasR': 0, 'forget_rate': 0, 'choice_step_size': 0, 'w_tau1': 1}
+
+
+def DE_init_population(fit_names, fit_bounds, DE_pop_size, DE_seeds, DE_seed_fraction = 0.5, DE_seed_jitter = 0.05):
+    '''
+    Initial DE population: Latin hypercube sampling (as differential_evolution's default), with its first members replaced by the seeds,
+    then by jittered seeds (gaussian, DE_seed_jitter * bound range) up to DE_seed_fraction of the population
+    :param DE_seeds: list of {param name: value}, e.g. the fitted params of related models. Params missing from a seed
+                     take their nested value (see nested_param_values) if any, otherwise keep their random value
+    :return: (DE_pop_size * n_params, n_params)
+    '''
+    lb, ub = np.array(fit_bounds[0], dtype=float), np.array(fit_bounds[1], dtype=float)
+    n_params = len(fit_names)
+    n_pop = max(DE_pop_size * n_params, 5)
+
+    # Latin hypercube
+    samples = np.random.uniform(size=(n_pop, n_params)) / n_pop + np.linspace(0., 1., n_pop, endpoint=False)[:, None]
+    population = lb + np.stack([samples[np.random.permutation(n_pop), jj] for jj in range(n_params)], axis=1) * (ub - lb)
+
+    for ii, seed in enumerate(DE_seeds[:n_pop]):
+        for jj, nn in enumerate(fit_names):
+            vv = seed.get(nn, nested_param_values.get(nn))
+            if vv is not None:
+                population[ii, jj] = np.clip(vv, lb[jj], ub[jj])
+
+    # Fill up to DE_seed_fraction of the population with jittered seeds
+    n_seeds = min(len(DE_seeds), n_pop)
+    n_jittered = int(DE_seed_fraction * n_pop) - n_seeds
+    if n_seeds and n_jittered > 0:
+        jittered = population[np.arange(n_jittered) % n_seeds] + np.random.normal(size=(n_jittered, n_params)) * DE_seed_jitter * (ub - lb)
+        population[n_seeds:n_seeds + n_jittered] = np.clip(jittered, lb, ub)
+
+    return population
+
+
 def callback_history(x, **kargs):
     '''
     Store the intermediate DE results. I have to use global variable as a workaround. Any better ideas?
@@ -97,9 +209,11 @@ def fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history
 def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, 
                iti = None, session_num = None, 
                if_predictive = False, if_generative = False,  # Whether compute predictive or generative choice sequence
-               if_history = False, fit_method = 'DE', DE_pop_size = 16, n_x0s = 1, pool = ''):
+               if_history = False, fit_method = 'DE', DE_pop_size = 16, n_x0s = 1, pool = '', if_vectorized = True, DE_seeds = None):
     '''
     Main fitting func and compute BIC etc.
+    :param if_vectorized: for DE, evaluate the whole population at once (negLL_func_batch) if the forager supports it
+    :param DE_seeds: for DE, warm start: list of {param name: value} seeded in the initial population (see DE_init_population)
     '''
     if if_history: 
         global fit_history
@@ -110,14 +224,15 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
     
     if fit_method == 'DE':
         
-        # Use DE's own parallel method
-        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, []),
+        # Use DE's own parallel method, or evaluate the whole population at once
+        DE_func, DE_kwargs = DE_objective(forager, pool, if_vectorized)
+        fitting_result = optimize.differential_evolution(func = DE_func, args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, []),
                                                          bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
                                                          mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
+                                                         init = DE_init_population(fit_names, fit_bounds, DE_pop_size, DE_seeds) if DE_seeds else 'latinhypercube',
                                                          disp = False, 
-                                                         workers = 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
-                                                         updating = 'immediate' if pool == '' else 'deferred',
-                                                         callback = callback_history if if_history else None,)
+                                                         callback = callback_history if if_history else None,
+                                                         **DE_kwargs)
         if if_history:
             fit_history.append(fitting_result.x.copy())  # Add the final result
             fit_histories = [fit_history]  # Backward compatibility
@@ -230,78 +345,110 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
 
 import random
 
+def split_cross_validation_folds(n_trials, k_fold = 2):
+    '''
+    Randomly split the trials into k_fold parts
+    :return: list of (fit_set, test_set) of each fold
+    '''
+    trial_numbers_shuffled = np.arange(n_trials)
+    random.shuffle(trial_numbers_shuffled)
+
+    folds = []
+    for kk in range(k_fold):
+        test_begin = int(kk * np.floor(n_trials/k_fold))
+        test_end = int((n_trials) if (kk == k_fold - 1) else (kk+1) * np.floor(n_trials/k_fold))
+        test_set_this = trial_numbers_shuffled[test_begin:test_end]
+        fit_set_this = np.hstack((trial_numbers_shuffled[:test_begin], trial_numbers_shuffled[test_end:]))
+        folds.append((fit_set_this, test_set_this))
+
+    return folds
+
+
+def cross_validate_fold(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_set_this, test_set_this,
+                        DE_pop_size = 16, pool = '', if_vectorized = True, DE_seeds = None):
+    '''
+    One fold of the cross-validation: fit using fit_set_this, and get the prediction accuracy of fit_set_this and test_set_this
+    :param DE_seeds: warm start, see fit_bandit
+    :return: prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only (None if no bias)
+    '''
+    # == Fit data using fit_set_this ==
+    DE_func, DE_kwargs = DE_objective(forager, pool, if_vectorized)
+    fitting_result = optimize.differential_evolution(func = DE_func, args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, fit_set_this),
+                                                     bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
+                                                     mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
+                                                     init = DE_init_population(fit_names, fit_bounds, DE_pop_size, DE_seeds) if DE_seeds else 'latinhypercube',
+                                                     disp = False, 
+                                                     callback = None,
+                                                     **DE_kwargs)
+        
+    # == Rerun predictive choice sequence and get the prediction accuracy of the test_set_this ==
+    kwargs_all = {}
+    for (nn, vv) in zip(fit_names, fitting_result.x):  # Use the fitted data
+        kwargs_all = {**kwargs_all, nn:vv}
+    
+    # Handle data from different sessions
+    if session_num is None:
+        session_num = np.zeros_like(choice_history)[0]  # Regard as one session
+    
+    unique_session = np.unique(session_num)
+    predictive_choice_prob = []
+    
+    # -- For each session --
+    for ss in unique_session:
+        # Data in this session
+        choice_this = choice_history[:, session_num == ss]
+        reward_this = reward_history[:, session_num == ss]
+        
+        # Run PREDICTIVE simulation    
+        bandit = BanditModel(forager = forager, **kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this, fit_iti = iti)  # Into the fitting mode
+        bandit.simulate()
+        predictive_choice_prob.extend(bandit.predictive_choice_prob[:, :-1])   # Exclude the final update after the last trial
+        
+    # Get prediction accuracy of the test_set and fitting_set
+    predictive_choice_prob = np.array(predictive_choice_prob)
+    predictive_choice = np.argmax(predictive_choice_prob, axis = 0)
+    prediction_correct = predictive_choice == choice_history[0]
+    
+    # Also return cross-validated prediction_accuracy_bias (Maybe this is why Hattori's bias_only is low? -- Not exactly...)
+    prediction_accuracy_test_bias_only = None
+    if 'biasL' in kwargs_all:
+        bias_this = kwargs_all['biasL']
+        prediction_correct_bias_only = int(bias_this <= 0) == choice_history[0] # If bias_this < 0, bias predicts all rightward choices
+        prediction_accuracy_test_bias_only = sum(prediction_correct_bias_only[test_set_this]) / len(test_set_this)
+
+    prediction_accuracy_test = sum(prediction_correct[test_set_this]) / len(test_set_this)
+    prediction_accuracy_fit = sum(prediction_correct[fit_set_this]) / len(fit_set_this)
+
+    return prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only
+
+
 def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, iti = None, session_num = None, k_fold = 2, 
-                          DE_pop_size = 16, pool = '', if_verbose = True):
+                          DE_pop_size = 16, pool = '', if_verbose = True, if_vectorized = True, DE_seeds = None):
     '''
     k-fold cross-validation
     '''
     
     # Split the data into k_fold parts
-    n_trials = np.shape(choice_history)[1]
-    trial_numbers_shuffled = np.arange(n_trials)
-    random.shuffle(trial_numbers_shuffled)
+    folds = split_cross_validation_folds(np.shape(choice_history)[1], k_fold)
     
     prediction_accuracy_test = []
     prediction_accuracy_fit = []
     prediction_accuracy_test_bias_only = []
     
-    for kk in range(k_fold):
+    for kk, (fit_set_this, test_set_this) in enumerate(folds):
         
-        test_begin = int(kk * np.floor(n_trials/k_fold))
-        test_end = int((n_trials) if (kk == k_fold - 1) else (kk+1) * np.floor(n_trials/k_fold))
-        test_set_this = trial_numbers_shuffled[test_begin:test_end]
-        fit_set_this = np.hstack((trial_numbers_shuffled[:test_begin], trial_numbers_shuffled[test_end:]))
-        
-        # == Fit data using fit_set_this ==
         if if_verbose: print('%g/%g...'%(kk+1, k_fold), end = '')
-        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, fit_set_this),
-                                                         bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
-                                                         mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
-                                                         disp = False, 
-                                                         workers = 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
-                                                         updating = 'immediate' if pool == '' else 'deferred',
-                                                         callback = None,)
-            
-        # == Rerun predictive choice sequence and get the prediction accuracy of the test_set_this ==
-        kwargs_all = {}
-        for (nn, vv) in zip(fit_names, fitting_result.x):  # Use the fitted data
-            kwargs_all = {**kwargs_all, nn:vv}
-        
-        # Handle data from different sessions
-        if session_num is None:
-            session_num = np.zeros_like(choice_history)[0]  # Regard as one session
+        acc_test, acc_fit, acc_test_bias_only = cross_validate_fold(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num,
+                                                                    fit_set_this, test_set_this,
+                                                                    DE_pop_size = DE_pop_size, pool = pool, if_vectorized = if_vectorized,
+                                                                    DE_seeds = DE_seeds)
         
-        unique_session = np.unique(session_num)
-        predictive_choice_prob = []
-        fitting_result.trial_numbers = []
-        
-        # -- For each session --
-        for ss in unique_session:
-            # Data in this session
-            choice_this = choice_history[:, session_num == ss]
-            reward_this = reward_history[:, session_num == ss]
-            
-            # Run PREDICTIVE simulation    
-            bandit = BanditModel(forager = forager, **kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this, fit_iti = iti)  # Into the fitting mode
-            bandit.simulate()
-            predictive_choice_prob.extend(bandit.predictive_choice_prob[:, :-1])   # Exclude the final update after the last trial
-            
-        # Get prediction accuracy of the test_set and fitting_set
-        predictive_choice_prob = np.array(predictive_choice_prob)
-        predictive_choice = np.argmax(predictive_choice_prob, axis = 0)
-        prediction_correct = predictive_choice == choice_history[0]
-        
-        # Also return cross-validated prediction_accuracy_bias (Maybe this is why Hattori's bias_only is low? -- Not exactly...)
-        if 'biasL' in kwargs_all:
-            bias_this = kwargs_all['biasL']
-            prediction_correct_bias_only = int(bias_this <= 0) == choice_history[0] # If bias_this < 0, bias predicts all rightward choices
-            prediction_accuracy_test_bias_only.append(sum(prediction_correct_bias_only[test_set_this]) / len(test_set_this))
-
-        prediction_accuracy_test.append(sum(prediction_correct[test_set_this]) / len(test_set_this))
-        prediction_accuracy_fit.append(sum(prediction_correct[fit_set_this]) / len(fit_set_this))
+        if acc_test_bias_only is not None:
+            prediction_accuracy_test_bias_only.append(acc_test_bias_only)
+        prediction_accuracy_test.append(acc_test)
+        prediction_accuracy_fit.append(acc_fit)
         
 
     return prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only
             
 
-
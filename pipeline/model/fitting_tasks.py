@@ -0,0 +1,235 @@
+# =============================================================================
+#  Parallel, resumable fitting tasks
+# =============================================================================
+# A fitting task is either the full fit of a model to a session ('fit') or one fold of its cross-validation ('fold').
+# Tasks are independent, so (session, model, fold) tasks can be scheduled across a process pool,
+# and each completed task is checkpointed on local disk such that an interrupted run resumes without refitting.
+# With warm start, the tasks of a (session, model) are only made once the fits seeding it are done.
+
+import hashlib
+import logging
+import multiprocessing as mp
+import pathlib
+import pickle
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .fitting_functions import fit_bandit, cross_validate_fold, split_cross_validation_folds
+
+log = logging.getLogger(__name__)
+
+
+def make_fit_tasks(name, fit_cmd, choice_history, reward_history, iti=None, k_fold=2, DE_pop_size=16, DE_seeds=None,
+                   checkpoint=None):
+    '''
+    The 'fit' task and the k_fold 'fold' tasks of a model and a session
+    :param name: unique name of the (session, model), to identify its tasks
+    :param fit_cmd: [forager, fit_names, fit_lb, fit_ub], as in foraging_model.Model
+    :param DE_seeds: warm start of the fits, see fitting_functions.fit_bandit
+    :param checkpoint: FitCheckpoint - to reuse the cross-validation folds of an interrupted run
+    '''
+    data = dict(name=name, fit_cmd=fit_cmd, choice_history=choice_history, reward_history=reward_history,
+                iti=iti, DE_pop_size=DE_pop_size, DE_seeds=DE_seeds)
+
+    # The random split of the trials must be the same for all folds, also across runs
+    folds_task = dict(name=name, kind='folds', n_trials=choice_history.shape[1], k_fold=k_fold)
+    folds = checkpoint.load(folds_task) if checkpoint is not None else None
+    if folds is None:
+        folds = split_cross_validation_folds(choice_history.shape[1], k_fold)
+        if checkpoint is not None:
+            checkpoint.save(folds_task, folds)
+
+    return [dict(data, kind='fit')] + [dict(data, kind='fold', fold=kk, fit_set=fit_set, test_set=test_set)
+                                       for kk, (fit_set, test_set) in enumerate(folds)]
+
+
+def task_label(task):
+    return task['kind'] if task['kind'] != 'fold' else 'fold{}'.format(task['fold'])
+
+
+def task_id(task):
+    return '{}_{}'.format(task['name'], task_label(task))
+
+
+def run_fit_task(task):
+    '''
+    Worker: run one fitting task
+    :return: (result, wall time in seconds)
+        - 'fit': the fitting result of fit_bandit (with the predictive choice prob, etc.)
+        - 'fold': (prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only)
+    '''
+    start = time.time()
+    forager, fit_names, fit_lb, fit_ub = task['fit_cmd']
+
+    if task['kind'] == 'fit':
+        result = fit_bandit(forager, fit_names, [fit_lb, fit_ub], task['choice_history'], task['reward_history'],
+                            iti=task['iti'], fit_method='DE', DE_pop_size=task['DE_pop_size'], pool='', if_predictive=True,
+                            DE_seeds=task['DE_seeds'])
+    else:
+        result = cross_validate_fold(forager, fit_names, [fit_lb, fit_ub], task['choice_history'], task['reward_history'],
+                                     task['iti'], None, task['fit_set'], task['test_set'], DE_pop_size=task['DE_pop_size'],
+                                     DE_seeds=task['DE_seeds'])
+
+    return result, time.time() - start
+
+
+class FitCheckpoint:
+    '''
+    FitCheckpoint: results of completed fitting tasks, kept on local disk (one pickle file per task)
+
+    A result is only reused for the same task inputs (data, model, fold, settings),
+    the warm start seeds excepted (a fit from other seeds remains valid).
+    '''
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = pathlib.Path(checkpoint_dir)
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def signature(task):
+        return hashlib.md5(pickle.dumps(sorted((k, v) for k, v in task.items() if k != 'DE_seeds'))).hexdigest()
+
+    def _path(self, task):
+        return self.checkpoint_dir / (task_id(task) + '.pkl')
+
+    def load(self, task):
+        '''
+        result of `task` if checkpointed, else None
+        '''
+        path = self._path(task)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as f:
+                checkpoint = pickle.load(f)
+        except Exception as e:
+            log.warning('Unable to load checkpoint {} ({}) - refitting'.format(path, repr(e)))
+            return None
+        return checkpoint['result'] if checkpoint['signature'] == self.signature(task) else None
+
+    def save(self, task, result):
+        path = self._path(task)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'signature': self.signature(task), 'result': result}, f)
+        tmp_path.replace(path)
+
+    def remove(self, name):
+        '''
+        remove the checkpoints of all tasks of `name`
+        '''
+        for path in self.checkpoint_dir.glob(name + '_*.pkl'):
+            path.unlink()
+
+
+def run_fit_tasks(tasks, workers=1, checkpoint=None):
+    '''
+    Run fitting tasks in a process pool, yielding (task, result, wall_time, error) as they complete
+    - tasks found in `checkpoint` are yielded as soon as reached (with wall_time None), without refitting
+    - each completed task is saved to `checkpoint` before being yielded
+    - a failed task is yielded with its exception as `error` (and result None)
+    - the list `tasks` may be extended while iterating (e.g. with the tasks depending on a result yielded):
+      the tasks appended are run as well
+    :param workers: number of processes (1: in this process)
+    '''
+    log.info('------ Running fitting tasks ({} workers) ------'.format(workers))
+
+    def completed(task, run):
+        try:
+            result, wall_time = run()
+        except Exception as e:
+            log.error('{} failed: {}'.format(task_id(task), repr(e)))
+            return task, None, None, e
+        if checkpoint is not None:
+            checkpoint.save(task, result)
+        log.info('{} ({}) done in {:.1f} s'.format(task_id(task), task['fit_cmd'][0], wall_time))
+        return task, result, wall_time, None
+
+    n_taken = 0
+
+    def take_new_tasks():
+        '''
+        the tasks not taken yet - with their checkpointed result (None if not checkpointed)
+        '''
+        nonlocal n_taken
+        new_tasks, n_taken = tasks[n_taken:], len(tasks)
+        return [(task, checkpoint.load(task) if checkpoint is not None else None) for task in new_tasks]
+
+    if workers <= 1:
+        while n_taken < len(tasks):
+            for task, result in take_new_tasks():
+                yield (task, result, None, None) if result is not None else completed(task, lambda: run_fit_task(task))
+        return
+
+    # "spawn" - workers do not share this process' database connection
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn')) as pool:
+        futures = {}
+        try:
+            while n_taken < len(tasks) or futures:
+                for task, result in take_new_tasks():
+                    if result is not None:
+                        yield task, result, None, None
+                    else:
+                        futures[pool.submit(run_fit_task, task)] = task
+                if n_taken < len(tasks) or not futures:  # tasks appended on a checkpointed result
+                    continue
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield completed(futures.pop(future), future.result)
+        finally:  # e.g. the caller stopped on an error: do not start the remaining tasks
+            for future in futures:
+                future.cancel()
+
+
+def warm_start_dependencies(fits):
+    '''
+    The fits to complete before a warm started fit of a (session, model) (see foraging_model.get_warm_start_seeds):
+        + the models of the same class with a lower model_id on the same session - i.e. their nested models,
+          as ordered in MODELS
+        + the same model on the previous session of the same subject (among `fits`)
+    :param fits: {name: (subject_id, session, model_class, model_id)}
+    :return: {name: [names of the fits it depends on]}
+    '''
+    previous = {}   # (subject_id, model_id, session) -> name of the same model on the previous session
+    last = {}
+    for name, (subject_id, session, _, model_id) in sorted(fits.items(), key=lambda f: f[1]):
+        previous[(subject_id, model_id, session)] = last.get((subject_id, model_id))
+        last[(subject_id, model_id)] = name
+
+    return {name: [other for other, (o_subject_id, o_session, o_model_class, o_model_id) in fits.items()
+                   if (o_subject_id, o_session, o_model_class) == (subject_id, session, model_class)
+                   and o_model_id < model_id]
+                  + ([previous[(subject_id, model_id, session)]] if previous[(subject_id, model_id, session)] else [])
+            for name, (subject_id, session, model_class, model_id) in fits.items()}
+
+
+def run_dependent_fit_tasks(names, dependencies, make_tasks, workers=1, checkpoint=None):
+    '''
+    Run the tasks of several fits (e.g. of (session, model)), the tasks of a fit being made only once the 'fit' task
+     of each fit it depends on is done (or failed) - e.g. to warm start it from their fitted params
+    :param names: names of the fits, and dependencies: {name: [names of the fits it depends on]}
+    :param make_tasks: make_tasks(name, fitted) -> tasks of the fit `name` (see `make_fit_tasks`),
+                       with fitted: {name: result of its 'fit' task} of the fits done so far
+    :return: generator of (task, result, wall_time, error), as `run_fit_tasks`
+    '''
+    waiting = {name: set(dependencies.get(name, [])) & set(names) for name in names}
+    dependents = defaultdict(list)
+    for name, deps in waiting.items():
+        for dep in deps:
+            dependents[dep].append(name)
+
+    fitted, tasks = {}, []
+    for name in names:
+        if not waiting[name]:
+            tasks.extend(make_tasks(name, fitted))
+
+    for task, result, wall_time, error in run_fit_tasks(tasks, workers=workers, checkpoint=checkpoint):
+        if task['kind'] == 'fit':
+            if error is None:
+                fitted[task['name']] = result
+            for dependent in dependents.pop(task['name'], []):
+                waiting[dependent].discard(task['name'])
+                if not waiting[dependent]:
+                    tasks.extend(make_tasks(dependent, fitted))
+        yield task, result, wall_time, error
@@ -723,12 +723,16 @@ def plot_psth_photostim_effect(units, condition_name_kw=['both_alm'], axs=None):
     return fig
 
 
-def plot_coding_direction(units, time_period=None, label=None, axs=None):
+def plot_coding_direction(units, time_period=None, label=None, axs=None, trial_psths=None):
+    """
+    Plot the CD-projected trial-psth of the units
+    :param trial_psths: output of psth.compute_CD_trial_psths(units) - computed if not provided
+    """
     # get event start times: sample, delay, response
     period_names, period_starts = _get_trial_event_times(['sample', 'delay', 'go'], units, 'good_noearlylick_hit')
 
     _, proj_contra_trial, proj_ipsi_trial, time_stamps, _ = psth.compute_CD_projected_psth(
-        units.fetch('KEY'), time_period=time_period)
+        units.fetch('KEY'), time_period=time_period, trial_psths=trial_psths)
 
     fig = None
     if axs is None:
@@ -751,15 +755,18 @@ def plot_coding_direction(units, time_period=None, label=None, axs=None):
     return fig
 
 
-def plot_paired_coding_direction(unit_g1, unit_g2, labels=None, time_period=None):
+def plot_paired_coding_direction(unit_g1, unit_g2, labels=None, time_period=None,
+                                 trial_psths_g1=None, trial_psths_g2=None):
     """
     Plot trial-to-trial CD-endpoint correlation between CD-projected trial-psth from two unit-groups (e.g. two brain regions)
     Note: coding direction is calculated on selective units, contra vs. ipsi, within the specified time_period
+    :param trial_psths_g1, trial_psths_g2: output of psth.compute_CD_trial_psths() for each unit-group
+     - computed if not provided
     """
     _, proj_contra_trial_g1, proj_ipsi_trial_g1, time_stamps, unit_g1_hemi = psth.compute_CD_projected_psth(
-        unit_g1.fetch('KEY'), time_period=time_period)
+        unit_g1.fetch('KEY'), time_period=time_period, trial_psths=trial_psths_g1)
     _, proj_contra_trial_g2, proj_ipsi_trial_g2, time_stamps, unit_g2_hemi = psth.compute_CD_projected_psth(
-        unit_g2.fetch('KEY'), time_period=time_period)
+        unit_g2.fetch('KEY'), time_period=time_period, trial_psths=trial_psths_g2)
 
     # get event start times: sample, delay, response
     period_names, period_starts = _get_trial_event_times(['sample', 'delay', 'go'], unit_g1, 'good_noearlylick_hit')
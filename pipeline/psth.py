@@ -1,6 +1,8 @@
 import logging
 import hashlib
+import time
 
+from collections import OrderedDict
 from functools import partial
 from inspect import getmembers
 from itertools import repeat
@@ -11,7 +13,7 @@ import scipy.stats as sc_stats
 from . import (lab, experiment, ephys)
 [lab, experiment, ephys]  # NOQA
 
-from . import get_schema_name, dict_to_hash, create_schema_settings
+from . import get_schema_name, dict_to_hash, create_schema_settings, populate_batched
 from .util import _get_units_hemisphere
 
 schema = dj.schema(get_schema_name('psth'), **create_schema_settings)
@@ -168,7 +170,17 @@ class TrialCondition(dj.Lookup):
                 for d in contents_data)
 
     @classmethod
-    def get_trials(cls, trial_condition_name):
+    def get_trials(cls, trial_condition_name, session_key=None):
+        '''
+        Trials of a trial condition - as a query on experiment.BehaviorTrial.
+        :param session_key: if given, the trials of this session only, served
+            from `trial_condition_cache`
+        '''
+        if session_key is not None:
+            return trial_condition_cache.get_trials_query(
+                cls, trial_condition_name, session_key,
+                partial(cls.get_trials, trial_condition_name))
+
         return cls.get_func({'trial_condition_name': trial_condition_name})()
 
     @classmethod
@@ -249,6 +261,179 @@ class TrialCondition(dj.Lookup):
                  - [{k: v} for k, v in _stim_key.items()]).proj())
 
 
+class TrialConditionCache(dj.Manual):
+    '''
+    TrialConditionCache: the trials of a trial condition in a session -
+    the (optional) persisted tier of `trial_condition_cache`.
+
+    Declared with the psth schema - i.e. created by a schema admin (create_tables);
+    where it is not created yet, the persisted tier is unavailable:
+    see `persisted_trial_condition_cache()`.
+    '''
+
+    definition = """
+    -> experiment.Session
+    trial_condition_source:     varchar(64)     # full table name of the TrialCondition table
+    trial_condition_hash:       varchar(32)     # trial condition hash - hash of func and arg
+    trial_offset:               smallint        # trial offset applied to the condition trials
+    ---
+    session_fingerprint:        varchar(32)     # checksum of the session behavior/photostim trials
+    trials:                     longblob        # trial numbers matching the condition
+    cache_time = CURRENT_TIMESTAMP: timestamp
+    """
+
+
+# as @schema, without failing the import where the table is not created yet
+if schema.create_tables or schema.connection.query('SHOW TABLES IN `{}` LIKE "{}"'.format(
+        schema.database, TrialConditionCache.table_name)).fetchone():
+    schema(TrialConditionCache)
+elif dj.config['custom'].get('trial_condition_cache.persist', False):
+    log.warning('TrialConditionCache is not created - the trial condition cache is in-process only')
+
+
+def persisted_trial_condition_cache():
+    '''
+    the TrialConditionCache table if dj.config['custom']['trial_condition_cache.persist']
+    is set - None if not set, or if the table is not created (persisted tier unavailable)
+    '''
+    if not dj.config['custom'].get('trial_condition_cache.persist', False):
+        return None
+    return TrialConditionCache if TrialConditionCache.database is not None else None
+
+
+class TrialConditionResolver(object):
+    '''
+    TrialConditionResolver: per-session cache of trial condition -> trials
+
+    Entries are keyed on (TrialCondition table, trial_condition_hash,
+    trial_offset, session) and kept in two tiers:
+        + an in-process LRU of dj.config['custom']['trial_condition_cache.size'] entries
+        + if dj.config['custom']['trial_condition_cache.persist'], the TrialConditionCache table
+
+    Each entry is tagged with a checksum of the session's BehaviorTrial,
+    WaterPortChoice, PhotostimTrial and PhotostimEvent rows, and is resolved
+    again once that checksum changes. The checksum of a session is re-checked
+    at most every dj.config['custom']['trial_condition_cache.ttl'] seconds;
+    use `invalidate()` to drop entries right away.
+    '''
+    fingerprint_tables = (experiment.BehaviorTrial, experiment.WaterPortChoice,
+                          experiment.PhotostimTrial, experiment.PhotostimEvent)
+
+    def __init__(self):
+        self._trials = OrderedDict()
+        self._fingerprints = {}
+        self._conditions = {}
+
+    @staticmethod
+    def _session_key(key):
+        return {k: key[k] for k in experiment.Session.primary_key}
+
+    def session_fingerprint(self, session_key, refresh=False):
+        '''
+        checksum of the behavior/photostim trials of a session
+        '''
+        session_key = self._session_key(session_key)
+        session = tuple(session_key.values())
+        fingerprint, checked = self._fingerprints.get(session, (None, 0))
+
+        if (refresh or fingerprint is None
+                or time.time() - checked > dj.config['custom'].get('trial_condition_cache.ttl', 60)):
+            hashed = hashlib.md5()
+            for tbl in self.fingerprint_tables:
+                checksum = 'bit_xor(crc32(concat_ws(",", {})))'.format(
+                    ', '.join('`{}`'.format(a) for a in tbl.heading.names))
+                hashed.update(str(dj.U().aggr(tbl & session_key, n='count(*)', checksum=checksum).fetch1(
+                    'n', 'checksum')).encode())
+            fingerprint = hashed.hexdigest()
+            self._fingerprints[session] = (fingerprint, time.time())
+
+        return fingerprint
+
+    def _condition_hash(self, condition_table, trial_condition_name):
+        conditions = self._conditions.get(condition_table.full_table_name, {})
+        if trial_condition_name not in conditions:
+            conditions = dict(zip(*condition_table.fetch('trial_condition_name', 'trial_condition_hash')))
+            self._conditions[condition_table.full_table_name] = conditions
+        try:
+            return conditions[trial_condition_name]
+        except KeyError:
+            raise dj.DataJointError('Unknown trial condition: {}'.format(trial_condition_name))
+
+    def get_trials(self, condition_table, trial_condition_name, session_key, resolve, trial_offset=0):
+        '''
+        trial numbers of a session matching a trial condition
+
+        :param condition_table: the TrialCondition table defining `trial_condition_name`
+        :param session_key: dict containing the session primary key
+        :param resolve: callable returning the (uncached) trial query of the condition
+        :param trial_offset: trial offset applied by `resolve`
+        :return: sorted np.array of trial numbers
+        '''
+        session_key = self._session_key(session_key)
+        trial_condition_hash = self._condition_hash(condition_table, trial_condition_name)
+        entry_key = {**session_key,
+                     'trial_condition_source': condition_table.full_table_name,
+                     'trial_condition_hash': trial_condition_hash,
+                     'trial_offset': trial_offset}
+        cache_key = tuple(entry_key.values())
+        fingerprint = self.session_fingerprint(session_key)
+
+        cached = self._trials.get(cache_key)
+        if cached is not None and cached[0] == fingerprint:
+            self._trials.move_to_end(cache_key)
+            return cached[1]
+
+        trials = None
+        persisted = persisted_trial_condition_cache()
+        if persisted is not None:
+            stored = (persisted & entry_key & {'session_fingerprint': fingerprint}).fetch('trials')
+            trials = stored[0] if len(stored) else None
+
+        if trials is None:
+            trials = np.unique((resolve() & session_key).fetch('trial')).astype(int)
+            if persisted is not None:
+                persisted.insert1({**entry_key, 'session_fingerprint': fingerprint, 'trials': trials},
+                                  replace=True)
+
+        self._trials[cache_key] = (fingerprint, trials)
+        while len(self._trials) > dj.config['custom'].get('trial_condition_cache.size', 1024):
+            self._trials.popitem(last=False)
+
+        return trials
+
+    def get_trials_query(self, condition_table, trial_condition_name, session_key, resolve,
+                         trial_offset=0):
+        '''
+        as `get_trials()`, returned as a query on experiment.BehaviorTrial
+        '''
+        session_key = self._session_key(session_key)
+        trials = self.get_trials(condition_table, trial_condition_name, session_key, resolve,
+                                 trial_offset)
+        return (experiment.BehaviorTrial & session_key
+                & ('trial in ({})'.format(','.join(map(str, trials))) if len(trials) else []))
+
+    def invalidate(self, session_key=None):
+        '''
+        drop the cached trials of a session (all sessions if None) from both tiers
+        '''
+        if session_key is None:
+            self._trials.clear()
+            self._fingerprints.clear()
+        else:
+            session = tuple(self._session_key(session_key).values())
+            self._fingerprints.pop(session, None)
+            for cache_key in [k for k in self._trials if k[:len(session)] == session]:
+                del self._trials[cache_key]
+
+        self._conditions.clear()
+        persisted = persisted_trial_condition_cache()
+        if persisted is not None:
+            (persisted & (session_key or {})).delete_quick()
+
+
+trial_condition_cache = TrialConditionResolver()
+
+
 @schema
 class UnitPsth(dj.Computed):
     definition = """
@@ -292,6 +477,88 @@ class UnitPsth(dj.Computed):
                       'unit_psth': np.array([psth, edges]),
                       'trial_count': len(trials)})
 
+    @classmethod
+    def populate_by_insertion(cls, *restrictions, reserve_jobs=False, display_progress=False,
+                              suppress_errors=False):
+        """
+        Probe-level batched alternative to UnitPsth.populate() - same results, computed with
+         one TrialSpikes fetch per probe insertion and one trial-set resolution per condition
+         (see UnitPsth.make_insertion)
+        Jobs are reserved per probe insertion (in the psth schema's jobs table) -
+         not exclusive of a concurrent `populate()` (see `populate_batched`)
+        """
+        return populate_batched(cls, ephys.ProbeInsertion, cls.make_insertion, restrictions, schema,
+                                reserve_jobs=reserve_jobs, display_progress=display_progress,
+                                suppress_errors=suppress_errors)
+
+    @classmethod
+    def make_insertion(cls, insertion_key, *restrictions):
+        """
+        Compute UnitPsth for all the (TrialCondition, Unit) keys to be populated in a probe insertion:
+            + fetch TrialSpikes of all units and trials of the insertion once
+            + resolve the trials of each TrialCondition once
+            + bin all spikes once, then compute every unit x condition PSTH with `np.bincount`
+        """
+        log.debug('UnitPsth.make_insertion(): key: {}'.format(insertion_key))
+
+        keys = ((cls().key_source - cls) & insertion_key & dj.AndList(restrictions)).fetch('KEY')
+        if not keys:
+            return
+
+        has_quality = bool(ephys.ProbeInsertionQuality & insertion_key)
+
+        unit_ids = sorted({(k['clustering_method'], k['unit']) for k in keys})
+        unit_ind = {u: i for i, u in enumerate(unit_ids)}
+
+        # -- TrialSpikes of all units and trials of this insertion --
+        methods, units, trials, spikes = (ephys.Unit.TrialSpikes & insertion_key).fetch(
+            'clustering_method', 'unit', 'trial', 'spike_times')
+        row_unit = np.array([unit_ind.get((m, u), -1) for m, u in zip(methods, units)], dtype=int)
+
+        xmin, xmax, bin_size = cls.psth_params.values()
+        binning = np.arange(xmin, xmax, bin_size)
+
+        spike_row, spike_bin = _bin_spike_trains(spikes, binning)
+        n_bins = len(binning) - 1
+
+        if has_quality:
+            # good trials of any insertion of the session, as in `cond_trials & GoodTrial`
+            good_trials = (ephys.ProbeInsertionQuality.GoodTrial
+                           & (experiment.Session & insertion_key).proj()).fetch('trial')
+
+        entries = []
+        for cond_name in sorted({k['trial_condition_name'] for k in keys}):
+            # expand TrialCondition to trials,
+            cond_trials = TrialCondition.get_trials(cond_name)
+            if has_quality:
+                cond_trials &= ephys.ProbeInsertionQuality.GoodTrial
+            trial_count = len(cond_trials)
+
+            session_trials = trial_condition_cache.get_trials(
+                TrialCondition, cond_name, insertion_key, partial(TrialCondition.get_trials, cond_name))
+            if has_quality:
+                session_trials = np.intersect1d(session_trials, good_trials)
+
+            row_in_cond = np.isin(trials, session_trials) & (row_unit >= 0)
+            unit_trial_count = np.bincount(row_unit[row_in_cond], minlength=len(unit_ids))
+
+            spike_in_cond = row_in_cond[spike_row]
+            unit_psths = np.bincount(row_unit[spike_row[spike_in_cond]] * n_bins + spike_bin[spike_in_cond],
+                                     minlength=len(unit_ids) * n_bins).reshape(len(unit_ids), n_bins)
+
+            for key in (k for k in keys if k['trial_condition_name'] == cond_name):
+                i = unit_ind[(key['clustering_method'], key['unit'])]
+                if not unit_trial_count[i]:
+                    log.warning('no spikes found for key {} - null psth'.format(key))
+                    entries.append(key)
+                    continue
+                psth = unit_psths[i] / unit_trial_count[i] / bin_size
+                entries.append({**key,
+                                'unit_psth': np.array([psth, binning[1:]]),
+                                'trial_count': trial_count})
+
+        cls.insert(entries, allow_direct_insert=True)
+
     @classmethod
     def get_plotting_data(cls, unit_key, condition_key):
         """
@@ -305,7 +572,8 @@ class UnitPsth(dj.Computed):
              'raster': Spike * Trial raster [np.array, np.array]
           }
         """
-        trials = TrialCondition.get_func(condition_key)()
+        trials = TrialCondition.get_trials(
+            (TrialCondition & condition_key).fetch1('trial_condition_name'), unit_key)
 
         if ephys.ProbeInsertionQuality & unit_key:
             trials &= ephys.ProbeInsertionQuality.GoodTrial
@@ -427,6 +695,152 @@ class PeriodSelectivity(dj.Computed):
                       'ipsi_firing_rate': freq_i_m,
                       'contra_firing_rate': freq_c_m})
 
+    @classmethod
+    def populate_by_session(cls, *restrictions, reserve_jobs=False, display_progress=False,
+                            suppress_errors=False, unit_selectivity=True):
+        """
+        Session-level batched alternative to PeriodSelectivity.populate() - same results, computed with
+         one TrialSpikes fetch per session and one set of trial events per period
+         (see PeriodSelectivity.make_session)
+        If `unit_selectivity`, UnitSelectivity of the session is computed in the same pass
+        Jobs are reserved per session (in the psth schema's jobs table) -
+         not exclusive of a concurrent `populate()` (see `populate_batched`)
+        """
+        def make_session(session_key, *restrictions):
+            cls.make_session(session_key, *restrictions)
+            if unit_selectivity:
+                UnitSelectivity.make_session(session_key)
+
+        return populate_batched(cls, experiment.Session, make_session, restrictions, schema,
+                                reserve_jobs=reserve_jobs, display_progress=display_progress,
+                                suppress_errors=suppress_errors)
+
+    @classmethod
+    def make_session(cls, session_key, *restrictions):
+        """
+        Compute PeriodSelectivity for all the (Unit, Period) keys to be populated in a session:
+            + fetch the TrialSpikes of all units over the selected trials once
+            + fetch the trial events of each period once
+            + count the spikes of all unit-trials within the period at once (units x trials rates)
+            + run the ipsi vs. contra t-tests of all units sharing the same trials in one `ttest_ind` call
+        """
+        log.debug('PeriodSelectivity.make_session(): key: {}'.format(session_key))
+
+        keys = ((cls().key_source - cls) & session_key & dj.AndList(restrictions)).fetch('KEY')
+        if not keys:
+            return
+
+        unit_attrs = ephys.Unit.primary_key
+        unit_ids = sorted({tuple(k[a] for a in unit_attrs) for k in keys})
+        unit_ind = {u: i for i, u in enumerate(unit_ids)}
+
+        # hemisphere of each unit - from its probe insertion
+        insertion_attrs = ephys.ProbeInsertion.primary_key
+        insertion_hemi = {}
+        for u in unit_ids:
+            insertion_key = {a: v for a, v in zip(unit_attrs, u) if a in insertion_attrs}
+            insertion = tuple(insertion_key.values())
+            if insertion not in insertion_hemi:
+                insertion_hemi[insertion] = _get_units_hemisphere(insertion_key)
+        unit_hemi = np.array([insertion_hemi[tuple(v for a, v in zip(unit_attrs, u) if a in insertion_attrs)]
+                              for u in unit_ids])
+
+        # the trials of interest, and the spikes of all units on these trials
+        trials_q = ((experiment.BehaviorTrial & session_key
+                     & {'task': 'audio delay',
+                        'early_lick': 'no early',
+                        'outcome': 'hit',
+                        'free_water': 0,
+                        'auto_water': 0})
+                    & (experiment.TrialEvent & 'trial_event_type = "delay"' & 'duration = 1.2')
+                    - experiment.PhotostimEvent)
+        trials, trial_instructions = trials_q.fetch('trial', 'trial_instruction', order_by='trial')
+
+        *row_unit_ids, row_trials, spikes = (ephys.Unit.TrialSpikes & session_key & trials_q.proj()).fetch(
+            *unit_attrs, 'trial', 'spike_times')
+        row_unit = np.array([unit_ind.get(u, -1) for u in zip(*row_unit_ids)], dtype=int)
+        row_trial = np.searchsorted(trials, row_trials)
+        spikes = [s for s, u in zip(spikes, row_unit) if u >= 0]
+        row_trial, row_unit = row_trial[row_unit >= 0], row_unit[row_unit >= 0]
+
+        present = np.zeros((len(unit_ids), len(trials)), dtype=bool)
+        present[row_unit, row_trial] = True
+
+        spike_counts = [len(s) for s in spikes]
+        all_spikes = np.concatenate(spikes) if sum(spike_counts) else np.array([])
+        spike_row = np.repeat(np.arange(len(spikes)), spike_counts)
+
+        # units sharing the same trials (and hemisphere) are tested together
+        groups, group_ind = np.unique(np.column_stack([present, unit_hemi == 'left']), axis=0,
+                                      return_inverse=True)
+        group_ind = group_ind.ravel()
+
+        entries = []
+        for period in sorted({k['period'] for k in keys}):
+            # retrieving event times
+            start_event, start_tshift, end_event, end_tshift = (experiment.Period & {'period': period}).fetch1(
+                'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
+            start_event_q = {k['trial']: float(k['start_event_time'])
+                             for k in (experiment.TrialEvent & session_key & {'trial_event_type': start_event}).proj(
+                start_event_time=f'trial_event_time + {start_tshift}').fetch(as_dict=True)}
+            end_event_q = {k['trial']: float(k['end_event_time'])
+                           for k in (experiment.TrialEvent & session_key & {'trial_event_type': end_event}).proj(
+                end_event_time=f'trial_event_time + {end_tshift}').fetch(as_dict=True)}
+            cue_event_q = {k['trial']: float(k['trial_event_time'])
+                           for k in (experiment.TrialEvent & session_key & {'trial_event_type': 'go'}).fetch(
+                as_dict=True)}
+
+            # period window of each trial with spikes, relative to the go-cue
+            start_time, stop_time = np.full(len(trials), np.nan), np.full(len(trials), np.nan)
+            for i in np.flatnonzero(present.any(axis=0)):
+                start_time[i] = start_event_q[trials[i]] - cue_event_q[trials[i]]
+                stop_time[i] = end_event_q[trials[i]] - cue_event_q[trials[i]]
+
+            # compute spike rate during the period-of-interest for each unit-trial
+            spike_trial = row_trial[spike_row]
+            in_period = ((all_spikes >= start_time[spike_trial].astype(all_spikes.dtype))
+                         & (all_spikes < stop_time[spike_trial].astype(all_spikes.dtype)))
+            row_rate = (np.bincount(spike_row[in_period], minlength=len(spikes))
+                        / (stop_time[row_trial] - start_time[row_trial]))
+
+            rates = np.full(present.shape, np.nan)
+            rates[row_unit, row_trial] = row_rate
+
+            # and testing for selectivity.
+            pvals = np.ones(len(unit_ids))
+            freq_i_m, freq_c_m = np.full(len(unit_ids), np.nan), np.full(len(unit_ids), np.nan)
+            for g, group in enumerate(groups):
+                trial_mask, is_left = group[:-1], group[-1]
+                if not trial_mask.any():
+                    continue  # no spikes found
+                units = np.flatnonzero(group_ind == g)
+                is_ipsi = trial_instructions == ('left' if is_left else 'right')
+                freq_i = rates[np.ix_(units, trial_mask & is_ipsi)]
+                freq_c = rates[np.ix_(units, trial_mask & ~is_ipsi)]
+
+                _, pvals[units] = sc_stats.ttest_ind(freq_i, freq_c, axis=1, equal_var=True)
+                freq_i_m[units] = freq_i.mean(axis=1)
+                freq_c_m[units] = freq_c.mean(axis=1)
+
+            pvals[np.isnan(pvals)] = 1
+
+            for key in (k for k in keys if k['period'] == period):
+                i = unit_ind[tuple(key[a] for a in unit_attrs)]
+                if not present[i].any():  # no spikes found
+                    entries.append({**key, 'period_selectivity': 'non-selective'})
+                    continue
+                if pvals[i] > cls.alpha:
+                    pref = 'non-selective'
+                else:
+                    pref = ('ipsi-selective' if freq_i_m[i] > freq_c_m[i]
+                            else 'contra-selective')
+                entries.append({**key, 'p_value': pvals[i],
+                                'period_selectivity': pref,
+                                'ipsi_firing_rate': freq_i_m[i],
+                                'contra_firing_rate': freq_c_m[i]})
+
+        cls.insert(entries, allow_direct_insert=True)
+
 
 @schema
 class UnitSelectivity(dj.Computed):
@@ -470,6 +884,42 @@ class UnitSelectivity(dj.Computed):
 
         self.insert1({**key, 'unit_selectivity': pref})
 
+    @classmethod
+    def make_session(cls, session_key):
+        """
+        Compute UnitSelectivity for all the units to be populated in a session,
+         from one fetch of the session's PeriodSelectivity
+        """
+        log.debug('UnitSelectivity.make_session(): key: {}'.format(session_key))
+
+        keys = ((cls().key_source - cls) & session_key).fetch('KEY')
+        if not keys:
+            return
+
+        unit_attrs = ephys.Unit.primary_key
+        unit_periods = {}
+        for r in (PeriodSelectivity & session_key).fetch(
+                *unit_attrs, 'period', 'period_selectivity', 'contra_firing_rate', 'ipsi_firing_rate',
+                as_dict=True, order_by=unit_attrs + ['period']):
+            unit_periods.setdefault(tuple(r[a] for a in unit_attrs), []).append(r)
+
+        entries = []
+        for key in keys:
+            periods = unit_periods[tuple(key[a] for a in unit_attrs)]
+
+            if all(r['period_selectivity'] == 'non-selective' for r in periods):
+                entries.append({**key, 'unit_selectivity': 'non-selective'})
+                continue
+
+            contra_frate, ipsi_frate = np.array([(r['contra_firing_rate'], r['ipsi_firing_rate'])
+                                                 for r in periods
+                                                 if r['period'] in ('sample', 'delay', 'response')]).T
+
+            pref = ('ipsi-selective' if ipsi_frate.mean() > contra_frate.mean() else 'contra-selective')
+            entries.append({**key, 'unit_selectivity': pref})
+
+        cls.insert(entries, allow_direct_insert=True)
+
 
 def compute_unit_psth(unit_key, trial_keys, per_trial=False):
     """
@@ -502,6 +952,28 @@ def compute_unit_psth(unit_key, trial_keys, per_trial=False):
         return psth, edges[1:]
 
 
+def _bin_spike_trains(spike_trains, binning):
+    """
+    Vectorized binning of many spike trains at once - same bin convention as np.histogram
+    :param spike_trains: list of spike-time arrays (e.g. fetched TrialSpikes)
+    :param binning: bin edges
+    :return: (spike_train index, bin index) of every spike falling within the binning
+    """
+    spike_counts = [len(s) for s in spike_trains]
+    if not sum(spike_counts):
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    spikes = np.concatenate(spike_trains).astype(float)
+    spike_train_ind = np.repeat(np.arange(len(spike_trains)), spike_counts)
+
+    n_bins = len(binning) - 1
+    bin_ind = np.searchsorted(binning, spikes, side='right') - 1
+    bin_ind[spikes == binning[-1]] = n_bins - 1  # last bin is right-inclusive
+    in_range = (bin_ind >= 0) & (bin_ind < n_bins)
+
+    return spike_train_ind[in_range], bin_ind[in_range]
+
+
 def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     """
     Coding direction here is a vector of length: len(unit_keys)
@@ -527,54 +999,85 @@ def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     return cd_vec / np.linalg.norm(cd_vec)
 
 
-def compute_CD_projected_psth(units, time_period=None):
+def compute_CD_trial_psths(units):
+    """
+    Per-trial PSTH of all the specified units over the contra and ipsi no early-lick, correct-response trials
+     - from one TrialSpikes fetch, binned all at once into a trial# x unit# x time tensor
+    :param units: list of unit_keys (all from the same session)
+    :return: contra-trials psth (trial# x unit# x time),
+             ipsi-trials psth (trial# x unit# x time),
+             psth time-stamps,
+             units hemisphere
+    """
+    unit_hemi = _get_units_hemisphere(units)
+    session_key = experiment.Session & units
+    if len(session_key) != 1:
+        raise Exception('Units from multiple sessions found')
+    session_key = session_key.fetch1('KEY')
+
+    unit_attrs = ephys.Unit.primary_key
+    unit_ind = {tuple(u[a] for a in unit_attrs): i for i, u in enumerate(units)}
+
+    # get units and trials - ensuring they have trial-spikes
+    contra_trials = TrialCondition.get_trials(
+        'good_noearlylick_right_hit' if unit_hemi == 'left' else 'good_noearlylick_left_hit', session_key)
+    ipsi_trials = TrialCondition.get_trials(
+        'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit', session_key)
+    trials = contra_trials.proj() + ipsi_trials.proj()
+
+    if ephys.ProbeInsertionQuality & units:
+        trials &= ephys.ProbeInsertionQuality.GoodTrial
+
+    *row_unit_ids, row_trials, spikes = (ephys.Unit.TrialSpikes & units & trials).fetch(
+        *unit_attrs, 'trial', 'spike_times')
+    row_unit = np.array([unit_ind[u] for u in zip(*row_unit_ids)], dtype=int)
+
+    trial_ids = np.unique(row_trials).astype(int)
+    row_trial = np.searchsorted(trial_ids, row_trials)
+
+    xmin, xmax, bin_size = UnitPsth.psth_params.values()
+    binning = np.arange(xmin, xmax, bin_size)
+    n_bins = len(binning) - 1
+
+    # spike counts - trial# x unit# x time
+    spike_row, spike_bin = _bin_spike_trains(spikes, binning)
+    trial_psths = np.bincount((row_trial[spike_row] * len(units) + row_unit[spike_row]) * n_bins + spike_bin,
+                              minlength=len(trial_ids) * len(units) * n_bins).reshape(
+        len(trial_ids), len(units), n_bins) / bin_size
+
+    is_contra = np.isin(trial_ids, contra_trials.fetch('trial'))
+    is_ipsi = np.isin(trial_ids, ipsi_trials.fetch('trial'))
+
+    return trial_psths[is_contra], trial_psths[is_ipsi], binning[1:], unit_hemi
+
+
+def compute_CD_projected_psth(units, time_period=None, trial_psths=None):
     """
     Routine for Coding Direction computation on all the units in the specified unit_keys
     Coding Direction is calculated in the specified time_period
     Unit PSTH are computed over no early-lick, correct-response trials
     :param: unit_keys - list of unit_keys
     :param time_period: (time_from, time_to) in seconds, relative to go-cue
+    :param trial_psths: output of `compute_CD_trial_psths(units)` - computed if not provided
     :return: coding direction unit-vector,
              contra-trials CD projected trial-psth,
              ipsi-trials CD projected trial-psth
              psth time-stamps
     """
-    unit_hemi = _get_units_hemisphere(units)
-    session_key = experiment.Session & units
-    if len(session_key) != 1:
-        raise Exception('Units from multiple sessions found')
-
-    # -- the computation part
-    # get units and trials - ensuring they have trial-spikes
-    contra_trials = (TrialCondition().get_trials(
-        'good_noearlylick_right_hit' if unit_hemi == 'left' else 'good_noearlylick_left_hit')
-                     & session_key & ephys.Unit.TrialSpikes).fetch('KEY')
-    ipsi_trials = (TrialCondition().get_trials(
-        'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit')
-                     & session_key & ephys.Unit.TrialSpikes).fetch('KEY')
-
-    # get per-trial unit psth for all units - unit# x (trial# x time)
-    contra_trial_psths, contra_edges = zip(*(compute_unit_psth(unit, contra_trials, per_trial=True)
-                                             for unit in units))
-    ipsi_trial_psths, ipsi_edges = zip(*(compute_unit_psth(unit, ipsi_trials, per_trial=True)
-                                         for unit in units))
+    if trial_psths is None:
+        trial_psths = compute_CD_trial_psths(units)
+    contra_trial_psths, ipsi_trial_psths, time_stamps, unit_hemi = trial_psths
 
     # compute trial-ave unit psth
-    contra_psths = zip((p.mean(axis=0) for p in contra_trial_psths), contra_edges)
-    ipsi_psths = zip((p.mean(axis=0) for p in ipsi_trial_psths), ipsi_edges)
+    contra_psths = zip(contra_trial_psths.mean(axis=0), repeat(time_stamps))
+    ipsi_psths = zip(ipsi_trial_psths.mean(axis=0), repeat(time_stamps))
 
     # compute coding direction
     cd_vec = compute_coding_direction(contra_psths, ipsi_psths, time_period=time_period)
 
-    # get time vector, relying on all units PSTH shares the same time vector
-    time_stamps = contra_edges[0]
-
-    # get coding projection per trial - trial# x unit# x time
-    contra_psth_per_trial = np.dstack(contra_trial_psths)
-    ipsi_psth_per_trial = np.dstack(ipsi_trial_psths)
-
-    proj_contra_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in contra_psth_per_trial)  # trial# x time
-    proj_ipsi_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in ipsi_psth_per_trial)    # trial# x time
+    # get coding projection per trial - trial# x time
+    proj_contra_trial = np.einsum('iuj,u->ij', contra_trial_psths, cd_vec)
+    proj_ipsi_trial = np.einsum('iuj,u->ij', ipsi_trial_psths, cd_vec)
 
     return cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps, unit_hemi
 
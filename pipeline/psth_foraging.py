@@ -11,6 +11,7 @@ from . import (lab, experiment, ephys)
 
 from . import get_schema_name, dict_to_hash, create_schema_settings
 from pipeline import foraging_model
+from pipeline.psth import trial_condition_cache
 from pipeline.util import _get_unit_independent_variable
 
 schema = dj.schema(get_schema_name('psth_foraging'), **create_schema_settings)
@@ -239,7 +240,17 @@ class TrialCondition(dj.Lookup):
                 for d in contents_data)
 
     @classmethod
-    def get_trials(cls, trial_condition_name, trial_offset=0):
+    def get_trials(cls, trial_condition_name, trial_offset=0, session_key=None):
+        '''
+        Trials of a trial condition, shifted by `trial_offset`.
+        :param session_key: if given, the trials of this session only, served
+            from `psth.trial_condition_cache` (as a query on experiment.BehaviorTrial)
+        '''
+        if session_key is not None:
+            return trial_condition_cache.get_trials_query(
+                cls, trial_condition_name, session_key,
+                partial(cls.get_trials, trial_condition_name, trial_offset), trial_offset)
+
         return cls.get_func({'trial_condition_name': trial_condition_name}, trial_offset)()
 
     @classmethod
@@ -103,7 +103,20 @@ def ingest_ephys(*args):
 
 
 def ingest_units(*args):
+    '''
+    ingest-units [--workers N]: with N > 1 workers (default: dj.config['custom']['ephys.ingest_workers']),
+    the probes of each session are loaded in parallel and inserted in one transaction
+    '''
     from pipeline import ephys
+    from pipeline.ingest import ephys as ephys_ingest
+
+    workers = ephys_ingest.get_ingest_workers(
+        args[args.index('--workers') + 1] if '--workers' in args else None)
+
+    if workers > 1:
+        ephys_ingest.populate_units(workers=workers, reserve_jobs=True, display_progress=True,
+                                    suppress_errors=True)
+
     ephys.Unit.populate(reserve_jobs=True, display_progress=True, suppress_errors=True)
     ephys.ClusterMetric.populate(reserve_jobs=True, display_progress=True, suppress_errors=True)
 
@@ -463,11 +476,11 @@ def populate_ephys(populate_settings={'reserve_jobs': True, 'display_progress':
 
 def populate_psth(populate_settings={'reserve_jobs': True, 'display_progress': True}):
 
-    log.info('psth.UnitPsth.populate()')
-    psth.UnitPsth.populate(**populate_settings)
+    log.info('psth.UnitPsth.populate_by_insertion()')
+    psth.UnitPsth.populate_by_insertion(**populate_settings)
 
-    log.info('psth.PeriodSelectivity.populate()')
-    psth.PeriodSelectivity.populate(**populate_settings)
+    log.info('psth.PeriodSelectivity.populate_by_session()')
+    psth.PeriodSelectivity.populate_by_session(**populate_settings)
 
     log.info('psth.UnitSelectivity.populate()')
     psth.UnitSelectivity.populate(**populate_settings)
@@ -478,11 +491,11 @@ def populate_psth(populate_settings={'reserve_jobs': True, 'display_progress': T
 
 
 def populate_foraging_analysis(populate_settings={'reserve_jobs': True, 'display_progress': True}):
-    log.info('foraging_analysis.TrialStats.populate()')
-    foraging_analysis.TrialStats.populate(**populate_settings)
+    log.info('foraging_analysis.TrialStats.populate_by_session()')
+    foraging_analysis.TrialStats.populate_by_session(**populate_settings)
 
-    log.info('foraging_analysis.BlockStats.populate()')
-    foraging_analysis.BlockStats.populate(**populate_settings)
+    log.info('foraging_analysis.BlockStats.populate_by_session()')
+    foraging_analysis.BlockStats.populate_by_session(**populate_settings)
 
     log.info('foraging_analysis.SessionTaskProtocol.populate()')
     foraging_analysis.SessionTaskProtocol.populate(**populate_settings)
@@ -500,6 +513,21 @@ def populate_foraging_analysis(populate_settings={'reserve_jobs': True, 'display
     foraging_analysis.BlockEfficiency.populate(**populate_settings)
 
 
+def populate_foraging_model(*args):
+    '''
+    populate-foraging-model [--workers N]: FittedSessionModel, with the fit and cross-validation folds
+    of all (session, model) run in N processes (default: dj.config['custom']['foraging_model.fit_workers'])
+    and checkpointed in dj.config['custom']['foraging_model.checkpoint_dir']
+    '''
+    workers = args[args.index('--workers') + 1] if '--workers' in args else None
+
+    log.info('foraging_model.populate_fitted_session_models()')
+    foraging_model.populate_fitted_session_models(workers=workers, reserve_jobs=True, suppress_errors=True)
+
+    log.info('foraging_model.FittedSessionModelComparison.populate()')
+    foraging_model.FittedSessionModelComparison.populate(reserve_jobs=True, display_progress=True)
+
+
 def populate_oralfacial_analysis(populate_settings={'reserve_jobs': True, 'display_progress': True}):
     #log.info('oralfacial_analysis.LickLatency.populate()')
     log.info('oralfacial_analysis.GLMFitNoLickBody.populate()')
@@ -806,6 +834,7 @@ actions = {
     'ingest-histology': (ingest_histology, 'ingest histology data'),
     'ingest-all': (ingest_all, 'run auto ingest job (load all types)'),
     'populate-psth': (populate_psth, 'populate psth schema'),
+    'populate-foraging-model': (populate_foraging_model, 'fit behavioral models to foraging sessions'),
     'publication-login': (publication_login, 'login to globus'),
     'publication-publish-ephys': (publication_publish_ephys,
                                   'publish raw ephys data to globus'),
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+"""
+Benchmark insertion of ephys.Unit.TrialSpikes-like rows on a mocked DataJoint connection:
+    + InsertBuffer - one dict per (unit, trial), chunked by row count (the former ingest_units path)
+    + ColumnarInsertBuffer - unit/trial columns + flat spike buffer, chunked by statement size
+
+The mocked connection performs the client-side escaping of the query arguments (as pymysql does)
+but does not send anything - so this measures the Python-side cost of building the INSERTs.
+
+Usage: benchmark_columnar_insert.py [n_units] [n_trials] [mean_spikes_per_trial]
+"""
+
+import sys
+import time
+
+import numpy as np
+import datajoint as dj
+import pymysql.converters
+from datajoint.heading import Heading, default_attribute_properties
+
+from pipeline import InsertBuffer, ColumnarInsertBuffer
+
+
+class MockConnection:
+    def __init__(self):
+        self.query_count = 0
+        self.query_bytes = 0
+
+    def query(self, query, args=(), **kwargs):
+        self.query_count += 1
+        self.query_bytes += len(query) + sum(len(pymysql.converters.escape_item(a, 'utf8')) for a in args)
+
+
+class MockTable(dj.Table):
+    """ dj.Table with a fixed heading and a mocked connection - uses the actual `Table.insert` """
+    table_name = '_unit__trial_spikes'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._support = None
+        self.database = 'map_v2_ephys'
+        self._heading = Heading([
+            dict(default_attribute_properties, name=name, type=attr_type, in_key=in_key, comment='',
+                 numeric=not is_blob, is_blob=is_blob)
+            for name, attr_type, in_key, is_blob in (
+                ('subject_id', 'int', True, False),
+                ('session', 'smallint', True, False),
+                ('insertion_number', 'int', True, False),
+                ('unit', 'smallint', True, False),
+                ('trial', 'smallint', True, False),
+                ('spike_times', 'longblob', False, True))])
+
+    @property
+    def connection(self):
+        return self._connection
+
+
+def make_trial_spikes(n_units, n_trials, mean_spikes):
+    counts = np.random.poisson(mean_spikes, n_units * n_trials)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    spike_times = np.random.uniform(-3, 3, offsets[-1])
+    units = np.repeat(np.arange(n_units), n_trials)
+    trials = np.tile(np.arange(n_trials) + 1, n_units)
+    return units, trials, spike_times, offsets
+
+
+def run_insert_buffer(key, units, trials, spike_times, offsets):
+    rel = MockTable(MockConnection())
+    with InsertBuffer(rel, 10000, skip_duplicates=True, allow_direct_insert=True) as ib:
+        for i, (u, t) in enumerate(zip(units, trials)):
+            ib.insert1({**key, 'unit': u, 'trial': t,
+                        'spike_times': spike_times[offsets[i]:offsets[i + 1]]})
+            ib.flush()
+    return rel.connection
+
+
+def run_columnar_insert_buffer(key, units, trials, spike_times, offsets):
+    rel = MockTable(MockConnection())
+    with ColumnarInsertBuffer(rel, skip_duplicates=True) as ib:
+        ib.insert({'unit': units, 'trial': trials}, key=key,
+                  ragged={'spike_times': (spike_times, offsets)})
+    return rel.connection
+
+
+def main(n_units=500, n_trials=600, mean_spikes=20):
+    np.random.seed(0)
+    key = {'subject_id': 1, 'session': 1, 'insertion_number': 1}
+    data = make_trial_spikes(int(n_units), int(n_trials), float(mean_spikes))
+    n_rows = len(data[0])
+
+    print('{} rows ({} units x {} trials), {} spikes'.format(n_rows, n_units, n_trials, len(data[2])))
+    for name, runner in (('InsertBuffer', run_insert_buffer),
+                         ('ColumnarInsertBuffer', run_columnar_insert_buffer)):
+        start = time.time()
+        conn = runner(key, *data)
+        duration = time.time() - start
+        print('{:>22}: {:8.2f} s - {:>10.0f} rows/s - {} statements, {:.1f} MB'.format(
+            name, duration, n_rows / duration, conn.query_count, conn.query_bytes / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
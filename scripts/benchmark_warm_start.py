@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+"""
+Benchmark the warm start of the foraging model fits (FittedSessionModel with dj.config['custom']['foraging_model.warm_start'])
+on sessions simulated by a Hattori2019 forager:
+    + cold: each (session, model) DE fit starts from a random (Latin hypercube) population
+    + warm: the DE population is seeded with the fits of the related models (same model class) of the same session,
+            and of the same model on the previous session (as foraging_model.get_warm_start_seeds)
+
+The fit and cross-validation fold tasks are scheduled as by foraging_model.populate_fitted_session_models
+(fitting_tasks.run_dependent_fit_tasks - with fitting_tasks.warm_start_dependencies if warm), in this process,
+for the MODELS of the model classes below.
+Reports the number of likelihood evaluations (n_eval, i.e. parameter vectors evaluated - with the vectorized DE,
+scipy's nfev counts the calls to the objective instead) of all tasks, the DE generations (nit) and the log likelihood
+of the fit.
+
+Usage: benchmark_warm_start.py [n_sessions] [n_trials]
+"""
+
+import sys
+from collections import defaultdict
+
+import numpy as np
+
+from pipeline.model import fitting_functions
+from pipeline.model.bandit_model import BanditModel
+from pipeline.model.fitting_tasks import make_fit_tasks, run_dependent_fit_tasks, warm_start_dependencies
+from pipeline.model.models import MODELS
+
+MODEL_CLASSES = ['RW1972', 'LNP', 'Bari2019', 'Hattori2019']
+SUBJECT_ID = 0
+
+n_eval = 0
+
+
+def counted(func):
+    """ count the parameter vectors evaluated by a (vectorized) objective """
+    def counted_func(x, *args):
+        global n_eval
+        n_eval += 1 if np.ndim(x) == 1 else np.shape(x)[1]
+        return func(x, *args)
+    return counted_func
+
+
+fitting_functions.negLL_func = counted(fitting_functions.negLL_func)
+fitting_functions.negLL_func_batch = counted(fitting_functions.negLL_func_batch)
+
+
+def simulate_sessions(n_sessions, n_trials):
+    sessions = []
+    for _ in range(n_sessions):
+        bandit = BanditModel(forager='Hattori2019', n_trials=n_trials, learn_rate_rew=0.4, learn_rate_unrew=0.1,
+                             forget_rate=0.1, softmax_temperature=0.3, biasL=0.2)
+        bandit.simulate()
+        sessions.append((bandit.choice_history[:, :n_trials], bandit.reward_history[:, :n_trials]))
+    return sessions
+
+
+def get_fits(sessions):
+    """ {name: (subject_id, session, model_class, model_id)} of the models of MODEL_CLASSES (model_id: as Model) """
+    fits = {}
+    for session in range(len(sessions)):
+        for model_id, (forager, *_) in enumerate(MODELS):
+            model_class = [mc for mc in MODEL_CLASSES if mc in forager]
+            if model_class:
+                fits['{}_{}_{}'.format(SUBJECT_ID, session, model_id)] = (SUBJECT_ID, session, model_class[0], model_id)
+    return fits
+
+
+def warm_start_seeds(fits, name, fitted):
+    """ as foraging_model.get_warm_start_seeds, from the fits of this run """
+    subject_id, session, model_class, model_id = fits[name]
+    fitted = {fits[n]: dict(zip(MODELS[fits[n][3]][1], result.x)) for n, result in fitted.items()}
+    previous_session = max([f_session for _, f_session, _, f_model_id in fitted
+                            if f_model_id == model_id and f_session < session], default=None)
+    return [params for (_, f_session, f_model_class, f_model_id), params in sorted(fitted.items())
+            if (f_session == session and f_model_class == model_class and f_model_id != model_id)
+            or (f_session == previous_session and f_model_id == model_id)]
+
+
+def run_fits(sessions, warm_start):
+    global n_eval
+    np.random.seed(0)
+    fits = get_fits(sessions)
+
+    def make_tasks(name, fitted):
+        _, session, _, model_id = fits[name]
+        choice_history, reward_history = sessions[session]
+        return make_fit_tasks(name, MODELS[model_id][:4], choice_history, reward_history, DE_pop_size=16,
+                              DE_seeds=warm_start_seeds(fits, name, fitted) if warm_start else None)
+
+    stats = defaultdict(lambda: dict(n_eval=0, time=0))
+    n_eval = 0
+    for task, result, wall_time, error in run_dependent_fit_tasks(
+            list(fits), warm_start_dependencies(fits) if warm_start else {}, make_tasks):
+        if error is not None:
+            raise error
+        _, session, _, model_id = fits[task['name']]
+        fit_stats = stats[(session, model_id)]
+        fit_stats['n_eval'] += n_eval
+        fit_stats['time'] += wall_time
+        if task['kind'] == 'fit':
+            fit_stats.update(nit=result.nit, log_likelihood=result.log_likelihood)
+        n_eval = 0
+    return [dict(session=session, model=model_id, **stats[(session, model_id)])
+            for session, model_id in sorted(stats)]
+
+
+if __name__ == '__main__':
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    np.random.seed(0)
+    sessions = simulate_sessions(n_sessions, n_trials)
+
+    cold = run_fits(sessions, warm_start=False)
+    warm = run_fits(sessions, warm_start=True)
+
+    print('{} sessions x {} trials, {} models'.format(n_sessions, n_trials, len(cold) // n_sessions))
+    print('{:>7} {:>5} {:>10} {:>10} {:>6} {:>6} {:>10} {:>10}'.format(
+        'session', 'model', 'n_eval_c', 'n_eval_w', 'nit_c', 'nit_w', 'LL_cold', 'LL_warm'))
+    for c, w in zip(cold, warm):
+        print('{:>7} {:>5} {:>10} {:>10} {:>6} {:>6} {:>10.2f} {:>10.2f}'.format(
+            c['session'], c['model'], c['n_eval'], w['n_eval'], c['nit'], w['nit'], c['log_likelihood'], w['log_likelihood']))
+
+    for label, stats in (('cold', cold), ('warm', warm)):
+        print('{}: n_eval = {}, nit = {}, time = {:.1f} s, sum LL = {:.2f}'.format(
+            label, sum(s['n_eval'] for s in stats), sum(s['nit'] for s in stats),
+            sum(s['time'] for s in stats), sum(s['log_likelihood'] for s in stats)))
+    print('n_eval reduction: {:.1%}'.format(1 - sum(s['n_eval'] for s in warm) / sum(s['n_eval'] for s in cold)))
@@ -0,0 +1,74 @@
+"""
+Test of the population-batched likelihood of the bandit models (negLL_func_batch)
+against the per-parameter-vector likelihood (negLL_func), for each of the foraging MODELS
+"""
+
+import unittest
+
+import numpy as np
+
+from pipeline.model.fitting_functions import negLL_func, negLL_func_batch
+from pipeline.model.models import MODELS
+
+
+POPULATION_SIZE = 20
+
+
+def generate_session(rng, n_trials, forager, if_sessions):
+    """ random choice/reward history (and iti, session_num) - with the trials to be fitted """
+    choice_history = rng.randint(0, 2, (1, n_trials))
+    reward_history = np.zeros((2, n_trials))
+    reward_history[choice_history[0], np.arange(n_trials)] = rng.rand(n_trials) < 0.5
+    iti = rng.uniform(1, 10, n_trials)
+    session_num = np.sort(rng.randint(0, 3, n_trials)) if if_sessions else None
+
+    excluded = []
+    if forager == 'RW1972_epsi':
+        # The greedy choice of RW1972_epsi breaks ties randomly: continuous rewards (no ties after the first trial),
+        # and the first trial of each session (all values 0) is not fitted
+        reward_history[choice_history[0], np.arange(n_trials)] = rng.uniform(0.1, 1, n_trials)
+        excluded = [np.flatnonzero(session_num == ss)[0] for ss in np.unique(session_num)] if if_sessions else [0]
+
+    return choice_history, reward_history, iti, session_num, excluded
+
+
+class TestNegLLFuncBatch(unittest.TestCase):
+
+    def check_models(self, seed, if_fit_set, if_sessions):
+        rng = np.random.RandomState(seed)
+        for model_id, (forager, fit_names, fit_lb, fit_ub, desc) in enumerate(MODELS):
+            with self.subTest(model_id=model_id, desc=desc):
+                n_trials = rng.randint(50, 300)
+                choice_history, reward_history, iti, session_num, excluded = generate_session(
+                    rng, n_trials, forager, if_sessions)
+
+                fit_set = np.setdiff1d(rng.choice(n_trials, n_trials // 2, replace=False) if if_fit_set
+                                       else np.arange(n_trials), excluded)
+                if not if_fit_set and not len(excluded):
+                    fit_set = []   # All trials
+
+                population = np.array([rng.uniform(lb, ub, POPULATION_SIZE) for lb, ub in zip(fit_lb, fit_ub)])
+                args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, fit_set)
+
+                expected = np.array([negLL_func(population[:, ss], *args) for ss in range(POPULATION_SIZE)])
+                negLL = negLL_func_batch(population, *args)
+
+                self.assertEqual(negLL.shape, (POPULATION_SIZE,))
+                np.testing.assert_allclose(negLL, expected, rtol=1e-9)
+
+                # A single parameter vector
+                negLL_single = negLL_func_batch(population[:, 0], *args)
+                self.assertEqual(np.ndim(negLL_single), 0)
+                np.testing.assert_allclose(negLL_single, expected[0], rtol=1e-9)
+
+    def test_all_trials(self):
+        self.check_models(0, if_fit_set=False, if_sessions=False)
+
+    def test_fit_set(self):
+        self.check_models(1, if_fit_set=True, if_sessions=False)
+
+    def test_sessions(self):
+        self.check_models(2, if_fit_set=False, if_sessions=True)
+
+    def test_fit_set_sessions(self):
+        self.check_models(3, if_fit_set=True, if_sessions=True)
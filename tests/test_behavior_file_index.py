@@ -0,0 +1,81 @@
+"""
+Test of the incremental behavior file index (BehaviorIngest.key_source) on a synthetic rig directory tree
+"""
+
+import datetime
+import os
+import pathlib
+import tempfile
+import unittest
+
+from pipeline.ingest.utils.behavior_file_index import BehaviorFileIndex
+
+
+def write_behavior_file(rigpath, subpath, content=b'mat'):
+    fullpath = rigpath / subpath
+    fullpath.parent.mkdir(parents=True, exist_ok=True)
+    fullpath.write_bytes(content)
+    return fullpath
+
+
+def make_rigs(tmp_path):
+    rigs = [['RRig2', (tmp_path / 'rig2').as_posix(), 1],
+            ['RRig', (tmp_path / 'rig1').as_posix(), 0]]
+    write_behavior_file(tmp_path / 'rig1', 'dl7/TW_autoTrain/Session Data/dl7_TW_autoTrain_20180104_132813.mat')
+    write_behavior_file(tmp_path / 'rig1', 'dl7/TW_autoTrain/Session Data/dl7_TW_autoTrain_20180105_101010.mat')
+    write_behavior_file(tmp_path / 'rig1', 'dl7/TW_autoTrain/Session Data/notes.txt')
+    write_behavior_file(tmp_path / 'rig2', 'SC011/Foraging/Session Data/SC011_Foraging_20190301_090000.mat')
+    write_behavior_file(tmp_path / 'rig2', 'SC011/Foraging/Session Data/SC011_Foraging_20191399_090000.mat')
+    return rigs
+
+
+class TestBehaviorFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = pathlib.Path(tmp_dir.name)
+
+    def test_records(self):
+        tmp_path = self.tmp_path
+        index = BehaviorFileIndex(make_rigs(tmp_path))
+        index.refresh()
+
+        records = index.records
+        self.assertEqual([r['filename'] for r in records], [
+            'dl7_TW_autoTrain_20180104_132813.mat', 'dl7_TW_autoTrain_20180105_101010.mat',
+            'SC011_Foraging_20190301_090000.mat'])  # rigs in search order, invalid names/dates skipped
+
+        r = records[-1]
+        self.assertEqual(r['rig'], 'RRig2')
+        self.assertEqual(r['rig_data_path'], (tmp_path / 'rig2').as_posix())
+        self.assertEqual(r['subpath'], 'SC011/Foraging/Session Data/SC011_Foraging_20190301_090000.mat')
+        self.assertEqual(r['h2o'], 'SC011')
+        self.assertEqual(r['session_date'], datetime.date(2019, 3, 1))
+        self.assertEqual(r['size'], 3)
+
+    def test_incremental_refresh(self):
+        tmp_path = self.tmp_path
+        rigs = make_rigs(tmp_path)
+        index_file = tmp_path / 'index' / 'behavior_files.pkl'
+
+        index = BehaviorFileIndex(rigs, index_file)
+        self.assertEqual(index.refresh(), 8)
+        self.assertTrue(index_file.exists())
+        self.assertEqual(index.refresh(), 0)
+
+        # only the directory with a new file is listed again - also from the index on disk
+        session_dir = tmp_path / 'rig2' / 'SC011' / 'Foraging' / 'Session Data'
+        write_behavior_file(tmp_path / 'rig2', 'SC011/Foraging/Session Data/SC011_Foraging_20190302_090000.mat')
+        os.utime(session_dir, ns=(0, session_dir.stat().st_mtime_ns + 1))
+
+        index = BehaviorFileIndex(rigs, index_file)
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual(len(index.records), 4)
+
+        # removed directories are dropped
+        for f in session_dir.iterdir():
+            f.unlink()
+        session_dir.rmdir()
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual({r['rig'] for r in index.records}, {'RRig'})
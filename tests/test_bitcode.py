@@ -0,0 +1,112 @@
+"""
+Property-based tests of the vectorized bitcode decoding/matching of the nidq.XA.txt bitcode files
+against the former per-trial implementation, on randomly generated trials and bitcodes
+"""
+
+import unittest
+
+import numpy as np
+
+from pipeline.ingest.utils.bitcodes import decode_bitcodes, match_bitcodes
+
+
+TIME_TO_FIRST_HIGH_BIT = 0.05
+INTER_BIT_INTERVAL = 0.007
+
+
+def per_trial_decode_bitcodes(trial_starts, bitcode_times):
+    """ reference: the former per-trial decoding of `build_bitcode` """
+    trial_ends = np.concatenate([trial_starts[1:], [trial_starts[-1] + 99]])
+    bitcodes = []
+    for trial_start, trial_end in zip(trial_starts, trial_ends):
+        trial_bitcode_times = bitcode_times[np.logical_and(bitcode_times >= trial_start,
+                                                           bitcode_times < trial_end)]
+        trial_bitcode_times = np.concatenate(
+            [[trial_start + TIME_TO_FIRST_HIGH_BIT - INTER_BIT_INTERVAL], trial_bitcode_times])
+        high_bit_ind = np.cumsum(np.round(np.diff(trial_bitcode_times) / INTER_BIT_INTERVAL)).astype(int) - 1
+        bitcode = np.zeros(10).astype(int)
+        bitcode[high_bit_ind] = 1
+        bitcode = ''.join(bitcode.astype(str))
+        bitcodes.append(bitcode)
+    return bitcodes
+
+
+def per_trial_match_bitcodes(bitcodes, trial_start_times, behavior_bitcodes, behav_trials, go_times):
+    """ reference: the former per-trial matching of `read_bitcode` """
+    ephys_bitcodes, trial_numbers, ephys_trial_start_times, ephys_trial_ref_times = [], [], [], []
+    for bitcode, start_time in zip(bitcodes, trial_start_times):
+        matched_trial_idx = np.where(behavior_bitcodes == bitcode)[0]
+        if len(matched_trial_idx):
+            matched_trial_idx = matched_trial_idx[0]
+            ephys_trial_start_times.append(start_time)
+            ephys_bitcodes.append(bitcode)
+            trial_numbers.append(behav_trials[matched_trial_idx])
+            ephys_trial_ref_times.append(start_time + go_times[matched_trial_idx])
+
+    return (ephys_bitcodes, np.array(trial_numbers),
+            np.array(ephys_trial_start_times), np.array(ephys_trial_ref_times))
+
+
+def generate_bitcode_times(rng, n_trials, jitter=0.001):
+    """ trial start times and high-bit times of random 10-bit bitcodes (plus out-of-trial/spurious edges) """
+    trial_starts = np.round(np.cumsum(rng.uniform(0.05, 8, n_trials)) + rng.uniform(0, 100), 6)
+    bits = rng.rand(n_trials, 10) < 0.5
+    trial_idx, bit_idx = np.nonzero(bits)
+    bitcode_times = (trial_starts[trial_idx] + TIME_TO_FIRST_HIGH_BIT + bit_idx * INTER_BIT_INTERVAL
+                     + rng.uniform(-jitter, jitter, len(trial_idx)))
+    # edges before the first trial, in the last trial's tail and doubled edges (out-of-range bit positions wrap)
+    extra = [trial_starts[0] - rng.uniform(0, 10, 3), trial_starts[-1] + rng.uniform(1, 120, 3)]
+    if n_trials > 1 and rng.rand() < 0.5:
+        extra.append(bitcode_times[:2] + rng.uniform(0, INTER_BIT_INTERVAL / 3, 2))
+    bitcode_times = np.sort(np.concatenate([bitcode_times] + extra))
+    return trial_starts, np.round(bitcode_times, 6)
+
+
+class TestBitcodes(unittest.TestCase):
+
+    def test_decode_bitcodes(self):
+        for seed in range(50):
+            with self.subTest(seed=seed):
+                rng = np.random.RandomState(seed)
+                trial_starts, bitcode_times = generate_bitcode_times(rng, rng.randint(1, 300))
+
+                try:
+                    expected = per_trial_decode_bitcodes(trial_starts, bitcode_times)
+                except IndexError:
+                    with self.assertRaises(IndexError):
+                        decode_bitcodes(trial_starts, bitcode_times)
+                    continue
+
+                bitcodes = decode_bitcodes(trial_starts, bitcode_times)
+                self.assertEqual(bitcodes, expected)
+                self.assertTrue(all(isinstance(b, str) for b in bitcodes))
+
+    def test_decode_bitcodes_no_high_bit(self):
+        trial_starts = np.array([1., 5., 9.])
+        self.assertEqual(decode_bitcodes(trial_starts, np.array([])), ['0' * 10] * 3)
+        self.assertEqual(decode_bitcodes(trial_starts, np.array([0.5, 200.])), ['0' * 10] * 3)
+
+    def test_match_bitcodes(self):
+        for seed in range(50):
+            with self.subTest(seed=seed):
+                rng = np.random.RandomState(seed)
+                n_behavior = rng.randint(0, 200)
+                behav_trials = np.arange(1, n_behavior + 1)
+                behavior_bitcodes = np.array([''.join(rng.choice(list('01'), 10)) for _ in range(n_behavior)],
+                                             dtype=object)
+                go_times = rng.uniform(0, 3, n_behavior) if rng.rand() < 0.5 else np.zeros_like(behav_trials)
+
+                # ephys trials: a subset of the behavior trials, in order, with unmatched bitcodes interleaved
+                n_ephys = rng.randint(0, n_behavior + 5)
+                bitcodes = [behavior_bitcodes[i] if n_behavior and rng.rand() < 0.8 else 'unmatched'
+                            for i in np.sort(rng.randint(0, max(n_behavior, 1), n_ephys))]
+                trial_start_times = np.cumsum(rng.uniform(1, 8, n_ephys))
+
+                expected = per_trial_match_bitcodes(bitcodes, trial_start_times, behavior_bitcodes, behav_trials,
+                                                    go_times)
+                result = match_bitcodes(bitcodes, trial_start_times, behavior_bitcodes, behav_trials, go_times)
+
+                self.assertEqual(result[0], expected[0])
+                for r, e in zip(result[1:], expected[1:]):
+                    np.testing.assert_array_equal(r, e)
+                    self.assertEqual(r.shape, e.shape)
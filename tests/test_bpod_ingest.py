@@ -0,0 +1,298 @@
+"""
+Regression test of the session-batched trial construction of BehaviorBpodIngest
+against the former per-trial construction, on a synthetic pybpod csv file
+"""
+
+import datetime
+import decimal
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from pipeline import dict_to_hash
+from pipeline.ingest.utils.bpod_csv import load_and_parse_a_csv_file
+from pipeline.ingest.utils.bpod_trials import build_trial_rows, water_port_name_mapper
+
+
+WATER_PORT_CHANNELS = {'left': 'Port1In', 'right': 'Port2In', 'middle': 'Port3In'}
+
+
+def write_bpod_csv(csvfilename, n_trials=40, seed=0):
+    """ a pybpod-like csv file of a 2-lickport foraging session """
+    rng = np.random.RandomState(seed)
+    session_start = datetime.datetime(2021, 3, 4, 12, 0, 0)
+    rows, clock = [], [0.]
+
+    def add_row(row_type, msg, info='', initial='', final=''):
+        clock[0] += 0.0137
+        pc_time = session_start + datetime.timedelta(seconds=clock[0])
+        rows.append(';'.join([row_type, pc_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                              str(initial), str(final), msg, info]))
+
+    ports = {'L': WATER_PORT_CHANNELS['left'], 'R': WATER_PORT_CHANNELS['right']}
+    variables = {'lickport_number': 2,
+                 'reward_probabilities_L': [0.1, 0.5, 0.5, 0.9],
+                 'reward_probabilities_R': [0.9, 0.5, 0.5, 0.1],
+                 'WaterPort_L_ch_in': ports['L'], 'WaterPort_R_ch_in': ports['R'],
+                 'ValveOpenTime_L': 0.03, 'ValveOpenTime_R': 0.04}
+    motors = {'LickPort_Lateral_pos': 1000., 'LickPort_RostroCaudal_pos': 2000.,
+              'LickPort_DorsoVentral_pos': 3000.}
+
+    add_row('INFO', 'CREATOR-NAME', '["experimenter"]')
+    add_row('INFO', 'SUBJECT-NAME', "['HH09', 'abc']")
+
+    for trial in range(n_trials):
+        add_row('DEBUG', 'TrialBitCode: ')
+        add_row('DEBUG', ''.join(rng.choice(list('01'), 20)))
+        add_row('TRIAL', 'New trial')
+        if trial == 0:
+            for msg, value in (('Random seed:', rng.randint(1e6)),
+                               ('Variables:', variables), ('LickportMotors:', motors)):
+                add_row('DEBUG', msg)
+                add_row('DEBUG', repr(value))
+        if trial == n_trials // 2:
+            add_row('DEBUG', 'Variables updated:')
+            add_row('DEBUG', repr({'ValveOpenTime_L': 0.035}))
+        add_row('DEBUG', 'Blocknumber:')
+        add_row('DEBUG', 'n/a' if trial == 3 else str(1 + trial * 4 // n_trials))
+        add_row('DEBUG', 'Trialnumber:')
+        add_row('DEBUG', str(trial + 1))
+        for port in ports:
+            add_row('DEBUG', 'reward_{}_accumulated:'.format(port))
+            add_row('DEBUG', str(rng.rand() < 0.3))
+
+        trial_time = [0.]
+
+        def add_state(name, duration):
+            add_row('TRANSITION', name)
+            add_row('STATE', name, '', round(trial_time[0], 4), round(trial_time[0] + duration, 4))
+            trial_time[0] += duration
+
+        add_state('ITIBeforeVideoOn', 0.5)
+        add_state('Start', 0.42)
+        if rng.rand() < 0.3:  # early lick
+            add_state('DelayStart', 0.2)
+            add_row('EVENT', ports['L'], ports['L'], round(trial_time[0], 4))
+        add_state('DelayStart', 1.)
+        if trial != 7:  # a trial without go cue
+            add_state('GoCue', 0.1)
+        if rng.rand() < 0.2:
+            add_row('STATE', 'Auto_Water_L', '0.02', round(trial_time[0], 4), round(trial_time[0] + .02, 4))
+        if rng.rand() < 0.8:
+            port = rng.choice(list(ports))
+            add_row('EVENT', ports[port], ports[port], round(trial_time[0] + 0.05, 4))
+            add_state('Choice_{}'.format(port), 0.05)
+            if rng.rand() < 0.5:
+                add_state('Reward_{}'.format(port), 0.03)
+            for _ in range(rng.randint(4)):
+                port = rng.choice(list(ports))
+                add_row('EVENT', ports[port], ports[port], round(trial_time[0] + rng.rand(), 4))
+        add_state('ITI', 1.)
+        add_state('ITIAfterVideoOff', 0.1)
+        add_row('TRANSITION', 'End')
+        add_row('END-TRIAL', '', '', round(trial_time[0], 4))
+
+    with open(csvfilename, 'w') as f:
+        f.write('\n' * 6)
+        f.write('TYPE;PC-TIME;BPOD-INITIAL-TIME;BPOD-FINAL-TIME;MSG;+INFO\n')
+        f.write('\n'.join(rows) + '\n')
+
+
+def per_trial_rows(df_behavior_session, sess_key, session_start_time, task, task_protocol,
+                   lick_ports, water_port_channels, subject_trial_count, concat_sess_blocks):
+    """ the former per-trial construction of BehaviorBpodIngest.make (one bpod session) """
+    rows = {k: list() for k in ('sess_trial', 'behavior_trial', 'trial_note', 'sess_block',
+                                'sess_block_trial', 'trial_choice', 'trial_event', 'action_event',
+                                'valve_setting', 'valve_open_dur', 'available_reward')}
+
+    trial_start_idxs = df_behavior_session[(df_behavior_session['TYPE'] == 'TRIAL') & (df_behavior_session['MSG'] == 'New trial')].index
+    trial_start_idxs -= 2
+    trial_start_idxs = pd.Index([0]).append(trial_start_idxs[1:])
+    trial_end_idxs = trial_start_idxs[1:].append(pd.Index([(max(df_behavior_session.index))]))
+
+    trial_num = 0
+    blocknum_local_prev = np.nan
+
+    for trial_start_idx, trial_end_idx in zip(trial_start_idxs, trial_end_idxs):
+        df_behavior_trial = df_behavior_session[trial_start_idx:trial_end_idx + 1]
+
+        if not len(df_behavior_trial[(df_behavior_trial['MSG'] == 'GoCue') & (df_behavior_trial['TYPE'] == 'STATE')]):
+            continue
+
+        trial_num += 1
+        trial_uid = subject_trial_count + trial_num
+
+        trial_start_time = df_behavior_session['PC-TIME'][trial_start_idx].to_pydatetime() - session_start_time
+        trial_stop_time = df_behavior_session['PC-TIME'][trial_end_idx].to_pydatetime() - session_start_time
+
+        sess_trial_key = {**sess_key, 'trial': trial_num, 'trial_uid': trial_uid,
+                          'start_time': trial_start_time.total_seconds(),
+                          'stop_time': trial_stop_time.total_seconds()}
+        rows['sess_trial'].append(sess_trial_key)
+
+        if 'Block_number' in df_behavior_session:
+            if np.isnan(df_behavior_trial['Block_number'].to_list()[0]):
+                blocknum_local = 0 if np.isnan(blocknum_local_prev) else blocknum_local_prev
+            else:
+                blocknum_local = int(df_behavior_trial['Block_number'].to_list()[0]) - 1
+                blocknum_local_prev = blocknum_local
+
+            reward_probability = {}
+            for lick_port in lick_ports:
+                p_reward_varname = 'var:reward_probabilities_{}'.format(water_port_name_mapper[lick_port])
+                reward_probability[lick_port] = decimal.Decimal(
+                    df_behavior_session[p_reward_varname][0][blocknum_local]).quantize(decimal.Decimal('.001'))
+
+            if rows['sess_block']:
+                itsanewblock = dict_to_hash(reward_probability) != dict_to_hash(rows['sess_block'][-1]['reward_probability'])
+            else:
+                itsanewblock = True
+
+            if itsanewblock:
+                all_blocks = [b['block'] for b in rows['sess_block'] + concat_sess_blocks]
+                block_num = (np.max(all_blocks) + 1 if all_blocks else 1)
+                rows['sess_block'].append({**sess_key, 'block': block_num,
+                                           'block_start_time': trial_start_time.total_seconds(),
+                                           'reward_probability': reward_probability})
+            else:
+                block_num = rows['sess_block'][-1]['block']
+
+            rows['sess_block_trial'].append({**sess_trial_key, 'block': block_num})
+
+        bpod_states_this_trial = df_behavior_trial[(df_behavior_trial['TYPE'] == 'STATE') & (df_behavior_trial['BPOD-INITIAL-TIME'] > 0)]
+        trial_event_count = 0
+        bpod_states_of_interest = {
+            'videostart': ['ITIBeforeVideoOn'], 'bitcodestart': ['Start'], 'delay': ['DelayStart'], 'go': ['GoCue'],
+            'choice': [f'Choice_{lickport}' for lickport in water_port_name_mapper.values()],
+            'reward': [f'Reward_{lickport}' for lickport in water_port_name_mapper.values()],
+            'doubledip': ['Double_dipped'], 'trialend': ['ITI'], 'videoend': ['ITIAfterVideoOff']}
+
+        for trial_event_type, bpod_state in bpod_states_of_interest.items():
+            _idx = bpod_states_this_trial.index[bpod_states_this_trial['MSG'].isin(bpod_state)]
+            if not len(_idx):
+                continue
+            initials, finals = bpod_states_this_trial.loc[_idx][['BPOD-INITIAL-TIME', 'BPOD-FINAL-TIME']].values.T.astype(float)
+            initials[initials > 9999] = 9999
+            finals[finals > 9999] = 9999
+            for idx, (initial, final) in enumerate(zip(initials, finals)):
+                rows['trial_event'].extend([{**sess_trial_key, 'trial_event_id': trial_event_count + idx,
+                                             'trial_event_type': trial_event_type,
+                                             'trial_event_time': initial, 'duration': final - initial}])
+            trial_event_count += len(initials)
+            if trial_event_type == 'go':
+                gocue_time = initials[0]
+
+        lick_times = {}
+        for lick_port in lick_ports:
+            lick_times[lick_port] = df_behavior_trial['BPOD-INITIAL-TIME'][(
+                df_behavior_trial['+INFO'] == water_port_channels[lick_port])].to_numpy()
+        all_lick_types = np.concatenate([[ltype] * len(ltimes) for ltype, ltimes in lick_times.items()])
+        all_lick_times = np.concatenate([ltimes for ltimes in lick_times.values()])
+        sorted_licks = sorted(zip(all_lick_types, all_lick_times), key=lambda x: x[-1])
+        rows['action_event'].extend([{**sess_trial_key, 'action_event_id': idx,
+                                      'action_event_type': '{} lick'.format(ltype),
+                                      'action_event_time': ltime} for idx, (ltype, ltime) in enumerate(sorted_licks)])
+
+        trial_choice = {'water_port': None}
+        for lick_port in lick_ports:
+            if any((df_behavior_trial['MSG'] == 'Choice_{}'.format(water_port_name_mapper[lick_port]))
+                   & (df_behavior_trial['TYPE'] == 'TRANSITION')):
+                trial_choice['water_port'] = lick_port
+                break
+        rows['trial_choice'].append({**sess_trial_key, **trial_choice})
+
+        early_lick = 'no early'
+        if any(all_lick_times < gocue_time):
+            early_lick = 'early'
+
+        outcome = 'miss' if trial_choice['water_port'] else 'ignore'
+        for lick_port in lick_ports:
+            if any((df_behavior_trial['MSG'] == 'Reward_{}'.format(water_port_name_mapper[lick_port]))
+                   & (df_behavior_trial['TYPE'] == 'TRANSITION')):
+                outcome = 'hit'
+                break
+
+        for lick_port in lick_ports:
+            reward = df_behavior_trial['reward_{}_accumulated'.format(water_port_name_mapper[lick_port])].values[0]
+            rows['available_reward'].append({**sess_trial_key, 'water_port': lick_port,
+                                             'reward_available': False if np.isnan(reward) else reward})
+
+        auto_water = False
+        auto_water_times = {}
+        for lick_port in lick_ports:
+            auto_water_ind = (df_behavior_trial['TYPE'] == 'STATE') & (
+                df_behavior_trial['MSG'] == 'Auto_Water_{}'.format(water_port_name_mapper[lick_port]))
+            if any(auto_water_ind):
+                auto_water = True
+                auto_water_times[lick_port] = float(df_behavior_trial['+INFO'][auto_water_ind.idxmax()])
+        if auto_water_times:
+            auto_water_ports = [k for k, v in auto_water_times.items() if v > 0.001]
+            rows['trial_note'].append({**sess_trial_key, 'trial_note_type': 'autowater',
+                                       'trial_note': 'and '.join(auto_water_ports)})
+
+        if any(df_behavior_trial['MSG'] == 'Random seed:'):
+            seedidx = (df_behavior_trial['MSG'] == 'Random seed:').idxmax() + 1
+            rows['trial_note'].append({**sess_trial_key, 'trial_note_type': 'random_seed_start',
+                                       'trial_note': str(df_behavior_trial['MSG'][seedidx])})
+        if any(df_behavior_trial['MSG'] == 'TrialBitCode: '):
+            bitcode_ind = (df_behavior_trial['MSG'] == 'TrialBitCode: ').idxmax() + 1
+            rows['trial_note'].append({**sess_trial_key, 'trial_note_type': 'bitcode',
+                                       'trial_note': str(df_behavior_trial['MSG'][bitcode_ind])})
+
+        rows['behavior_trial'].append({**sess_trial_key, 'task': task, 'task_protocol': task_protocol,
+                                       'trial_instruction': 'none', 'early_lick': early_lick,
+                                       'outcome': outcome, 'auto_water': auto_water, 'free_water': False})
+
+        valve_setting = {**sess_trial_key}
+        for attr, varname in (('water_port_lateral_pos', 'var_motor:LickPort_Lateral_pos'),
+                              ('water_port_rostrocaudal_pos', 'var_motor:LickPort_RostroCaudal_pos'),
+                              ('water_port_dorsoventral_pos', 'var_motor:LickPort_DorsoVentral_pos')):
+            if varname in df_behavior_trial.keys():
+                valve_setting[attr] = df_behavior_trial[varname].values[0]
+        rows['valve_setting'].append(valve_setting)
+
+        for lick_port in lick_ports:
+            valve_open_varname = 'var:ValveOpenTime_{}'.format(water_port_name_mapper[lick_port])
+            if valve_open_varname in df_behavior_trial:
+                rows['valve_open_dur'].append({**sess_trial_key, 'water_port': lick_port,
+                                               'open_duration': df_behavior_trial[valve_open_varname].values[0]})
+
+    return rows
+
+
+class TestBpodTrialRows(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_session_batched_trial_rows(self):
+        csvfilename = pathlib.Path(self.tmp_dir.name) / 'bpod_session.csv'
+        write_bpod_csv(csvfilename)
+        df_behavior_session = load_and_parse_a_csv_file(csvfilename, use_cache=False)
+
+        session_key = {'subject_id': 1, 'session': 2}
+        sess_key = {**session_key, 'session_date': datetime.date(2021, 3, 4),
+                    'session_time': datetime.time(12, 0, 0), 'username': 'experimenter', 'rig': 'Training-Tower-2'}
+        session_start_time = datetime.datetime.combine(sess_key['session_date'], sess_key['session_time'])
+        lick_ports = ['left', 'right']
+        water_port_channels = {p: WATER_PORT_CHANNELS[p] for p in lick_ports}
+        args = (df_behavior_session, session_start_time, 'foraging', 100, lick_ports, water_port_channels, 500)
+
+        trial_state = {'trial_num': 0, 'gocue_time': None, 'blocks': []}
+        rows = build_trial_rows(*args, trial_state)
+        expected_rows = per_trial_rows(df_behavior_session, sess_key, *args[1:], [])
+
+        self.assertEqual(trial_state['trial_num'], 39)
+        self.assertEqual(len(expected_rows['sess_trial']), 39)
+
+        for tbl, expected in expected_rows.items():
+            if tbl == 'sess_block':
+                self.assertEqual(rows[tbl], [{k: v for k, v in r.items() if k not in sess_key} for r in expected])
+                continue
+            columns = rows[tbl]
+            actual = [dict(zip(columns, values)) for values in zip(*columns.values())]
+            self.assertEqual(actual, [{k: r[k] for k in columns} for r in expected], tbl)